@@ -7,7 +7,16 @@ from ldm.models.diffusion.ddim import DDIMSampler
 class CLIPEvaluator(object):
     def __init__(self, device, clip_model='ViT-B/32') -> None:
         self.device = device
-        self.model, clip_preprocess = clip.load(clip_model, device=self.device)
+        self.clip_model_name = clip_model
+        # The CLIP model is only loaded when it's first used (see load_clip()), 
+        # so that it doesn't occupy GPU memory while e.g. LDMCLIPEvaluator is still sampling.
+        self._model = None
+
+    def load_clip(self):
+        if self._model is not None:
+            return
+
+        self._model, clip_preprocess = clip.load(self.clip_model_name, device=self.device)
 
         self.clip_preprocess = clip_preprocess
         
@@ -15,6 +24,11 @@ class CLIPEvaluator(object):
                                               clip_preprocess.transforms[:2] +                                      # to match CLIP input scale assumptions
                                               clip_preprocess.transforms[4:])                                       # + skip convert PIL to tensor
 
+    @property
+    def model(self):
+        self.load_clip()
+        return self._model
+
     def tokenize(self, strings: list):
         return clip.tokenize(strings).to(self.device)
 
@@ -24,6 +38,7 @@ class CLIPEvaluator(object):
 
     @torch.no_grad()
     def encode_images(self, images: torch.Tensor) -> torch.Tensor:
+        self.load_clip()
         images = self.preprocess(images).to(self.device)
         return self.model.encode_image(images)
 
@@ -58,6 +73,15 @@ class CLIPEvaluator(object):
 
         return (text_features @ gen_img_features.T).mean()
 
+    # Same as (img_to_img_similarity(src_images, generated_images), 
+    #          txt_to_img_similarity(text, generated_images)),
+    # but takes the features of the generated images, so that they are encoded only once for both.
+    def similarities_from_features(self, src_images, text, gen_img_features):
+        src_img_features = self.get_image_features(src_images)
+        text_features    = self.get_text_features(text)
+
+        return (src_img_features @ gen_img_features.T).mean(), (text_features @ gen_img_features.T).mean()
+
 
 class LDMCLIPEvaluator(CLIPEvaluator):
     def __init__(self, device, clip_model='ViT-B/32') -> None:
@@ -70,14 +94,16 @@ class LDMCLIPEvaluator(CLIPEvaluator):
         samples_per_batch = 8
         n_batches         = n_samples // samples_per_batch
 
-        # generate samples
-        all_samples=list()
+        # generate samples, and encode each batch right away. 
+        # Only the CLIP features are kept, instead of concatenating all the samples.
+        all_features=list()
         with torch.no_grad():
             with ldm_model.ema_scope():                
+                # The prompts are the same for all batches, so they are encoded only once.
                 uc = ldm_model.get_learned_conditioning(samples_per_batch * [""])
+                c  = ldm_model.get_learned_conditioning(samples_per_batch * [target_text])
 
                 for batch in range(n_batches):
-                    c = ldm_model.get_learned_conditioning(samples_per_batch * [target_text])
                     shape = [4, 256//8, 256//8]
                     samples_ddim, _ = sampler.sample(S=n_steps,
                                                     conditioning=c,
@@ -91,12 +117,12 @@ class LDMCLIPEvaluator(CLIPEvaluator):
                     x_samples_ddim = ldm_model.decode_first_stage(samples_ddim)
                     x_samples_ddim = torch.clamp(x_samples_ddim, min=-1.0, max=1.0)
 
-                    all_samples.append(x_samples_ddim)
+                    all_features.append(self.get_image_features(x_samples_ddim))
         
-        all_samples = torch.cat(all_samples, axis=0)
+        all_features = torch.cat(all_features, axis=0)
 
-        sim_samples_to_img  = self.img_to_img_similarity(src_images, all_samples)
-        sim_samples_to_text = self.txt_to_img_similarity(target_text.replace("*", ""), all_samples)
+        sim_samples_to_img, sim_samples_to_text = \
+            self.similarities_from_features(src_images, target_text.replace("*", ""), all_features)
 
         return sim_samples_to_img, sim_samples_to_text
 
@@ -106,8 +132,9 @@ class ImageDirEvaluator(CLIPEvaluator):
         super().__init__(device, clip_model)
 
     def evaluate(self, gen_samples, src_images, target_text):
-
-        sim_samples_to_img  = self.img_to_img_similarity(src_images, gen_samples)
-        sim_samples_to_text = self.txt_to_img_similarity(target_text.replace("*", ""), gen_samples)
+        # Encode gen_samples once for both similarities.
+        gen_img_features = self.get_image_features(gen_samples)
+        sim_samples_to_img, sim_samples_to_text = \
+            self.similarities_from_features(src_images, target_text.replace("*", ""), gen_img_features)
 
         return sim_samples_to_img, sim_samples_to_text
\ No newline at end of file
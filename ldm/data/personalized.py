@@ -149,6 +149,8 @@ class PersonalizedBase(Dataset):
                  mixing_prob=0.25,
                  coarse_class_text=None,
                  num_composition_samples_per_batch=1,
+                 # The downsampling factor from images to latents of the first stage model.
+                 latent_downsample_factor=8,
                  ):
 
         self.data_root = data_root
@@ -192,6 +194,7 @@ class PersonalizedBase(Dataset):
             self.random_scaler = None
 
         self.num_composition_samples_per_batch = num_composition_samples_per_batch
+        self.latent_downsample_factor = latent_downsample_factor
 
     def __len__(self):
         return self._length
@@ -304,6 +307,12 @@ class PersonalizedBase(Dataset):
 
             # mask[mask > 0] = 1. No need to do thresholding, as mask is uint8.
             example["mask"]  = mask
+            # The mask at the latent resolution. With an integer factor, 
+            # nearest interpolation is simply taking every f-th pixel.
+            # Precomputed here on the dataloader workers, so that shared_step() 
+            # doesn't need to upload the full-res mask and interpolate it on the GPU.
+            f = self.latent_downsample_factor
+            example["mask_latent"] = np.ascontiguousarray(mask[::f, ::f])
 
         image = np.array(image).astype(np.uint8)
         example["image"] = (image / 127.5 - 1.0).astype(np.float32)
@@ -8,7 +8,7 @@ from taming.modules.vqvae.quantize import VectorQuantizer2 as VectorQuantizer
 from ldm.modules.diffusionmodules.model import Encoder, Decoder
 from ldm.modules.distributions.distributions import DiagonalGaussianDistribution
 
-from ldm.util import instantiate_from_config
+from ldm.util import instantiate_from_config, rescale_to_pm1
 
 
 class VQModel(pl.LightningModule):
@@ -63,15 +63,15 @@ class VQModel(pl.LightningModule):
     @contextmanager
     def ema_scope(self, context=None):
         if self.use_ema:
-            self.model_ema.store(self.parameters())
-            self.model_ema.copy_to(self)
+            # Swap in the EMA weights by reference, instead of backing up and copying all params.
+            self.model_ema.swap(self)
             if context is not None:
                 print(f"{context}: Switched to EMA weights")
         try:
             yield None
         finally:
             if self.use_ema:
-                self.model_ema.restore(self.parameters())
+                self.model_ema.swap(self)
                 if context is not None:
                     print(f"{context}: Restored training weights")
 
@@ -257,7 +257,7 @@ class VQModel(pl.LightningModule):
         if not hasattr(self, "colorize"):
             self.register_buffer("colorize", torch.randn(3, x.shape[1], 1, 1).to(x))
         x = F.conv2d(x, weight=self.colorize)
-        x = 2.*(x-x.min())/(x.max()-x.min()) - 1.
+        x = rescale_to_pm1(x)
         return x
 
 
@@ -419,7 +419,7 @@ class AutoencoderKL(pl.LightningModule):
         if not hasattr(self, "colorize"):
             self.register_buffer("colorize", torch.randn(3, x.shape[1], 1, 1).to(x))
         x = F.conv2d(x, weight=self.colorize)
-        x = 2.*(x-x.min())/(x.max()-x.min()) - 1.
+        x = rescale_to_pm1(x)
         return x
 
 
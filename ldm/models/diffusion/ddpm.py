@@ -11,29 +11,45 @@ import torch.nn as nn
 import torch.nn.functional as F
 
 import os
+import inspect
+import itertools
 import numpy as np
 import pytorch_lightning as pl
 from torch.optim.lr_scheduler import LambdaLR
-from einops import rearrange, repeat
+from einops import rearrange
 from contextlib import contextmanager
 from functools import partial
 from tqdm import tqdm
 from torchvision.utils import make_grid
 from pytorch_lightning.utilities.distributed import rank_zero_only
 
-from ldm.util import log_txt_as_img, exists, default, ismap, isimage, mean_flat, count_params, instantiate_from_config
+from ldm.util import log_txt_as_img, exists, default, ismap, isimage, mean_flat, count_params, instantiate_from_config, \
+                     rescale_to_pm1, params_version_key
 from ldm.modules.ema import LitEma
 from ldm.modules.distributions.distributions import normal_kl, DiagonalGaussianDistribution
 from ldm.models.autoencoder import VQModelInterface, IdentityFirstStage, AutoencoderKL
-from ldm.modules.diffusionmodules.util import make_beta_schedule, extract_into_tensor, noise_like
+from ldm.modules.diffusionmodules.util import make_beta_schedule, extract_into_tensor, noise_like, \
+                                           resize_mask_nearest, concat_cfg_conditioning
 from ldm.models.diffusion.ddim import DDIMSampler
 import copy
 from functools import partial
+from collections import OrderedDict
 
 __conditioning_keys__ = {'concat': 'c_concat',
                          'crossattn': 'c_crossattn',
                          'adm': 'y'}
 
+# Schedule coefficients that are multiplied into the latents in q_sample / q_posterior.
+# Half-precision copies of them are kept, so that under autocast the gathered coefficients 
+# already have the dtype of the latents.
+__half_coef_names__ = ['sqrt_alphas_cumprod', 'sqrt_one_minus_alphas_cumprod',
+                       'sqrt_recip_alphas_cumprod', 'sqrt_recipm1_alphas_cumprod',
+                       'posterior_mean_coef1', 'posterior_mean_coef2']
+__half_dtype_suffixes__ = {torch.float16: '_h', torch.bfloat16: '_bf'}
+# Accepted values of the *_autocast_dtype options of LatentDiffusion.
+__autocast_dtypes__ = { None: None, 'fp16': torch.float16, 'float16': torch.float16,
+                        'bf16': torch.bfloat16, 'bfloat16': torch.bfloat16 }
+
 
 def disabled_train(self, mode=True):
     """Overwrite model.train with this function to make sure train/eval mode
@@ -45,6 +61,50 @@ def uniform_on_device(r1, r2, shape, device):
     return (r1 - r2) * torch.rand(*shape, device=device) + r2
 
 
+# torch.optim.AdamW, using the fused CUDA implementation (PyTorch >= 2.0) when all the params 
+# are CUDA float tensors. It updates all the params in a few kernels, instead of a few per param.
+# params: a list of params, or of param group dicts, as accepted by torch.optim.AdamW.
+def make_adamw(params, **kwargs):
+    groups = params if len(params) > 0 and isinstance(params[0], dict) else [ {'params': params} ]
+    all_params = [ param for group in groups for param in group['params'] ]
+    if 'fused' in inspect.signature(torch.optim.AdamW).parameters and len(all_params) > 0 \
+      and all(param.is_cuda and param.is_floating_point() for param in all_params):
+        kwargs['fused'] = True
+    return torch.optim.AdamW(params, **kwargs)
+
+
+# Extract the sliding crops of x as a strided view, without the im2col copy made by nn.Unfold.
+# x: (b, c, h, w). Returns a view of shape (b, c, kernel_size[0], kernel_size[1], Ly, Lx).
+# Flattening (Ly, Lx) gives the crop dim L of nn.Unfold, in the same order.
+def unfold_crops(x, kernel_size, stride):
+    b, c, h, w = x.shape
+    Ly = (h - kernel_size[0]) // stride[0] + 1
+    Lx = (w - kernel_size[1]) // stride[1] + 1
+    sb, sc, sh, sw = x.stride()
+    return x.as_strided((b, c, kernel_size[0], kernel_size[1], Ly, Lx),
+                        (sb, sc, sh, sw, sh * stride[0], sw * stride[1]))
+
+
+# The list of the L crops in crops: (b, c, k0, k1, Ly, Lx), in nn.Unfold order. All are views.
+def crops_to_list(crops):
+    return [ crop for crop_row in crops.unbind(-2) for crop in crop_row.unbind(-1) ]
+
+
+# Scripted, so that the fuser merges the subtraction, squaring and reduction into one kernel,
+# instead of materializing the full (B, C, H, W) squared error before reducing it.
+@torch.jit.script
+def per_sample_mse(pred, target):
+    return (pred - target).pow(2).flatten(1).mean(dim=1)
+
+
+# Same as per_sample_mse(pred * mask, target * mask), i.e., the squared error on the masked region 
+# (averaged over all elements). The masking is fused into the same kernel, instead of 
+# materializing the masked copies of pred and target first.
+@torch.jit.script
+def per_sample_masked_mse(pred, target, mask):
+    return ((pred - target) * mask).pow(2).flatten(1).mean(dim=1)
+
+
 class DDPM(pl.LightningModule):
     # classic DDPM with Gaussian diffusion, in image space
     def __init__(self,
@@ -82,6 +142,8 @@ class DDPM(pl.LightningModule):
                  use_ada_embedding=False,
                  composition_delta_reg_iter_gap=-1,
                  composition_delta_reg_weight=0.,
+                 compile_sampler=False,
+                 compile_unet=False,
                  ):
         super().__init__()
         assert parameterization in ["eps", "x0"], 'currently only supporting "eps" and "x0"'
@@ -100,10 +162,15 @@ class DDPM(pl.LightningModule):
         self.composition_delta_reg_iter_gap = composition_delta_reg_iter_gap
         self.composition_delta_reg_weight   = composition_delta_reg_weight
         self.do_static_comp_delta_reg       = False
+        # compile_sampler: compile the denoising step of DDPM.p_sample_loop() with torch.compile 
+        # (requires torch >= 2.0). The compiled step is built on the first sampling call.
+        self.compile_sampler = compile_sampler and hasattr(torch, 'compile')
+        self._compiled_step  = None
         self.do_ada_comp_delta_reg          = False
 
         self.model = DiffusionWrapper(unet_config, conditioning_key, 
-                                      use_layerwise_embedding, use_ada_embedding)
+                                      use_layerwise_embedding, use_ada_embedding,
+                                      compile_unet=compile_unet)
         count_params(self.model, verbose=True)
         self.use_ema = use_ema
         if self.use_ema:
@@ -131,11 +198,32 @@ class DDPM(pl.LightningModule):
                                linear_start=linear_start, linear_end=linear_end, cosine_s=cosine_s)
 
         self.loss_type = loss_type
+        # Resolve the loss function once, instead of dispatching on loss_type at every get_loss() call.
+        if loss_type == 'l1':
+            self._loss_fn = F.l1_loss
+        elif loss_type == 'l2':
+            self._loss_fn = F.mse_loss
+        else:
+            raise NotImplementedError(f"unknown loss type '{loss_type}'")
 
         self.learn_logvar = learn_logvar
-        self.logvar = torch.full(fill_value=logvar_init, size=(self.num_timesteps,))
+        logvar = torch.full(fill_value=logvar_init, size=(self.num_timesteps,))
         if self.learn_logvar:
-            self.logvar = nn.Parameter(self.logvar, requires_grad=True)
+            self.logvar = nn.Parameter(logvar, requires_grad=True)
+        else:
+            # As a buffer, logvar is moved to the model device together with the model, 
+            # instead of being copied from CPU at every p_losses() call.
+            # Non-persistent, as it's a constant, and older checkpoints don't contain it.
+            self.register_buffer('logvar', logvar, persistent=False)
+        # A fixed all-zero logvar (the default) makes the loss reweighting in p_losses() an identity.
+        self.logvar_is_zero = not self.learn_logvar and logvar_init == 0
+
+        # Noise buffer reused by p_losses() across training steps. See randn_like_reused().
+        self._noise_buf = None
+        # Buffer of the doubled x_noisy batch reused by p_losses(). See repeat2_reused().
+        self._repeat2_buf = None
+        # Buffers of the initial latents of the sampling loops, keyed by shape. See randn_reused().
+        self._randn_bufs = {}
 
 
     def register_schedule(self, given_betas=None, beta_schedule="linear", timesteps=1000,
@@ -161,49 +249,100 @@ class DDPM(pl.LightningModule):
         self.register_buffer('alphas_cumprod', to_torch(alphas_cumprod))
         self.register_buffer('alphas_cumprod_prev', to_torch(alphas_cumprod_prev))
 
-        # calculations for diffusion q(x_t | x_{t-1}) and others
-        self.register_buffer('sqrt_alphas_cumprod', to_torch(np.sqrt(alphas_cumprod)))
-        self.register_buffer('sqrt_one_minus_alphas_cumprod', to_torch(np.sqrt(1. - alphas_cumprod)))
-        self.register_buffer('log_one_minus_alphas_cumprod', to_torch(np.log(1. - alphas_cumprod)))
-        self.register_buffer('sqrt_recip_alphas_cumprod', to_torch(np.sqrt(1. / alphas_cumprod)))
-        self.register_buffer('sqrt_recipm1_alphas_cumprod', to_torch(np.sqrt(1. / alphas_cumprod - 1)))
-
+        # All the other schedule coefficients are derived from the three arrays above in one pass.
+        one_minus_alphas_cumprod = 1. - alphas_cumprod
         # calculations for posterior q(x_{t-1} | x_t, x_0)
-        posterior_variance = (1 - self.v_posterior) * betas * (1. - alphas_cumprod_prev) / (
-                    1. - alphas_cumprod) + self.v_posterior * betas
+        posterior_variance = (1 - self.v_posterior) * betas * (1. - alphas_cumprod_prev) / \
+                             one_minus_alphas_cumprod + self.v_posterior * betas
         # above: equal to 1. / (1. / (1. - alpha_cumprod_tm1) + alpha_t / beta_t)
-        self.register_buffer('posterior_variance', to_torch(posterior_variance))
-        # below: log calculation clipped because the posterior variance is 0 at the beginning of the diffusion chain
-        self.register_buffer('posterior_log_variance_clipped', to_torch(np.log(np.maximum(posterior_variance, 1e-20))))
-        self.register_buffer('posterior_mean_coef1', to_torch(
-            betas * np.sqrt(alphas_cumprod_prev) / (1. - alphas_cumprod)))
-        self.register_buffer('posterior_mean_coef2', to_torch(
-            (1. - alphas_cumprod_prev) * np.sqrt(alphas) / (1. - alphas_cumprod)))
+        derived_schedule = {
+            # calculations for diffusion q(x_t | x_{t-1}) and others
+            'sqrt_alphas_cumprod':              np.sqrt(alphas_cumprod),
+            'sqrt_one_minus_alphas_cumprod':    np.sqrt(one_minus_alphas_cumprod),
+            'log_one_minus_alphas_cumprod':     np.log(one_minus_alphas_cumprod),
+            'sqrt_recip_alphas_cumprod':        np.sqrt(1. / alphas_cumprod),
+            'sqrt_recipm1_alphas_cumprod':      np.sqrt(1. / alphas_cumprod - 1),
+            'posterior_variance':               posterior_variance,
+            # log calculation clipped because the posterior variance is 0 at the beginning of the diffusion chain
+            'posterior_log_variance_clipped':   np.log(np.maximum(posterior_variance, 1e-20)),
+            'posterior_mean_coef1':             betas * np.sqrt(alphas_cumprod_prev) / one_minus_alphas_cumprod,
+            'posterior_mean_coef2':             (1. - alphas_cumprod_prev) * np.sqrt(alphas) / one_minus_alphas_cumprod,
+        }
+        for name, coef in derived_schedule.items():
+            self.register_buffer(name, to_torch(coef))
+
+        for name in __half_coef_names__:
+            for dtype, suffix in __half_dtype_suffixes__.items():
+                self.register_buffer(name + suffix, getattr(self, name).to(dtype), persistent=False)
 
         if self.parameterization == "eps":
             lvlb_weights = self.betas ** 2 / (
                         2 * self.posterior_variance * to_torch(alphas) * (1 - self.alphas_cumprod))
         elif self.parameterization == "x0":
-            lvlb_weights = 0.5 * np.sqrt(torch.Tensor(alphas_cumprod)) / (2. * 1 - torch.Tensor(alphas_cumprod))
+            alphas_cumprod_t = torch.from_numpy(alphas_cumprod).float()
+            # NOTE: "2. * 1 - a" is 2 - a, not 2 * (1 - a). Kept as is to preserve the original weights.
+            lvlb_weights = 0.5 * alphas_cumprod_t.sqrt() / (2. * 1 - alphas_cumprod_t)
         else:
             raise NotImplementedError("mu not supported")
         # TODO how to choose this term
         lvlb_weights[0] = lvlb_weights[1]
         self.register_buffer('lvlb_weights', lvlb_weights, persistent=False)
-        assert not torch.isnan(self.lvlb_weights).all()
+        # Checked once at construction, while the weights are still on the CPU.
+        assert not torch.isnan(self.lvlb_weights).any()
+
+    # Return the schedule buffer `name` in the precision matching `dtype`.
+    # fp16/bf16 latents get the half-precision copy, avoiding a cast on every gather.
+    def schedule_coef(self, name, dtype):
+        suffix = __half_dtype_suffixes__.get(dtype, '')
+        return getattr(self, name + suffix)
+
+    # Draw standard normal noise of x's shape into a buffer reused across training steps,
+    # instead of allocating a new tensor at every step. The returned noise is only valid 
+    # until the next call.
+    def randn_like_reused(self, x):
+        buf = self._noise_buf
+        if buf is None or buf.shape != x.shape or buf.dtype != x.dtype or buf.device != x.device:
+            buf = self._noise_buf = torch.empty_like(x)
+        return buf.normal_()
+
+    # Draw the initial latents of a sampling loop into a buffer reused across sampling calls
+    # (log_images() runs several sampling loops of the same shape), instead of allocating a new one.
+    # 4-D buffers are channels_last, the layout the sampling loops use.
+    # The returned tensor is only valid until the next call with the same shape.
+    def randn_reused(self, shape, device):
+        key = tuple(shape)
+        buf = self._randn_bufs.get(key)
+        if buf is None or buf.device != torch.device(device):
+            memory_format = torch.channels_last if len(key) == 4 else torch.contiguous_format
+            buf = self._randn_bufs[key] = torch.empty(key, device=device, memory_format=memory_format)
+        return buf.normal_()
+
+    # Equivalent to x.repeat(2, 1, 1, 1), but written into a buffer reused across training steps.
+    # Only for inputs that don't require grad. The returned tensor is only valid until the next call.
+    def repeat2_reused(self, x):
+        if x.requires_grad:
+            return x.repeat(2, *((1,) * (x.ndim - 1)))
+        B = x.shape[0]
+        buf = self._repeat2_buf
+        if buf is None or buf.shape[1:] != x.shape[1:] or buf.shape[0] != 2 * B \
+          or buf.dtype != x.dtype or buf.device != x.device:
+            buf = self._repeat2_buf = x.new_empty((2 * B, *x.shape[1:]))
+        buf[:B].copy_(x)
+        buf[B:].copy_(x)
+        return buf
 
     @contextmanager
     def ema_scope(self, context=None):
         if self.use_ema:
-            self.model_ema.store(self.model.parameters())
-            self.model_ema.copy_to(self.model)
+            # Swap in the EMA weights by reference, instead of backing up and copying all params.
+            self.model_ema.swap(self.model)
             if context is not None:
                 print(f"{context}: Switched to EMA weights")
         try:
             yield None
         finally:
             if self.use_ema:
-                self.model_ema.restore(self.model.parameters())
+                self.model_ema.swap(self.model)
                 if context is not None:
                     print(f"{context}: Restored training weights")
 
@@ -237,17 +376,17 @@ class DDPM(pl.LightningModule):
         log_variance = extract_into_tensor(self.log_one_minus_alphas_cumprod, t, x_start.shape)
         return mean, variance, log_variance
 
+    # The two coefficient products are fused with addcmul, so that only one 
+    # intermediate tensor of x_t's size is materialized instead of two.
     def predict_start_from_noise(self, x_t, t, noise):
-        return (
-                extract_into_tensor(self.sqrt_recip_alphas_cumprod, t, x_t.shape) * x_t -
-                extract_into_tensor(self.sqrt_recipm1_alphas_cumprod, t, x_t.shape) * noise
-        )
+        return torch.addcmul(extract_into_tensor(self.schedule_coef('sqrt_recip_alphas_cumprod', x_t.dtype), t, x_t.shape) * x_t,
+                             extract_into_tensor(self.schedule_coef('sqrt_recipm1_alphas_cumprod', x_t.dtype), t, x_t.shape), noise,
+                             value=-1)
 
     def q_posterior(self, x_start, x_t, t):
-        posterior_mean = (
-                extract_into_tensor(self.posterior_mean_coef1, t, x_t.shape) * x_start +
-                extract_into_tensor(self.posterior_mean_coef2, t, x_t.shape) * x_t
-        )
+        posterior_mean = torch.addcmul(extract_into_tensor(self.schedule_coef('posterior_mean_coef2', x_t.dtype), t, x_t.shape) * x_t,
+                                       extract_into_tensor(self.schedule_coef('posterior_mean_coef1', x_t.dtype), t, x_t.shape),
+                                       x_start)
         posterior_variance = extract_into_tensor(self.posterior_variance, t, x_t.shape)
         posterior_log_variance_clipped = extract_into_tensor(self.posterior_log_variance_clipped, t, x_t.shape)
         return posterior_mean, posterior_variance, posterior_log_variance_clipped
@@ -265,58 +404,101 @@ class DDPM(pl.LightningModule):
         return model_mean, posterior_variance, posterior_log_variance
 
     @torch.no_grad()
-    def p_sample(self, x, t, clip_denoised=True, repeat_noise=False):
+    def p_sample(self, x, t, clip_denoised=True, repeat_noise=False, noise_buf=None, add_noise=None):
         b, *_, device = *x.shape, x.device
         model_mean, _, model_log_variance = self.p_mean_variance(x=x, t=t, clip_denoised=clip_denoised)
-        noise = noise_like(x.shape, device, repeat_noise)
+        # add_noise: whether t != 0 for the whole batch, if the caller knows it (as in p_sample_loop).
+        # Then we branch in Python instead of building the per-instance t == 0 mask on the GPU.
+        if add_noise is not None and not add_noise:
+            return model_mean
+
+        # noise_buf: a preallocated tensor of x's shape, refilled in place at each step.
+        if noise_buf is not None and not repeat_noise:
+            noise = noise_buf.normal_()
+        else:
+            noise = noise_like(x.shape, device, repeat_noise)
+        if add_noise:
+            return torch.addcmul(model_mean, (0.5 * model_log_variance).exp(), noise)
+
         # no noise when t == 0
         nonzero_mask = (1 - (t == 0).float()).reshape(b, *((1,) * (len(x.shape) - 1)))
-        return model_mean + nonzero_mask * (0.5 * model_log_variance).exp() * noise
+        return torch.addcmul(model_mean, nonzero_mask * (0.5 * model_log_variance).exp(), noise)
+
+    # One denoising step of p_sample_loop() at t > 0. The noise is passed in, so that the whole step
+    # is free of random ops and can be captured by torch.compile into one graph.
+    # The noise-free last step (t == 0) runs eagerly, so no t == 0 mask is needed here.
+    def _denoise_step(self, x, t, noise):
+        model_mean, _, model_log_variance = self.p_mean_variance(x=x, t=t, clip_denoised=self.clip_denoised)
+        return torch.addcmul(model_mean, (0.5 * model_log_variance).exp(), noise)
 
     @torch.no_grad()
-    def p_sample_loop(self, shape, return_intermediates=False):
+    def p_sample_loop(self, shape, return_intermediates=False, verbose=True):
         device = self.betas.device
         b = shape[0]
-        img = torch.randn(shape, device=device)
+        # channels_last, for the UNet convs. See LatentDiffusion.__init__().
+        img = torch.randn(shape, device=device).to(memory_format=torch.channels_last)
         intermediates = [img]
-        for i in tqdm(reversed(range(0, self.num_timesteps)), desc='Sampling t', total=self.num_timesteps):
-            img = self.p_sample(img, torch.full((b,), i, device=device, dtype=torch.long),
-                                clip_denoised=self.clip_denoised)
+        # Timestep tensor is allocated once and refilled in place at each step.
+        ts = torch.empty((b,), device=device, dtype=torch.long)
+        noise_buf = torch.empty_like(img)
+        iterator = reversed(range(0, self.num_timesteps))
+        if verbose:
+            iterator = tqdm(iterator, desc='Sampling t', total=self.num_timesteps)
+        if self.compile_sampler and self._compiled_step is None:
+            # 'reduce-overhead' replays the fixed-shape step as a CUDA graph.
+            self._compiled_step = torch.compile(self._denoise_step, mode='reduce-overhead', fullgraph=True)
+
+        for i in iterator:
+            use_compiled_step = self.compile_sampler and i > 0
+            if use_compiled_step:
+                img = self._compiled_step(img, ts.fill_(i), noise_buf.normal_())
+            else:
+                img = self.p_sample(img, ts.fill_(i), clip_denoised=self.clip_denoised, noise_buf=noise_buf,
+                                    add_noise=(i > 0))
             if i % self.log_every_t == 0 or i == self.num_timesteps - 1:
-                intermediates.append(img)
+                # The output of a CUDA graph replay is overwritten by the next replay.
+                intermediates.append(img.clone() if use_compiled_step else img)
+        # The last step (i == 0) runs eagerly, so the returned img is not a CUDA graph output.
         if return_intermediates:
             return img, intermediates
         return img
 
     @torch.no_grad()
-    def sample(self, batch_size=16, return_intermediates=False):
+    def sample(self, batch_size=16, return_intermediates=False, verbose=True):
         image_size = self.image_size
         channels = self.channels
         return self.p_sample_loop((batch_size, channels, image_size, image_size),
-                                  return_intermediates=return_intermediates)
+                                  return_intermediates=return_intermediates, verbose=verbose)
 
     def q_sample(self, x_start, t, noise=None):
         noise = default(noise, lambda: torch.randn_like(x_start))
-        return (extract_into_tensor(self.sqrt_alphas_cumprod, t, x_start.shape) * x_start +
-                extract_into_tensor(self.sqrt_one_minus_alphas_cumprod, t, x_start.shape) * noise)
+        return torch.addcmul(extract_into_tensor(self.schedule_coef('sqrt_alphas_cumprod', x_start.dtype), t, x_start.shape) * x_start,
+                             extract_into_tensor(self.schedule_coef('sqrt_one_minus_alphas_cumprod', x_start.dtype), t, x_start.shape),
+                             noise)
 
     def get_loss(self, pred, target, mean=True):
-        if self.loss_type == 'l1':
-            loss = (target - pred).abs()
-            if mean:
-                loss = loss.mean()
-        elif self.loss_type == 'l2':
-            if mean:
-                loss = torch.nn.functional.mse_loss(target, pred)
-            else:
-                loss = torch.nn.functional.mse_loss(target, pred, reduction='none')
+        return self._loss_fn(target, pred, reduction='mean' if mean else 'none')
+
+    # Mean of the per-sample loss weighted by lvlb_weights[t], done as a single dot product
+    # instead of an elementwise multiplication followed by a mean.
+    def get_vlb_loss(self, loss, t):
+        w = self.lvlb_weights.index_select(0, t).to(loss.dtype)
+        return torch.dot(w, loss) / loss.numel()
+
+    # The loss of each instance, averaged over all the other dims.
+    # If mask is given, the loss is only computed on the masked region.
+    def get_loss_per_sample(self, pred, target, mask=None):
+        if self.loss_type == 'l2':
+            if mask is not None:
+                return per_sample_masked_mse(pred, target, mask.to(pred.dtype))
+            return per_sample_mse(pred, target)
         else:
-            raise NotImplementedError("unknown loss type '{loss_type}'")
-
-        return loss
+            if mask is not None:
+                pred, target = pred * mask, target * mask
+            return self.get_loss(pred, target, mean=False).flatten(1).mean(dim=1)
 
     def p_losses(self, x_start, t, noise=None):
-        noise = default(noise, lambda: torch.randn_like(x_start))
+        noise = default(noise, lambda: self.randn_like_reused(x_start))
         x_noisy = self.q_sample(x_start=x_start, t=t, noise=noise)
         model_out = self.model(x_noisy, t)
 
@@ -328,14 +510,14 @@ class DDPM(pl.LightningModule):
         else:
             raise NotImplementedError(f"Paramterization {self.parameterization} not yet supported")
 
-        loss = self.get_loss(model_out, target, mean=False).mean(dim=[1, 2, 3])
+        loss = self.get_loss_per_sample(model_out, target)
 
         log_prefix = 'train' if self.training else 'val'
 
         loss_dict.update({f'{log_prefix}/loss_simple': loss.mean()})
         loss_simple = loss.mean() * self.l_simple_weight
 
-        loss_vlb = (self.lvlb_weights[t] * loss).mean()
+        loss_vlb = self.get_vlb_loss(loss, t)
         loss_dict.update({f'{log_prefix}/loss_vlb': loss_vlb})
 
         loss = loss_simple + self.original_elbo_weight * loss_vlb
@@ -354,8 +536,10 @@ class DDPM(pl.LightningModule):
         x = batch[k]
         if len(x.shape) == 3:
             x = x[..., None]
-        x = rearrange(x, 'b h w c -> b c h w')
-        x = x.to(memory_format=torch.contiguous_format).float()
+        # 'b h w c -> b c h w'. 
+        x = x.permute(0, 3, 1, 2)
+        # x is a permuted 'b h w c' view, i.e., already channels_last. See LatentDiffusion.__init__().
+        x = x.to(memory_format=torch.channels_last).float()
         return x
 
     # ignore do_composition_delta_reg. It's handled in LatentDiffusion::shared_step().
@@ -364,9 +548,17 @@ class DDPM(pl.LightningModule):
         loss, loss_dict = self(x)
         return loss, loss_dict
 
+    # Under DDP with accumulate_grad_batches > 1, pytorch_lightning already runs the backward 
+    # of non-boundary micro-batches within model.no_sync() (_block_parallel_sync_behavior), 
+    # so gradients are only all-reduced at accumulation boundaries. 
+    # no_sync() has to wrap backward(), which happens outside training_step(), 
+    # so it shouldn't be entered here again.
     def training_step(self, batch, batch_idx):
+        # The composition delta loss is only added to the loss within the embedding_reg_weight > 0 branch 
+        # of p_losses(). Otherwise the 4x delta-prompt batch would be encoded for nothing.
         self.do_static_comp_delta_reg = self.composition_delta_reg_iter_gap > 0 \
-                                            and self.composition_delta_reg_weight > 0
+                                            and self.composition_delta_reg_weight > 0 \
+                                            and self.embedding_reg_weight > 0
         self.do_ada_comp_delta_reg    = self.do_static_comp_delta_reg \
                                             and self.use_ada_embedding \
                                             and self.global_step % self.composition_delta_reg_iter_gap == 0
@@ -398,10 +590,26 @@ class DDPM(pl.LightningModule):
         if self.use_ema:
             self.model_ema(self.model)
 
+    # Noise x_start to each of the logged timesteps (every log_every_t steps, and the last step).
+    # All the timesteps are done in one batched q_sample() call.
+    # Returns a tuple of noisy tensors of x_start's shape, one for each logged timestep.
+    def q_sample_diffusion_row(self, x_start):
+        log_ts = [ t for t in range(self.num_timesteps) 
+                   if t % self.log_every_t == 0 or t == self.num_timesteps - 1 ]
+        t = torch.tensor(log_ts, device=self.device, dtype=torch.long)
+        # The timestep dim is prepended, and x_start is broadcasted along it, 
+        # instead of being repeated len(log_ts) times. Same math as q_sample().
+        noisy_shape = (len(log_ts), *x_start.shape)
+        noise = torch.randn(noisy_shape, device=x_start.device, dtype=x_start.dtype)
+        x_noisy = torch.addcmul(extract_into_tensor(self.schedule_coef('sqrt_alphas_cumprod', x_start.dtype), t, noisy_shape) * x_start,
+                                extract_into_tensor(self.schedule_coef('sqrt_one_minus_alphas_cumprod', x_start.dtype), t, noisy_shape),
+                                noise)
+        return x_noisy.unbind(0)
+
     def _get_rows_from_list(self, samples):
         n_imgs_per_row = len(samples)
-        denoise_grid = rearrange(samples, 'n b c h w -> b n c h w')
-        denoise_grid = rearrange(denoise_grid, 'b n c h w -> (b n) c h w')
+        # 'n b c h w -> b n c h w -> (b n) c h w'.
+        denoise_grid = torch.stack(samples, dim=1).flatten(0, 1)
         denoise_grid = make_grid(denoise_grid, nrow=n_imgs_per_row)
         return denoise_grid
 
@@ -415,17 +623,8 @@ class DDPM(pl.LightningModule):
         log["inputs"] = x
 
         # get diffusion row
-        diffusion_row = list()
         x_start = x[:n_row]
-
-        for t in range(self.num_timesteps):
-            if t % self.log_every_t == 0 or t == self.num_timesteps - 1:
-                t = repeat(torch.tensor([t]), '1 -> b', b=n_row)
-                t = t.to(self.device).long()
-                noise = torch.randn_like(x_start)
-                x_noisy = self.q_sample(x_start=x_start, t=t, noise=noise)
-                diffusion_row.append(x_noisy)
-
+        diffusion_row = self.q_sample_diffusion_row(x_start)
         log["diffusion_row"] = self._get_rows_from_list(diffusion_row)
 
         if sample:
@@ -448,13 +647,18 @@ class DDPM(pl.LightningModule):
         params = list(self.model.parameters())
         if self.learn_logvar:
             params = params + [self.logvar]
-        opt = torch.optim.AdamW(params, lr=lr)
+        opt = make_adamw(params, lr=lr)
         return opt
 
 # LatentDiffusion inherits from DDPM. So:
 # LatentDiffusion.model = DiffusionWrapper(unet_config, conditioning_key, use_layerwise_embedding)
 class LatentDiffusion(DDPM):
     """main class"""
+    # Patch-wise encoding/decoding/denoising is enabled by assigning a dict to 
+    # model.split_input_params. Defaulting it to None on the class makes the checks 
+    # on the hot path a plain attribute read, instead of a failing hasattr() lookup.
+    split_input_params = None
+
     def __init__(self,
                  first_stage_config,
                  cond_stage_config,
@@ -467,10 +671,31 @@ class LatentDiffusion(DDPM):
                  conditioning_key=None,
                  scale_factor=1.0,
                  scale_by_std=False,
+                 max_crop_batch_size=32,
+                 crop_decode_streams=1,
+                 cond_autocast_dtype=None,
+                 sample_autocast_dtype=None,
+                 compile_first_stage=False,
                  *args, **kwargs):
 
         self.num_timesteps_cond = default(num_timesteps_cond, 1)
         self.scale_by_std = scale_by_std
+        # The max number of crops decoded in one batch in the patch-wise first stage decoding.
+        self.max_crop_batch_size = max_crop_batch_size
+        # If > 1, the crop batches are decoded on this many rotating CUDA streams, 
+        # so that the kernels of consecutive batches overlap. See _decode_crops().
+        self.crop_decode_streams = crop_decode_streams
+        self._crop_streams = None
+        # The side stream of decode_first_stage_batched_async(), and its outputs not yet waited for.
+        self._side_decode_stream  = None
+        self._side_decode_outputs = []
+        self._single_crop_notified = False
+        # If set ('fp16' or 'bf16'), the static prompts are encoded by the frozen CLIP text encoder 
+        # under autocast of this dtype, and the embeddings are cast back to fp32 afterwards.
+        self.cond_autocast_dtype = __autocast_dtypes__[cond_autocast_dtype]
+        # If set ('fp16' or 'bf16'), the sampling loops run under autocast of this dtype. 
+        # The default None keeps sampling in fp32. See sample_autocast().
+        self.sample_autocast_dtype = __autocast_dtypes__[sample_autocast_dtype]
         assert self.num_timesteps_cond <= kwargs['timesteps']
         # for backwards compatibility after implementation of DiffusionWrapper
         # conditioning_key: crossattn
@@ -496,12 +721,29 @@ class LatentDiffusion(DDPM):
             self.scale_factor = scale_factor
         else:
             self.register_buffer('scale_factor', torch.tensor(scale_factor))
+        # compile_first_stage: compile first_stage_model.encode() / decode() with torch.compile (PyTorch >= 2.0).
+        self.compile_first_stage = compile_first_stage and hasattr(torch, 'compile')
         self.instantiate_first_stage(first_stage_config)
         self.instantiate_cond_stage(cond_stage_config)
 
         self.cond_stage_forward = cond_stage_forward
         self.clip_denoised = False
         self.bbox_tokenizer = None  
+        # Caches of get_fold_unfold() and delta_border(). Their outputs only depend on the 
+        # input shape and the split_input_params, which don't change across steps.
+        self._fold_cache = {}
+        self._fold_modules = {}
+        self._delta_border_cache = {}
+        # LRU cache of the static prompt embeddings computed without grad (i.e., during sampling),
+        # where the same prompts are encoded again and again. See encode_prompts_cached().
+        self._cond_cache = OrderedDict()
+        self.cond_cache_size = 16
+        # Static embeddings of the class-single prompts. See encode_cls_single_cached().
+        self._cls_emb_cache = {}
+        self._cls_emb_cache_key = None
+        self._cls_emb_layers_checked = False
+        # The first stage posterior of the last input image batch. See encode_first_stage_cached().
+        self._first_stage_cache = None
 
         self.restarted_from_ckpt = False
         if ckpt_path is not None:
@@ -519,6 +761,11 @@ class LatentDiffusion(DDPM):
             self.model.train = disabled_train
             for param in self.model.parameters():
                 param.requires_grad = False
+            # channels_last: the UNet convs run faster with NHWC (tensor-core) kernels. The frozen UNet 
+            # only runs forward passes, so its weights are converted once here. The latents fed to it 
+            # (from get_input() and the sampling loops) and the first stage model use the same layout,
+            # so that the convs don't convert their weights or inputs between layouts at every call.
+            self.model = self.model.to(memory_format=torch.channels_last)
         
         self.embedding_manager = self.instantiate_embedding_manager(personalization_config, self.cond_stage_model)
 
@@ -566,6 +813,15 @@ class LatentDiffusion(DDPM):
         self.first_stage_model.train = disabled_train
         for param in self.first_stage_model.parameters():
             param.requires_grad = False
+        # channels_last, as the input images and the sampled latents. See LatentDiffusion.__init__().
+        self.first_stage_model = self.first_stage_model.to(memory_format=torch.channels_last)
+        if self.compile_first_stage:
+            # The default mode, not 'reduce-overhead': the CUDA graphs of the latter reuse 
+            # their output memory across calls, but _decode_crops() keeps the outputs of 
+            # consecutive decode() calls alive until they are concatenated.
+            # The crop batches have a fixed size except the last one, so shapes are mostly static.
+            self.first_stage_model.encode = torch.compile(self.first_stage_model.encode)
+            self.first_stage_model.decode = torch.compile(self.first_stage_model.decode)
 
     def instantiate_cond_stage(self, config):
         # cond_stage_trainable = True
@@ -599,15 +855,56 @@ class LatentDiffusion(DDPM):
         
         return model
 
+    # Decode a list of latent batches together, in batches of at most max_crop_batch_size latents,
+    # instead of one decode_first_stage() call per latent batch. Returns the decoded batches in a list.
+    def decode_first_stage_batched(self, zs, desc=None, force_not_quantize=False):
+        sizes = [ z.shape[0] for z in zs ]
+        z = torch.cat([ z.to(self.device) for z in zs ])
+        z_chunks = z.split(self.max_crop_batch_size)
+        if desc is not None:
+            z_chunks = tqdm(z_chunks, desc=desc)
+        x = torch.cat([ self.decode_first_stage(z_chunk, force_not_quantize=force_not_quantize)
+                        for z_chunk in z_chunks ])
+        return list(x.split(sizes))
+
+    # decode_first_stage_batched() on a side CUDA stream, so that the decoding overlaps with the work 
+    # issued next on the current stream, e.g., the next sampling loop in log_images().
+    # The outputs must not be used before wait_side_decodes().
+    def decode_first_stage_batched_async(self, zs):
+        if self.device.type != 'cuda':
+            return self.decode_first_stage_batched(zs)
+        if self._side_decode_stream is None:
+            self._side_decode_stream = torch.cuda.Stream(device=self.device)
+        stream = self._side_decode_stream
+        stream.wait_stream(torch.cuda.current_stream(self.device))
+        with torch.cuda.stream(stream):
+            for z in zs:
+                # Keep the caching allocator from handing z's memory to the current stream 
+                # while the side stream still reads it.
+                if z.is_cuda:
+                    z.record_stream(stream)
+            xs = self.decode_first_stage_batched(zs)
+        self._side_decode_outputs.extend(xs)
+        return xs
+
+    # Make the current stream wait for the pending decode_first_stage_batched_async() calls.
+    def wait_side_decodes(self):
+        if self._side_decode_stream is None or len(self._side_decode_outputs) == 0:
+            return
+        cur_stream = torch.cuda.current_stream(self.device)
+        cur_stream.wait_stream(self._side_decode_stream)
+        for x in self._side_decode_outputs:
+            x.record_stream(cur_stream)
+        self._side_decode_outputs = []
+
     def _get_denoise_row_from_list(self, samples, desc='', force_no_decoder_quantization=False):
-        denoise_row = []
-        for zd in tqdm(samples, desc=desc):
-            denoise_row.append(self.decode_first_stage(zd.to(self.device),
-                                                            force_not_quantize=force_no_decoder_quantization))
-        n_imgs_per_row = len(denoise_row)
+        # Decode all the logged steps together, instead of one decode_first_stage() call per step.
+        n_imgs_per_row = len(samples)
+        denoise_row = self.decode_first_stage_batched(samples, desc=desc, 
+                                                      force_not_quantize=force_no_decoder_quantization)
         denoise_row = torch.stack(denoise_row)  # n_log_step, n_row, C, H, W
-        denoise_grid = rearrange(denoise_row, 'n b c h w -> b n c h w')
-        denoise_grid = rearrange(denoise_grid, 'b n c h w -> (b n) c h w')
+        # 'n b c h w -> b n c h w -> (b n) c h w'.
+        denoise_grid = denoise_row.transpose(0, 1).flatten(0, 1)
         denoise_grid = make_grid(denoise_grid, nrow=n_imgs_per_row)
         return denoise_grid
 
@@ -630,7 +927,11 @@ class LatentDiffusion(DDPM):
                 # cond_stage_model: ldm.modules.encoders.modules.FrozenCLIPEmbedder
                 c_in = copy.copy(c)
                 # c: [128, 77, 768]
-                c = self.cond_stage_model.encode(c, embedding_manager=self.embedding_manager)
+                with torch.autocast(self.device.type, dtype=self.cond_autocast_dtype or torch.bfloat16,
+                                    enabled=self.cond_autocast_dtype is not None):
+                    c = self.encode_prompts_cached(c)
+                if self.cond_autocast_dtype is not None and isinstance(c, torch.Tensor):
+                    c = c.float()
                 if isinstance(c, DiagonalGaussianDistribution):
                     c = c.mode()
                 if self.use_ada_embedding:
@@ -640,9 +941,8 @@ class LatentDiffusion(DDPM):
                     # for each layer into the cache. 
                     # The cache will be used in composition_delta_loss().
                     self.embedding_manager.init_ada_embedding_cache()
-                    if self.do_ada_comp_delta_reg and img_mask is not None:
-                        # The image batch is repeated twice, so img_mask is also repeated twice.
-                        img_mask = img_mask.repeat(2, 1, 1, 1)
+                    # If do_ada_comp_delta_reg, the image batch is repeated twice. img_mask is not 
+                    # repeated accordingly, as MaskedAvgPool2d broadcasts it over the repeated batch.
                     self.embedding_manager.set_img_mask(img_mask)
                     c = (c, c_in, embedder)
             else:
@@ -652,6 +952,93 @@ class LatentDiffusion(DDPM):
             c = getattr(self.cond_stage_model, self.cond_stage_forward)(c)
         return c
 
+    # Encode a list of prompts with cond_stage_model, encoding each distinct prompt only once.
+    # Repeated prompts are common in a batch, e.g., cls_prompt_single * REPEATS in shared_step().
+    # Only used for the static embeddings. The ada embeddings depend on the per-instance 
+    # UNet features, so get_ada_conditioning() always encodes the full batch.
+    def encode_unique_prompts(self, c):
+        if not isinstance(c, list) or not all(isinstance(prompt, str) for prompt in c):
+            return self.cond_stage_model.encode(c, embedding_manager=self.embedding_manager)
+
+        uniq_prompts, inverse = np.unique(c, return_inverse=True)
+        if len(uniq_prompts) == len(c):
+            return self.cond_stage_model.encode(c, embedding_manager=self.embedding_manager)
+
+        c_uniq = self.cond_stage_model.encode(list(uniq_prompts), embedding_manager=self.embedding_manager)
+        if not isinstance(c_uniq, torch.Tensor):
+            return self.cond_stage_model.encode(c, embedding_manager=self.embedding_manager)
+        # With layerwise embeddings, each prompt is encoded into 16 consecutive embeddings.
+        c_uniq = c_uniq.view(len(uniq_prompts), -1, *c_uniq.shape[1:])
+        inverse = torch.as_tensor(inverse, device=c_uniq.device)
+        return c_uniq[inverse].flatten(0, 1)
+
+    # Look up the static embeddings of the prompts in _cond_cache before encoding them. 
+    # Only used when grad is disabled, as the cached embeddings are detached. 
+    # The key includes the versions of the embedding_manager params, so that updated 
+    # or reloaded embeddings are never served from a stale entry. subj_scale isn't a param, 
+    # but scales the embeddings as well.
+    def encode_prompts_cached(self, c):
+        if torch.is_grad_enabled() or not isinstance(c, list):
+            return self.encode_unique_prompts(c)
+
+        em = self.embedding_manager
+        em_params_key = params_version_key(em.parameters()) if em is not None else ()
+        key = (tuple(c), self.use_ada_embedding, self.use_layerwise_embedding,
+               getattr(em, 'subj_scale', 1), em_params_key)
+        if key in self._cond_cache:
+            self._cond_cache.move_to_end(key)
+            return self._cond_cache[key].clone()
+
+        c = self.encode_unique_prompts(c)
+        if isinstance(c, torch.Tensor):
+            self._cond_cache[key] = c.detach().clone()
+            if len(self._cond_cache) > self.cond_cache_size:
+                self._cond_cache.popitem(last=False)
+        return c
+
+    # The static embeddings of cls_prompt_single, cached across training steps.
+    # cls prompts contain the class token instead of the placeholder, so their embeddings only depend on 
+    # the text encoder params. The cache is cleared once any of them is updated (with unfreeze_model).
+    # cls_prompt_single is drawn from a small set of templates, so the cache stays small.
+    # cls_prompt_comp is almost always a new composition, and isn't worth caching.
+    # Returns the embeddings in the layout of get_learned_conditioning(): [B * N_LAYERS, 77, 768].
+    def encode_cls_single_cached(self, prompts):
+        N_LAYERS = 16 if self.use_layerwise_embedding else 1
+        params_key = params_version_key(self.cond_stage_model.parameters())
+        if params_key != self._cls_emb_cache_key:
+            self._cls_emb_cache.clear()
+            self._cls_emb_cache_key = params_key
+
+        missing = [ prompt for prompt in dict.fromkeys(prompts) if prompt not in self._cls_emb_cache ]
+        if len(missing) > 0:
+            with torch.no_grad():
+                embs = self.cond_stage_model.encode(missing, embedding_manager=self.embedding_manager)
+            embs = embs.view(len(missing), N_LAYERS, *embs.shape[1:])
+            # Without the placeholder token, the N_LAYERS layerwise embeddings of a prompt are identical,
+            # and only the first one is kept. Checked once, as the check syncs with the host.
+            if not self._cls_emb_layers_checked:
+                assert torch.equal(embs, embs[:, :1].expand_as(embs)), \
+                    "The layerwise embeddings of the class prompts are not identical"
+                self._cls_emb_layers_checked = True
+            embs = embs[:, 0]
+            for prompt, emb in zip(missing, embs):
+                self._cls_emb_cache[prompt] = emb
+
+        embs = torch.stack([ self._cls_emb_cache[prompt] for prompt in prompts ])
+        return embs.unsqueeze(1).expand(-1, N_LAYERS, -1, -1).flatten(0, 1)
+
+    # Insert the cached embeddings of cls_prompt_single into c_static (the output of 
+    # get_learned_conditioning() on the other delta prompts), after the first num_prompts_before prompts. 
+    def insert_cls_single_embeddings(self, c_static, cls_prompt_single, num_prompts_before):
+        N_LAYERS = 16 if self.use_layerwise_embedding else 1
+        c_real = c_static[0] if isinstance(c_static, tuple) else c_static
+        cls_single_emb = self.encode_cls_single_cached(cls_prompt_single).to(c_real.dtype)
+        split_at = num_prompts_before * N_LAYERS
+        c_real = torch.cat([ c_real[:split_at], cls_single_emb, c_real[split_at:] ])
+        if isinstance(c_static, tuple):
+            return (c_real,) + tuple(c_static[1:])
+        return c_real
+
     # get_ada_conditioning() is a callback function called iteratively by each layer in UNet
     # It returns the conditioning embedding (ada embedding & other token embeddings -> clip encoder) 
     # for the current layer to UNet.
@@ -659,13 +1046,68 @@ class LatentDiffusion(DDPM):
         # We don't want to mess with the pipeline of cond_stage_model.encode(), so we pass
         # c_in, layer_idx and layer_infeat directly to embedding_manager. They will be used implicitly
         # when embedding_manager is called within cond_stage_model.encode().
-        self.embedding_manager.set_ada_layer_info(layer_idx, layer_infeat, time_emb)
-        c = self.cond_stage_model.encode(c_in, embedding_manager=self.embedding_manager)
-        return (c, self.embedding_manager.get_ada_emb_weight())
+        em = self.embedding_manager
+        subj_idx, base_idx = self.split_prompts_by_placeholder(c_in)
+        # The split only applies without grad (sampling), and when the image mask doesn't have to be 
+        # matched with a subset of the batch.
+        if torch.is_grad_enabled() or len(base_idx) == 0 or getattr(em, 'img_mask', None) is not None:
+            em.set_ada_layer_info(layer_idx, layer_infeat, time_emb, has_placeholder=len(subj_idx) > 0)
+            c = self.cond_stage_model.encode(c_in, embedding_manager=em)
+            return (c, em.get_ada_emb_weight())
+
+        # The prompts without any placeholder, e.g. the "" prompts of classifier-free guidance, 
+        # are encoded to the same embeddings at every layer and step, as the ada embeddings only replace
+        # the placeholder tokens. Their embeddings are cached, and only the prompts with placeholders 
+        # are encoded with the ada embeddings of the current layer.
+        c_base = self.encode_base_prompts_cached([ c_in[i] for i in base_idx ])
+        if len(subj_idx) == 0:
+            return (c_base, em.get_ada_emb_weight())
+
+        # layer_infeat and time_emb are sliced to the prompts with placeholders, 
+        # as get_ada_embedding() matches the rows of the ada embeddings and the prompts.
+        subj_idx_t = torch.tensor(subj_idx, device=layer_infeat.device)
+        em.set_ada_layer_info(layer_idx, layer_infeat[subj_idx_t], time_emb[subj_idx_t])
+        c_subj = self.cond_stage_model.encode([ c_in[i] for i in subj_idx ], embedding_manager=em)
+        c = c_subj.new_empty((len(c_in),) + c_subj.shape[1:])
+        c[subj_idx_t] = c_subj
+        c[torch.tensor(base_idx, device=c.device)] = c_base.to(c.dtype)
+        return (c, em.get_ada_emb_weight())
+
+    # Indices of the prompts that contain (subj_idx) and don't contain (base_idx) any placeholder string.
+    # The test is on the lowercased strings, as the tokenizer lowercases the prompts. A false positive 
+    # (e.g. the placeholder is a substring of a word) only means the prompt is always encoded.
+    def split_prompts_by_placeholder(self, c_in):
+        if not isinstance(c_in, list) or not all(isinstance(prompt, str) for prompt in c_in):
+            return list(range(len(c_in))), []
+        placeholders = [ s.lower() for s in self.embedding_manager.string_to_token_dict ]
+        subj_idx, base_idx = [], []
+        for i, prompt in enumerate(c_in):
+            prompt = prompt.lower()
+            if any(s in prompt for s in placeholders):
+                subj_idx.append(i)
+            else:
+                base_idx.append(i)
+        return subj_idx, base_idx
+
+    # The embeddings of prompts without placeholders don't involve the embedding_manager.
+    # Only used when grad is disabled. Cached in _cond_cache as encode_prompts_cached(),
+    # keyed with the versions of the text encoder params, as only they affect the embeddings.
+    def encode_base_prompts_cached(self, prompts):
+        key = ('base', tuple(prompts), params_version_key(self.cond_stage_model.parameters()))
+        if key in self._cond_cache:
+            self._cond_cache.move_to_end(key)
+            return self._cond_cache[key].clone()
+
+        c = self.cond_stage_model.encode(prompts, embedding_manager=None)
+        self._cond_cache[key] = c.detach().clone()
+        if len(self._cond_cache) > self.cond_cache_size:
+            self._cond_cache.popitem(last=False)
+        return c
 
     def meshgrid(self, h, w):
-        y = torch.arange(0, h).view(h, 1, 1).repeat(1, w, 1)
-        x = torch.arange(0, w).view(1, w, 1).repeat(h, 1, 1)
+        # expand() views are enough, as cat() writes the [h, w, 2] grid anyway.
+        y = torch.arange(0, h).view(h, 1, 1).expand(-1, w, -1)
+        x = torch.arange(0, w).view(1, w, 1).expand(h, -1, -1)
 
         arr = torch.cat([y, x], dim=-1)
         return arr
@@ -677,18 +1119,25 @@ class LatentDiffusion(DDPM):
         :return: normalized distance to image border,
          wtith min distance = 0 at border and max dist = 0.5 at image center
         """
-        lower_right_corner = torch.tensor([h - 1, w - 1]).view(1, 1, 2)
-        arr = self.meshgrid(h, w) / lower_right_corner
-        dist_left_up = torch.min(arr, dim=-1, keepdims=True)[0]
-        dist_right_down = torch.min(1 - arr, dim=-1, keepdims=True)[0]
-        edge_dist = torch.min(torch.cat([dist_left_up, dist_right_down], dim=-1), dim=-1)[0]
+        if (h, w) in self._delta_border_cache:
+            return self._delta_border_cache[(h, w)]
+
+        # The distance to the border is separable: 
+        # min(y, 1 - y, x, 1 - x) = min(min(y, 1 - y), min(x, 1 - x)).
+        # So it's the outer min of two 1-D distances, without building an (h, w, 2) meshgrid.
+        y = torch.arange(0, h) / (h - 1)
+        x = torch.arange(0, w) / (w - 1)
+        edge_dist = torch.minimum(torch.minimum(y, 1 - y)[:, None], torch.minimum(x, 1 - x)[None, :])
+        self._delta_border_cache[(h, w)] = edge_dist
         return edge_dist
 
-    def get_weighting(self, h, w, Ly, Lx, device):
+    def get_weighting(self, h, w, Ly, Lx, device, dtype=None):
         weighting = self.delta_border(h, w)
         weighting = torch.clip(weighting, self.split_input_params["clip_min_weight"],
                                self.split_input_params["clip_max_weight"], )
-        weighting = weighting.view(1, h * w, 1).repeat(1, 1, Ly * Lx).to(device)
+        # Only the (h * w) and (Ly * Lx) factors are moved to device. 
+        # The full (1, h * w, Ly * Lx) weighting is built there in one op.
+        weighting = weighting.view(1, h * w, 1).to(device)
 
         if self.split_input_params["tie_braker"]:
             L_weighting = self.delta_border(Ly, Lx)
@@ -697,8 +1146,21 @@ class LatentDiffusion(DDPM):
                                      self.split_input_params["clip_max_tie_weight"])
 
             L_weighting = L_weighting.view(1, 1, Ly * Lx).to(device)
+            # The broadcasted product is the outer product, without repeat()-ing weighting first.
             weighting = weighting * L_weighting
-        return weighting
+        else:
+            weighting = weighting.expand(1, h * w, Ly * Lx).contiguous()
+        # Built in fp32 and cast once, so that the cached weighting already has the dtype of the crops.
+        return weighting.to(dtype) if dtype is not None else weighting
+
+    # nn.Fold / nn.Unfold hold no parameters or buffers, so one instance per set of params 
+    # is shared by all the dtype / device variants in _fold_cache, instead of being rebuilt for each.
+    # They are kept in a plain dict, so they don't show up in the module tree.
+    def get_fold_module(self, module_cls, **params):
+        key = (module_cls, repr(sorted(params.items())))
+        if key not in self._fold_modules:
+            self._fold_modules[key] = module_cls(**params)
+        return self._fold_modules[key]
 
     def get_fold_unfold(self, x, kernel_size, stride, uf=1, df=1):  # todo load once not every time, shorten code
         """
@@ -706,6 +1168,9 @@ class LatentDiffusion(DDPM):
         :return: n img crops of size (n, bs, c, kernel_size[0], kernel_size[1])
         """
         bs, nc, h, w = x.shape
+        cache_key = ((h, w), tuple(kernel_size), tuple(stride), uf, df, x.dtype, x.device)
+        if cache_key in self._fold_cache:
+            return self._fold_cache[cache_key]
 
         # number of crops in image
         Ly = (h - kernel_size[0]) // stride[0] + 1
@@ -713,45 +1178,73 @@ class LatentDiffusion(DDPM):
 
         if uf == 1 and df == 1:
             fold_params = dict(kernel_size=kernel_size, dilation=1, padding=0, stride=stride)
-            unfold = torch.nn.Unfold(**fold_params)
+            unfold = self.get_fold_module(torch.nn.Unfold, **fold_params)
 
-            fold = torch.nn.Fold(output_size=x.shape[2:], **fold_params)
+            fold = self.get_fold_module(torch.nn.Fold, output_size=tuple(x.shape[2:]), **fold_params)
 
-            weighting = self.get_weighting(kernel_size[0], kernel_size[1], Ly, Lx, x.device).to(x.dtype)
-            normalization = fold(weighting).view(1, 1, h, w)  # normalizes the overlap
+            weighting = self.get_weighting(kernel_size[0], kernel_size[1], Ly, Lx, x.device)
+            # The overlap normalization is summed up in fp32 and cast once, like the weighting.
+            normalization = fold(weighting).view(1, 1, h, w).to(x.dtype)  # normalizes the overlap
+            weighting = weighting.to(x.dtype)
             weighting = weighting.view((1, 1, kernel_size[0], kernel_size[1], Ly * Lx))
 
         elif uf > 1 and df == 1:
             fold_params = dict(kernel_size=kernel_size, dilation=1, padding=0, stride=stride)
-            unfold = torch.nn.Unfold(**fold_params)
+            unfold = self.get_fold_module(torch.nn.Unfold, **fold_params)
 
             fold_params2 = dict(kernel_size=(kernel_size[0] * uf, kernel_size[0] * uf),
                                 dilation=1, padding=0,
                                 stride=(stride[0] * uf, stride[1] * uf))
-            fold = torch.nn.Fold(output_size=(x.shape[2] * uf, x.shape[3] * uf), **fold_params2)
+            fold = self.get_fold_module(torch.nn.Fold, output_size=(x.shape[2] * uf, x.shape[3] * uf), **fold_params2)
 
-            weighting = self.get_weighting(kernel_size[0] * uf, kernel_size[1] * uf, Ly, Lx, x.device).to(x.dtype)
-            normalization = fold(weighting).view(1, 1, h * uf, w * uf)  # normalizes the overlap
+            weighting = self.get_weighting(kernel_size[0] * uf, kernel_size[1] * uf, Ly, Lx, x.device)
+            # The overlap normalization is summed up in fp32 and cast once, like the weighting.
+            normalization = fold(weighting).view(1, 1, h * uf, w * uf).to(x.dtype)  # normalizes the overlap
+            weighting = weighting.to(x.dtype)
             weighting = weighting.view((1, 1, kernel_size[0] * uf, kernel_size[1] * uf, Ly * Lx))
 
         elif df > 1 and uf == 1:
             fold_params = dict(kernel_size=kernel_size, dilation=1, padding=0, stride=stride)
-            unfold = torch.nn.Unfold(**fold_params)
+            unfold = self.get_fold_module(torch.nn.Unfold, **fold_params)
 
             fold_params2 = dict(kernel_size=(kernel_size[0] // df, kernel_size[0] // df),
                                 dilation=1, padding=0,
                                 stride=(stride[0] // df, stride[1] // df))
-            fold = torch.nn.Fold(output_size=(x.shape[2] // df, x.shape[3] // df), **fold_params2)
+            fold = self.get_fold_module(torch.nn.Fold, output_size=(x.shape[2] // df, x.shape[3] // df), **fold_params2)
 
-            weighting = self.get_weighting(kernel_size[0] // df, kernel_size[1] // df, Ly, Lx, x.device).to(x.dtype)
-            normalization = fold(weighting).view(1, 1, h // df, w // df)  # normalizes the overlap
+            weighting = self.get_weighting(kernel_size[0] // df, kernel_size[1] // df, Ly, Lx, x.device)
+            # The overlap normalization is summed up in fp32 and cast once, like the weighting.
+            normalization = fold(weighting).view(1, 1, h // df, w // df).to(x.dtype)  # normalizes the overlap
+            weighting = weighting.to(x.dtype)
             weighting = weighting.view((1, 1, kernel_size[0] // df, kernel_size[1] // df, Ly * Lx))
 
         else:
             raise NotImplementedError
 
+        self._fold_cache[cache_key] = (fold, unfold, normalization, weighting)
         return fold, unfold, normalization, weighting
 
+    # Whether x: (bs, c, h, w) fits into a single crop of split_input_params["ks"]. Then the patch-wise 
+    # encode/decode would (after reducing ks) fold/unfold a single crop for nothing, 
+    # so the callers encode/decode x directly. 
+    def fits_in_one_crop(self, x):
+        ks = self.split_input_params["ks"]
+        fits = ks[0] >= x.shape[-2] and ks[1] >= x.shape[-1]
+        if fits and not self._single_crop_notified:
+            print(f"Input of size {tuple(x.shape[-2:])} fits in one crop of size {tuple(ks)}. Patch-wise encoding/decoding is skipped")
+            self._single_crop_notified = True
+        return fits
+
+    # Stitch the crops o: (bn, nc, ks[0], ks[1], L) back into an image with the outputs of get_fold_unfold().
+    # o is a fresh tensor (stacked or decoded crops) owned by the caller, so it's weighted in place,
+    # and the folded image is normalized in place, instead of allocating two more full-size tensors. 
+    # Neither mul nor div by a constant needs its input for backward, so this is autograd-safe.
+    def stitch_crops(self, o, fold, normalization, weighting):
+        o = o.mul_(weighting)
+        # Reverse reshape to img shape
+        o = o.view((o.shape[0], -1, o.shape[-1]))  # (bn, nc * ks[0] * ks[1], L)
+        return fold(o).div_(normalization)  # norm is shape (1, 1, h, w)
+
     @torch.no_grad()
     def get_input(self, batch, k, return_first_stage_outputs=False, force_c_encode=False,
                   cond_key=None, return_original_cond=False, bs=None):
@@ -759,7 +1252,7 @@ class LatentDiffusion(DDPM):
         if bs is not None:
             x = x[:bs]
         x = x.to(self.device)
-        encoder_posterior = self.encode_first_stage(x)
+        encoder_posterior = self.encode_first_stage_cached(batch[k], x, bs)
         z = self.get_first_stage_encoding(encoder_posterior).detach()
 
         # conditioning_key: 'crossattn'.
@@ -813,6 +1306,54 @@ class LatentDiffusion(DDPM):
             out.append(xc)
         return out
 
+    # Decode the crops z: (bn, nc, ks[0], ks[1], *crop_dims) by folding the crop dims into the batch dim,
+    # instead of calling first_stage_model.decode() on each crop in a Python loop.
+    # crop_dims is (L,) or (Ly, Lx) (as returned by unfold_crops()). 
+    # At most max_crop_batch_size crops are decoded at once, to bound the peak memory.
+    # Returns the decoded crops of shape (bn, c, h, w, L).
+    def _decode_crops(self, z, force_not_quantize=False):
+        bn, nc, k0, k1 = z.shape[:4]
+        z = z.permute(0, *range(4, z.ndim), 1, 2, 3).reshape(-1, nc, k0, k1)
+        L = z.shape[0] // bn
+        if isinstance(self.first_stage_model, VQModelInterface):
+            decode = partial(self.first_stage_model.decode, force_not_quantize=force_not_quantize)
+        else:
+            decode = self.first_stage_model.decode
+
+        z_chunks = z.split(self.max_crop_batch_size)
+        if z.is_cuda and self.crop_decode_streams > 1 and len(z_chunks) > 1:
+            o_chunks = self._decode_chunks_on_streams(decode, z_chunks)
+        else:
+            o_chunks = [ decode(z_chunk) for z_chunk in z_chunks ]
+
+        o = torch.cat(o_chunks)
+        o = o.view(bn, L, *o.shape[1:])
+        return o.permute(0, 2, 3, 4, 1).contiguous()
+
+    # Decode z_chunks on crop_decode_streams rotating CUDA streams. Each side stream waits for 
+    # the current stream (which produced z_chunks), and the current stream waits for all side streams
+    # before the outputs are consumed. record_stream() keeps the caching allocator from reusing 
+    # a chunk's memory on one stream while the other stream may still access it.
+    def _decode_chunks_on_streams(self, decode, z_chunks):
+        cur_stream = torch.cuda.current_stream(z_chunks[0].device)
+        if self._crop_streams is None:
+            self._crop_streams = [ torch.cuda.Stream(device=z_chunks[0].device) 
+                                   for _ in range(self.crop_decode_streams) ]
+
+        o_chunks = []
+        for i, z_chunk in enumerate(z_chunks):
+            stream = self._crop_streams[i % len(self._crop_streams)]
+            stream.wait_stream(cur_stream)
+            with torch.cuda.stream(stream):
+                z_chunk.record_stream(stream)
+                o_chunks.append(decode(z_chunk))
+
+        for stream in self._crop_streams:
+            cur_stream.wait_stream(stream)
+        for o_chunk in o_chunks:
+            o_chunk.record_stream(cur_stream)
+        return o_chunks
+
     @torch.no_grad()
     def decode_first_stage(self, z, predict_cids=False, force_not_quantize=False):
         if predict_cids:
@@ -821,10 +1362,11 @@ class LatentDiffusion(DDPM):
             z = self.first_stage_model.quantize.get_codebook_entry(z, shape=None)
             z = rearrange(z, 'b h w c -> b c h w').contiguous()
 
-        z = 1. / self.scale_factor * z
+        # A single division; 1. / scale_factor * z launches two kernels when scale_factor is a buffer.
+        z = z / self.scale_factor
 
-        if hasattr(self, "split_input_params"):
-            if self.split_input_params["patch_distributed_vq"]:
+        if self.split_input_params is not None:
+            if self.split_input_params["patch_distributed_vq"] and not self.fits_in_one_crop(z):
                 ks = self.split_input_params["ks"]  # eg. (128, 128)
                 stride = self.split_input_params["stride"]  # eg. (64, 64)
                 uf = self.split_input_params["vqf"]
@@ -839,28 +1381,13 @@ class LatentDiffusion(DDPM):
 
                 fold, unfold, normalization, weighting = self.get_fold_unfold(z, ks, stride, uf=uf)
 
-                z = unfold(z)  # (bn, nc * prod(**ks), L)
-                # 1. Reshape to img shape
-                z = z.view((z.shape[0], -1, ks[0], ks[1], z.shape[-1]))  # (bn, nc, ks[0], ks[1], L )
-
-                # 2. apply model loop over last dim
-                if isinstance(self.first_stage_model, VQModelInterface):
-                    output_list = [self.first_stage_model.decode(z[:, :, :, :, i],
-                                                                 force_not_quantize=predict_cids or force_not_quantize)
-                                   for i in range(z.shape[-1])]
-                else:
-
-                    output_list = [self.first_stage_model.decode(z[:, :, :, :, i])
-                                   for i in range(z.shape[-1])]
+                # 1. Crops in img shape, as a strided view of z.
+                z = unfold_crops(z, ks, stride)  # (bn, nc, ks[0], ks[1], Ly, Lx)
 
-                o = torch.stack(output_list, axis=-1)  # # (bn, nc, ks[0], ks[1], L)
-                o = o * weighting
-                # Reverse 1. reshape to img shape
-                o = o.view((o.shape[0], -1, o.shape[-1]))  # (bn, nc * ks[0] * ks[1], L)
-                # stitch crops together
-                decoded = fold(o)
-                decoded = decoded / normalization  # norm is shape (1, 1, h, w)
-                return decoded
+                # 2. apply model on all the crops, batched along the crop dim
+                o = self._decode_crops(z, force_not_quantize=predict_cids or force_not_quantize)  # (bn, nc, ks[0], ks[1], L)
+                # 3. stitch crops together
+                return self.stitch_crops(o, fold, normalization, weighting)
             else:
                 if isinstance(self.first_stage_model, VQModelInterface):
                     return self.first_stage_model.decode(z, force_not_quantize=predict_cids or force_not_quantize)
@@ -881,10 +1408,11 @@ class LatentDiffusion(DDPM):
             z = self.first_stage_model.quantize.get_codebook_entry(z, shape=None)
             z = rearrange(z, 'b h w c -> b c h w').contiguous()
 
-        z = 1. / self.scale_factor * z
+        # A single division; 1. / scale_factor * z launches two kernels when scale_factor is a buffer.
+        z = z / self.scale_factor
 
-        if hasattr(self, "split_input_params"):
-            if self.split_input_params["patch_distributed_vq"]:
+        if self.split_input_params is not None:
+            if self.split_input_params["patch_distributed_vq"] and not self.fits_in_one_crop(z):
                 ks = self.split_input_params["ks"]  # eg. (128, 128)
                 stride = self.split_input_params["stride"]  # eg. (64, 64)
                 uf = self.split_input_params["vqf"]
@@ -899,28 +1427,13 @@ class LatentDiffusion(DDPM):
 
                 fold, unfold, normalization, weighting = self.get_fold_unfold(z, ks, stride, uf=uf)
 
-                z = unfold(z)  # (bn, nc * prod(**ks), L)
-                # 1. Reshape to img shape
-                z = z.view((z.shape[0], -1, ks[0], ks[1], z.shape[-1]))  # (bn, nc, ks[0], ks[1], L )
-
-                # 2. apply model loop over last dim
-                if isinstance(self.first_stage_model, VQModelInterface):  
-                    output_list = [self.first_stage_model.decode(z[:, :, :, :, i],
-                                                                 force_not_quantize=predict_cids or force_not_quantize)
-                                   for i in range(z.shape[-1])]
-                else:
+                # 1. Crops in img shape, as a strided view of z.
+                z = unfold_crops(z, ks, stride)  # (bn, nc, ks[0], ks[1], Ly, Lx)
 
-                    output_list = [self.first_stage_model.decode(z[:, :, :, :, i])
-                                   for i in range(z.shape[-1])]
-
-                o = torch.stack(output_list, axis=-1)  # # (bn, nc, ks[0], ks[1], L)
-                o = o * weighting
-                # Reverse 1. reshape to img shape
-                o = o.view((o.shape[0], -1, o.shape[-1]))  # (bn, nc * ks[0] * ks[1], L)
-                # stitch crops together
-                decoded = fold(o)
-                decoded = decoded / normalization  # norm is shape (1, 1, h, w)
-                return decoded
+                # 2. apply model on all the crops, batched along the crop dim
+                o = self._decode_crops(z, force_not_quantize=predict_cids or force_not_quantize)  # (bn, nc, ks[0], ks[1], L)
+                # 3. stitch crops together
+                return self.stitch_crops(o, fold, normalization, weighting)
             else:
                 if isinstance(self.first_stage_model, VQModelInterface):
                     return self.first_stage_model.decode(z, force_not_quantize=predict_cids or force_not_quantize)
@@ -933,14 +1446,34 @@ class LatentDiffusion(DDPM):
             else:
                 return self.first_stage_model.decode(z)
 
+    def encode_first_stage_cached(self, x_batch, x, bs=None):
+        """
+        encode_first_stage(x), reusing the posterior of the previous call on the same batch.
+        validation_step() runs shared_step() twice on the same batch (without and with EMA), 
+        and the EMA weights don't cover the frozen first stage model.
+        :param x_batch: the batch images, before get_input() moves them to the device. 
+                        The cache keeps a reference to it, so its id() isn't reused while cached,
+                        and in-place updates are detected by its _version.
+        :param x: the images on the device, which are encoded on a cache miss.
+        :param bs: the batch size get_input() truncates x_batch to.
+        The latents are still sampled from the posterior at every call.
+        The cache is cleared at the end of validation_step().
+        """
+        key = (id(x_batch), x_batch._version, bs)
+        cache = getattr(self, '_first_stage_cache', None)
+        if cache is None or cache[1] != key:
+            cache = self._first_stage_cache = (x_batch, key, self.encode_first_stage(x))
+        return cache[2]
+
     @torch.no_grad()
     def encode_first_stage(self, x):
-        if hasattr(self, "split_input_params"):
+        if self.split_input_params is not None:
             if self.split_input_params["patch_distributed_vq"]:
+                self.split_input_params['original_image_size'] = x.shape[-2:]
+            if self.split_input_params["patch_distributed_vq"] and not self.fits_in_one_crop(x):
                 ks = self.split_input_params["ks"]  # eg. (128, 128)
                 stride = self.split_input_params["stride"]  # eg. (64, 64)
                 df = self.split_input_params["vqf"]
-                self.split_input_params['original_image_size'] = x.shape[-2:]
                 bs, nc, h, w = x.shape
                 if ks[0] > h or ks[1] > w:
                     ks = (min(ks[0], h), min(ks[1], w))
@@ -951,28 +1484,25 @@ class LatentDiffusion(DDPM):
                     print("reducing stride")
 
                 fold, unfold, normalization, weighting = self.get_fold_unfold(x, ks, stride, df=df)
-                z = unfold(x)  # (bn, nc * prod(**ks), L)
-                # Reshape to img shape
-                z = z.view((z.shape[0], -1, ks[0], ks[1], z.shape[-1]))  # (bn, nc, ks[0], ks[1], L )
+                # Crops in img shape, as a strided view of x.
+                z = unfold_crops(x, ks, stride)  # (bn, nc, ks[0], ks[1], Ly, Lx)
 
-                output_list = [self.first_stage_model.encode(z[:, :, :, :, i])
-                               for i in range(z.shape[-1])]
+                output_list = [self.first_stage_model.encode(z_crop) for z_crop in crops_to_list(z)]
 
                 o = torch.stack(output_list, axis=-1)
-                o = o * weighting
-
-                # Reverse reshape to img shape
-                o = o.view((o.shape[0], -1, o.shape[-1]))  # (bn, nc * ks[0] * ks[1], L)
                 # stitch crops together
-                decoded = fold(o)
-                decoded = decoded / normalization
-                return decoded
+                return self.stitch_crops(o, fold, normalization, weighting)
 
             else:
                 return self.first_stage_model.encode(x)
         else:
             return self.first_stage_model.encode(x)
 
+    def validation_step(self, batch, batch_idx):
+        super().validation_step(batch, batch_idx)
+        # Don't keep the batch and its posterior alive after the validation step.
+        self._first_stage_cache = None
+
     # LatentDiffusion.shared_step() overloads DDPM.shared_step().
     # shared_step() is called in training_step() and (no_grad) validation_step().
     # batch: { 'caption':               ['an illustration of a dirty z',                    
@@ -988,12 +1518,8 @@ class LatentDiffusion(DDPM):
         # c = batch["caption"]
         x, c = self.get_input(batch, self.first_stage_key)
         if self.do_static_comp_delta_reg:
-            subj_prompt_comps = []
-            for prompt_comps in batch['subj_prompt_comp']:
-                subj_prompt_comps.append(prompt_comps.split("|"))
-            cls_prompt_comps = []
-            for prompt_comps in batch['cls_prompt_comp']:
-                cls_prompt_comps.append(prompt_comps.split("|"))
+            subj_prompt_comps = [ prompt_comps.split("|") for prompt_comps in batch['subj_prompt_comp'] ]
+            cls_prompt_comps  = [ prompt_comps.split("|") for prompt_comps in batch['cls_prompt_comp'] ]
             cls_prompt_single = batch['cls_prompt_single']
             REPEATS = len(subj_prompt_comps[0])
             if REPEATS == 1 or self.do_ada_comp_delta_reg:
@@ -1004,33 +1530,39 @@ class LatentDiffusion(DDPM):
                 cls_prompt_comp  = [ prompts[0] for prompts in cls_prompt_comps ]
                 composition_delta_prompts = (subj_prompt_comp, cls_prompt_single, cls_prompt_comp)
             else:
-                subj_prompt_comps2 = []
-                cls_prompt_comp2 = []
                 # Suppose R = num_composition_samples_per_batch.
                 # subj_prompt_comps, cls_prompt_comps are like [ (p1_1,..., p1_R), ..., (pB_1,..., pB_R) ].
                 # Interlace the list of composition prompt lists into one list:
                 # [ p1_1, p2_1, ..., pB_1, p1_2, p2_2, ..., pB_2, ..., p1_R, p2_R, ..., pB_R ].
                 # Interlacing makes it easy to choose the first B prompts (just as for a normal batch). 
                 # Do not simply concatenate along B.
-                for prompts in zip(*subj_prompt_comps):
-                    subj_prompt_comps2 += prompts
-                for prompts in zip(*cls_prompt_comps):
-                    cls_prompt_comp2 += prompts
-                subj_prompt_comps = subj_prompt_comps2
-                cls_prompt_comps  = cls_prompt_comp2
+                subj_prompt_comps = list(itertools.chain.from_iterable(zip(*subj_prompt_comps)))
+                cls_prompt_comps  = list(itertools.chain.from_iterable(zip(*cls_prompt_comps)))
                 c = c * REPEATS
                 cls_prompt_single = cls_prompt_single * REPEATS
                 composition_delta_prompts = (subj_prompt_comps, cls_prompt_single, cls_prompt_comps)
         else:
             composition_delta_prompts = None
 
-        if 'mask' in batch:
-            img_mask = batch['mask']
-            img_mask = img_mask.unsqueeze(1).to(x.device)
-            img_mask = F.interpolate(img_mask, size=x.shape[-2:], mode='nearest')
+        if 'mask_latent' in batch and batch['mask_latent'].shape[-2:] == x.shape[-2:]:
+            # Already resized to the latent resolution by the dataset.
+            img_mask = batch['mask_latent'].unsqueeze(1).to(x.device, non_blocking=True)
+        elif 'mask' in batch:
+            img_mask = batch['mask'].unsqueeze(1)
+            # Resized before being moved to the GPU. If the latent size divides the mask size, 
+            # it's a strided slice, and only the pixels at the latent resolution are uploaded.
+            img_mask = resize_mask_nearest(img_mask, x.shape[-2:])
+            img_mask = img_mask.to(x.device, non_blocking=True)
         else:
             img_mask = None
 
+        # An all-ones mask (the whole image is masked, e.g., when the image isn't scaled) 
+        # is the same as no mask. Drop it, so that the ada embeddings use the plain average pooling, 
+        # the loss is the plain MSE, and the embeddings of the base prompts can be cached.
+        # The check costs one small sync per step, which is much less than the masked ops it saves.
+        if img_mask is not None and bool(img_mask.eq(1).all()):
+            img_mask = None
+
         loss = self(x, c, composition_delta_prompts, img_mask=img_mask, **kwargs)
         return loss
 
@@ -1049,13 +1581,22 @@ class LatentDiffusion(DDPM):
                     N_INST   = len(x)
                     N_EMBEDS = N_INST * N_LAYERS
                     # c == subj_prompt_single.
-                    c_delta = c + subj_prompt_comps + cls_prompt_single + cls_prompt_comps
+                    if self.unfreeze_model:
+                        c_delta = c + subj_prompt_comps + cls_prompt_single + cls_prompt_comps
+                    else:
+                        # cls_prompt_single are taken from the cache, and inserted back below.
+                        c_delta = c + subj_prompt_comps + cls_prompt_comps
                     # c_delta_static is a tuple: (c, c_in, embedder).
                     # *_static means static embeddings.
                     c_delta_static = self.get_learned_conditioning(c_delta, img_mask=img_mask)
+                    if not self.unfreeze_model:
+                        c_delta_static = self.insert_cls_single_embeddings(c_delta_static, cls_prompt_single, 
+                                                                           len(c) + len(subj_prompt_comps))
                     if self.use_ada_embedding:
                         # c_real: [128, 77, 768]. 128 = 8 * 16. 
                         # 8 is the total number of prompts in c_delta. Each prompt is converted to 16 embeddings.
+                        # If cls_prompt_single are cached, c_in doesn't contain them. 
+                        # But only the leading (real c_in, subj_prompt_comps) part of c_in is used below.
                         c_real, c_in, embedder = c_delta_static
                         if self.do_ada_comp_delta_reg:
                             # Do ada composition delta loss in this iteration. 
@@ -1103,15 +1644,14 @@ class LatentDiffusion(DDPM):
         # self.model (UNetModel) is called in p_losses().
         return self.p_losses(x, c, t, img_mask=img_mask, *args, **kwargs)
 
+    # Rescale all the (x0, y0, w, h) bboxes into the crop in one vectorized pass.
     def _rescale_annotations(self, bboxes, crop_coordinates):  # TODO: move to dataset
-        def rescale_bbox(bbox):
-            x0 = clamp((bbox[0] - crop_coordinates[0]) / crop_coordinates[2])
-            y0 = clamp((bbox[1] - crop_coordinates[1]) / crop_coordinates[3])
-            w = min(bbox[2] / crop_coordinates[2], 1 - x0)
-            h = min(bbox[3] / crop_coordinates[3], 1 - y0)
-            return x0, y0, w, h
-
-        return [rescale_bbox(b) for b in bboxes]
+        bboxes = np.asarray(bboxes, dtype=np.float64).reshape(-1, 4)
+        crop_coordinates = np.asarray(crop_coordinates, dtype=np.float64)
+        # x0, y0, clamped to [0, 1].
+        xy = np.clip((bboxes[:, :2] - crop_coordinates[:2]) / crop_coordinates[2:4], 0., 1.)
+        wh = np.minimum(bboxes[:, 2:4] / crop_coordinates[2:4], 1 - xy)
+        return [ tuple(bbox) for bbox in np.concatenate([xy, wh], axis=1).tolist() ]
 
     # apply_model() is called both during training and inference.
     def apply_model(self, x_noisy, t, cond, return_ids=False):
@@ -1126,7 +1666,7 @@ class LatentDiffusion(DDPM):
             cond = {key: cond}
 
         # has split_input_params: False.
-        if hasattr(self, "split_input_params"):
+        if self.split_input_params is not None:
             assert len(cond) == 1  # todo can only deal with one conditioning atm
             assert not return_ids  
             ks = self.split_input_params["ks"]  # eg. (128, 128)
@@ -1136,10 +1676,9 @@ class LatentDiffusion(DDPM):
 
             fold, unfold, normalization, weighting = self.get_fold_unfold(x_noisy, ks, stride)
 
-            z = unfold(x_noisy)  # (bn, nc * prod(**ks), L)
-            # Reshape to img shape
-            z = z.view((z.shape[0], -1, ks[0], ks[1], z.shape[-1]))  # (bn, nc, ks[0], ks[1], L )
-            z_list = [z[:, :, :, :, i] for i in range(z.shape[-1])]
+            # Crops in img shape, as a strided view of x_noisy.
+            z = unfold_crops(x_noisy, ks, stride)  # (bn, nc, ks[0], ks[1], Ly, Lx)
+            z_list = crops_to_list(z)
 
             if self.cond_stage_key in ["image", "LR_image", "segmentation",
                                        'bbox_img'] and self.model.conditioning_key:  # todo check for completeness
@@ -1148,10 +1687,9 @@ class LatentDiffusion(DDPM):
                 assert (len(c) == 1)  # todo extend to list with more than one elem
                 c = c[0]  # get element
 
-                c = unfold(c)
-                c = c.view((c.shape[0], -1, ks[0], ks[1], c.shape[-1]))  # (bn, nc, ks[0], ks[1], L )
+                c = unfold_crops(c, ks, stride)  # (bn, nc, ks[0], ks[1], Ly, Lx)
 
-                cond_list = [{c_key: [c[:, :, :, :, i]]} for i in range(c.shape[-1])]
+                cond_list = [{c_key: [c_crop]} for c_crop in crops_to_list(c)]
 
             elif self.cond_stage_key == 'coordinates_bbox':
                 assert 'original_image_size' in self.split_input_params, 'BoudingBoxRescaling is missing original_image_size'
@@ -1168,7 +1706,7 @@ class LatentDiffusion(DDPM):
                 # need to rescale the tl patch coordinates to be in between (0,1)
                 tl_patch_coordinates = [(rescale_latent * stride[0] * (patch_nr % n_patches_per_row) / full_img_w,
                                          rescale_latent * stride[1] * (patch_nr // n_patches_per_row) / full_img_h)
-                                        for patch_nr in range(z.shape[-1])]
+                                        for patch_nr in range(len(z_list))]
 
                 # patch_limits are tl_coord, width and height coordinates as (x_tl, y_tl, h, w)
                 patch_limits = [(x_tl, y_tl,
@@ -1179,36 +1717,37 @@ class LatentDiffusion(DDPM):
                 # tokenize crop coordinates for the bounding boxes of the respective patches
                 patch_limits_tknzd = [torch.LongTensor(self.bbox_tokenizer._crop_encoder(bbox))[None].to(self.device)
                                       for bbox in patch_limits]  # list of length l with tensors of shape (1, 2)
-                print(patch_limits_tknzd[0].shape)
                 # cut tknzd crop position from conditioning
                 assert isinstance(cond, dict), 'cond must be dict to be fed into model'
                 cut_cond = cond['c_crossattn'][0][..., :-2].to(self.device)
-                print(cut_cond.shape)
 
-                adapted_cond = torch.stack([torch.cat([cut_cond, p], dim=1) for p in patch_limits_tknzd])
+                # Fill one preallocated (l, b, n) tensor with the shared cut_cond and the per-patch 
+                # crop tokens, instead of l separate cats followed by a stack.
+                L = len(patch_limits_tknzd)
+                adapted_cond = torch.empty((L, cut_cond.shape[0], cut_cond.shape[1] + 2), 
+                                           dtype=cut_cond.dtype, device=cut_cond.device)
+                adapted_cond[:, :, :-2] = cut_cond
+                adapted_cond[:, :, -2:] = torch.cat(patch_limits_tknzd, dim=0).unsqueeze(1)
                 adapted_cond = rearrange(adapted_cond, 'l b n -> (l b) n')
-                print(adapted_cond.shape)
                 adapted_cond = self.get_learned_conditioning(adapted_cond)
-                print(adapted_cond.shape)
-                adapted_cond = rearrange(adapted_cond, '(l b) n d -> l b n d', l=z.shape[-1])
-                print(adapted_cond.shape)
+                adapted_cond = rearrange(adapted_cond, '(l b) n d -> l b n d', l=len(z_list))
 
                 cond_list = [{'c_crossattn': [e]} for e in adapted_cond]
 
             else:
-                cond_list = [cond for i in range(z.shape[-1])]  # Todo make this more efficient
-
-            # apply model by loop over crops
-            output_list = [self.model(z_list[i], t, **cond_list[i]) for i in range(z.shape[-1])]
-            assert not isinstance(output_list[0],
-                                  tuple)  # todo cant deal with multiple model outputs check this never happens
-
-            o = torch.stack(output_list, axis=-1)
-            o = o * weighting
-            # Reverse reshape to img shape
-            o = o.view((o.shape[0], -1, o.shape[-1]))  # (bn, nc * ks[0] * ks[1], L)
+                cond_list = [cond for i in range(len(z_list))]  # Todo make this more efficient
+
+            # apply model by loop over crops.
+            # Each crop output is written into a preallocated o as soon as it's computed, 
+            # so that the L outputs and their stacked copy don't coexist in memory.
+            o_crop = self.model(z_list[0], t, **cond_list[0])
+            assert not isinstance(o_crop, tuple)  # todo cant deal with multiple model outputs check this never happens
+            o = torch.empty((*o_crop.shape, len(z_list)), dtype=o_crop.dtype, device=o_crop.device)
+            o[..., 0] = o_crop
+            for i in range(1, len(z_list)):
+                o[..., i] = self.model(z_list[i], t, **cond_list[i])
             # stitch crops together
-            x_recon = fold(o) / normalization
+            x_recon = self.stitch_crops(o, fold, normalization, weighting)
 
         else:
             # Only execute this sentence.
@@ -1222,7 +1761,7 @@ class LatentDiffusion(DDPM):
             return x_recon
 
     def _predict_eps_from_xstart(self, x_t, t, pred_xstart):
-        return (extract_into_tensor(self.sqrt_recip_alphas_cumprod, t, x_t.shape) * x_t - pred_xstart) / \
+        return torch.addcmul(-pred_xstart, extract_into_tensor(self.sqrt_recip_alphas_cumprod, t, x_t.shape), x_t) / \
                extract_into_tensor(self.sqrt_recipm1_alphas_cumprod, t, x_t.shape)
 
     def _prior_bpd(self, x_start):
@@ -1240,10 +1779,14 @@ class LatentDiffusion(DDPM):
         return mean_flat(kl_prior) / np.log(2.0)
 
     def p_losses(self, x_start, cond, t, noise=None, img_mask=None):
-        noise = default(noise, lambda: torch.randn_like(x_start))
+        noise = default(noise, lambda: self.randn_like_reused(x_start))
         x_noisy = self.q_sample(x_start=x_start, t=t, noise=noise)
         if self.use_ada_embedding and self.do_ada_comp_delta_reg:
-            x_noisy = x_noisy.repeat(2, 1, 1, 1)
+            # A real copy is kept on purpose: an expand() along the batch dim can only stay a view 
+            # when the batch size is 1, otherwise reshaping it to [2B, ...] copies anyway.
+            # The copy is one latent batch, and the UNet activations of the second half dominate.
+            # The doubled batch is written into a buffer reused across steps.
+            x_noisy = self.repeat2_reused(x_noisy)
             t       = t.repeat(2)
 
         model_output = self.apply_model(x_noisy, t, cond)
@@ -1265,15 +1808,15 @@ class LatentDiffusion(DDPM):
             raise NotImplementedError()
 
         # Only compute the loss on the masked region.
-        if img_mask is not None:
-            target       = target       * img_mask
-            model_output = model_output * img_mask
-
-        loss_simple = self.get_loss(model_output, target, mean=False).mean([1, 2, 3])
+        loss_simple = self.get_loss_per_sample(model_output, target, mask=img_mask)
         loss_dict.update({f'{prefix}/loss_simple': loss_simple.mean()})
 
-        logvar_t = self.logvar.to(self.device)[t]
-        loss = loss_simple / torch.exp(logvar_t) + logvar_t
+        if self.logvar_is_zero:
+            # loss_simple / exp(0) + 0. Skip the gather, exp, div and add.
+            loss = loss_simple
+        else:
+            logvar_t = self.logvar[t]
+            loss = loss_simple / torch.exp(logvar_t) + logvar_t
         # loss = loss_simple / torch.exp(self.logvar) + self.logvar
         if self.learn_logvar:
             loss_dict.update({f'{prefix}/loss_gamma': loss.mean()})
@@ -1281,10 +1824,11 @@ class LatentDiffusion(DDPM):
 
         loss = self.l_simple_weight * loss.mean()
 
-        loss_vlb = self.get_loss(model_output, target, mean=False).mean(dim=(1, 2, 3))
-        loss_vlb = (self.lvlb_weights[t] * loss_vlb).mean()
+        # The per-sample loss of the vlb term is the same as loss_simple. Reuse it.
+        loss_vlb = self.get_vlb_loss(loss_simple, t)
         loss_dict.update({f'{prefix}/loss_vlb': loss_vlb})
-        loss += (self.original_elbo_weight * loss_vlb)
+        if self.original_elbo_weight > 0:
+            loss += (self.original_elbo_weight * loss_vlb)
         loss_dict.update({f'{prefix}/loss': loss})
 
         if self.embedding_reg_weight > 0:
@@ -1303,18 +1847,22 @@ class LatentDiffusion(DDPM):
 
         return loss, loss_dict
 
-    def p_mean_variance(self, x, c, t, clip_denoised: bool, return_codebook_ids=False, quantize_denoised=False,
-                        return_x0=False, score_corrector=None, corrector_kwargs=None):
-        t_in = t
-        model_out = self.apply_model(x, t_in, c, return_ids=return_codebook_ids)
+    # cfg_cond: the concatenated (unconditional, conditional) conditioning of classifier-free guidance
+    # (see concat_cfg_conditioning()), or None. With cfg_cond, both branches are evaluated
+    # in one batched UNet call on the doubled batch, and c is not used.
+    def p_mean_variance(self, x, c, t, clip_denoised: bool, quantize_denoised=False,
+                        return_x0=False, score_corrector=None, corrector_kwargs=None,
+                        cfg_cond=None, unconditional_guidance_scale=1.):
+        if cfg_cond is None:
+            model_out = self.apply_model(x, t, c)
+        else:
+            model_out_uncond, model_out = self.apply_model(torch.cat([x] * 2), torch.cat([t] * 2), cfg_cond).chunk(2)
+            model_out = model_out_uncond + unconditional_guidance_scale * (model_out - model_out_uncond)
 
         if score_corrector is not None:
             assert self.parameterization == "eps"
             model_out = score_corrector.modify_score(self, model_out, x, t, c, **corrector_kwargs)
 
-        if return_codebook_ids:
-            model_out, logits = model_out
-
         if self.parameterization == "eps":
             x_recon = self.predict_start_from_noise(x, t=t, noise=model_out)
         elif self.parameterization == "x0":
@@ -1327,43 +1875,80 @@ class LatentDiffusion(DDPM):
         if quantize_denoised:
             x_recon, _, [_, _, indices] = self.first_stage_model.quantize(x_recon)
         model_mean, posterior_variance, posterior_log_variance = self.q_posterior(x_start=x_recon, x_t=x, t=t)
-        if return_codebook_ids:
-            return model_mean, posterior_variance, posterior_log_variance, logits
-        elif return_x0:
+        if return_x0:
             return model_mean, posterior_variance, posterior_log_variance, x_recon
         else:
             return model_mean, posterior_variance, posterior_log_variance
 
     @torch.no_grad()
     def p_sample(self, x, c, t, clip_denoised=False, repeat_noise=False,
-                 return_codebook_ids=False, quantize_denoised=False, return_x0=False,
-                 temperature=1., noise_dropout=0., score_corrector=None, corrector_kwargs=None):
+                 quantize_denoised=False, return_x0=False,
+                 temperature=1., noise_dropout=0., score_corrector=None, corrector_kwargs=None,
+                 noise_buf=None, add_noise=None, cfg_cond=None, unconditional_guidance_scale=1.):
         b, *_, device = *x.shape, x.device
         outputs = self.p_mean_variance(x=x, c=c, t=t, clip_denoised=clip_denoised,
-                                       return_codebook_ids=return_codebook_ids,
                                        quantize_denoised=quantize_denoised,
                                        return_x0=return_x0,
-                                       score_corrector=score_corrector, corrector_kwargs=corrector_kwargs)
-        if return_codebook_ids:
-            raise DeprecationWarning("Support dropped.")
-            model_mean, _, model_log_variance, logits = outputs
-        elif return_x0:
+                                       score_corrector=score_corrector, corrector_kwargs=corrector_kwargs,
+                                       cfg_cond=cfg_cond, unconditional_guidance_scale=unconditional_guidance_scale)
+        if return_x0:
             model_mean, _, model_log_variance, x0 = outputs
         else:
             model_mean, _, model_log_variance = outputs
 
-        noise = noise_like(x.shape, device, repeat_noise) * temperature
-        if noise_dropout > 0.:
-            noise = torch.nn.functional.dropout(noise, p=noise_dropout)
-        # no noise when t == 0
-        nonzero_mask = (1 - (t == 0).float()).reshape(b, *((1,) * (len(x.shape) - 1)))
+        # add_noise: whether t != 0 for the whole batch, if the caller knows it (as in p_sample_loop).
+        # Then we branch in Python instead of building the per-instance t == 0 mask on the GPU.
+        if add_noise is not None and not add_noise:
+            x_prev = model_mean
+        else:
+            if noise_buf is not None and not repeat_noise:
+                noise = noise_buf.normal_()
+            else:
+                noise = noise_like(x.shape, device, repeat_noise)
+            if noise_dropout > 0.:
+                noise = torch.nn.functional.dropout(noise, p=noise_dropout)
+            # The per-instance noise std: [b, 1, 1, 1]. The temperature is folded into it, 
+            # so that the full-size noise is only read once, by addcmul.
+            noise_std = (0.5 * model_log_variance).exp() * temperature
+            if add_noise is None:
+                # no noise when t == 0
+                nonzero_mask = (1 - (t == 0).float()).reshape(b, *((1,) * (len(x.shape) - 1)))
+                noise_std = nonzero_mask * noise_std
+            x_prev = torch.addcmul(model_mean, noise_std, noise)
 
-        if return_codebook_ids:
-            return model_mean + nonzero_mask * (0.5 * model_log_variance).exp() * noise, logits.argmax(dim=1)
         if return_x0:
-            return model_mean + nonzero_mask * (0.5 * model_log_variance).exp() * noise, x0
+            return x_prev, x0
         else:
-            return model_mean + nonzero_mask * (0.5 * model_log_variance).exp() * noise
+            return x_prev
+
+    # A host buffer for the n_logs intermediate latents (of x's shape) logged by a sampling loop.
+    # The intermediates are copied into it asynchronously, so that the GPU only holds the working 
+    # latents during long sampling runs. Pinned, so that the device-to-host copies can overlap.
+    def alloc_intermediates_buf(self, n_logs, x):
+        return torch.empty((n_logs, *x.shape), dtype=x.dtype, pin_memory=x.is_cuda)
+
+    # Wait for the pending copies into an intermediates buffer, and return it as a list of latents.
+    def intermediates_buf_to_list(self, buf):
+        if torch.cuda.is_available() and self.device.type == 'cuda':
+            torch.cuda.current_stream(self.device).synchronize()
+        return list(buf)
+
+    # Slice cond (a tensor, a list of tensors, or a dict of them) to its first batch_size instances.
+    # Returns cond itself if it's already within batch_size, instead of rebuilding the containers.
+    @staticmethod
+    def slice_cond(cond, batch_size):
+        if cond is None:
+            return cond
+        if isinstance(cond, dict):
+            if all(not isinstance(v, list) and len(v) <= batch_size for v in cond.values()):
+                return cond
+            return {key: cond[key][:batch_size] if not isinstance(cond[key], list) else
+                    list(map(lambda x: x[:batch_size], cond[key])) for key in cond}
+        if isinstance(cond, list):
+            return [c[:batch_size] for c in cond]
+        if len(cond) <= batch_size:
+            return cond
+        return cond[:batch_size]
 
     @torch.no_grad()
     def progressive_denoising(self, cond, shape, verbose=True, callback=None, quantize_denoised=False,
@@ -1379,16 +1964,12 @@ class LatentDiffusion(DDPM):
         else:
             b = batch_size = shape[0]
         if x_T is None:
-            img = torch.randn(shape, device=self.device)
+            img = self.randn_reused(shape, self.device)
         else:
             img = x_T
-        intermediates = []
-        if cond is not None:
-            if isinstance(cond, dict):
-                cond = {key: cond[key][:batch_size] if not isinstance(cond[key], list) else
-                list(map(lambda x: x[:batch_size], cond[key])) for key in cond}
-            else:
-                cond = [c[:batch_size] for c in cond] if isinstance(cond, list) else cond[:batch_size]
+        # channels_last, for the UNet convs. See LatentDiffusion.__init__().
+        img = img.to(memory_format=torch.channels_last)
+        cond = self.slice_cond(cond, batch_size)
 
         if start_T is not None:
             timesteps = min(timesteps, start_T)
@@ -1397,9 +1978,18 @@ class LatentDiffusion(DDPM):
             range(0, timesteps))
         if type(temperature) == float:
             temperature = [temperature] * timesteps
+        n_logs = sum(1 for i in range(timesteps) if i % log_every_t == 0 or i == timesteps - 1)
+        intermediates = self.alloc_intermediates_buf(n_logs, img)
+        n_logged = 0
+        noise_buf = torch.empty_like(img)
+        # Timestep tensor is allocated once and refilled in place at each step.
+        ts = torch.empty((b,), device=self.device, dtype=torch.long)
+        if mask is not None:
+            # torch.lerp() requires the weight to have the dtype of img.
+            mask = mask.to(img.dtype)
 
         for i in iterator:
-            ts = torch.full((b,), i, device=self.device, dtype=torch.long)
+            ts.fill_(i)
             if self.shorten_cond_schedule:
                 assert self.model.conditioning_key != 'hybrid'
                 tc = self.cond_ids[ts].to(cond.device)
@@ -1409,48 +1999,70 @@ class LatentDiffusion(DDPM):
                                             clip_denoised=self.clip_denoised,
                                             quantize_denoised=quantize_denoised, return_x0=True,
                                             temperature=temperature[i], noise_dropout=noise_dropout,
-                                            score_corrector=score_corrector, corrector_kwargs=corrector_kwargs)
+                                            score_corrector=score_corrector, corrector_kwargs=corrector_kwargs,
+                                            noise_buf=noise_buf, add_noise=(i > 0))
             if mask is not None:
                 assert x0 is not None
                 img_orig = self.q_sample(x0, ts)
-                img = img_orig * mask + (1. - mask) * img
+                # img_orig * mask + (1 - mask) * img in one kernel.
+                img = torch.lerp(img, img_orig, mask)
 
             if i % log_every_t == 0 or i == timesteps - 1:
-                intermediates.append(x0_partial)
+                intermediates[n_logged].copy_(x0_partial, non_blocking=True)
+                n_logged += 1
             if callback: callback(i)
             if img_callback: img_callback(img, i)
-        return img, intermediates
+        return img, self.intermediates_buf_to_list(intermediates)
 
     @torch.no_grad()
     def p_sample_loop(self, cond, shape, return_intermediates=False,
                       x_T=None, verbose=True, callback=None, timesteps=None, quantize_denoised=False,
                       mask=None, x0=None, img_callback=None, start_T=None,
-                      log_every_t=None):
+                      log_every_t=None, unconditional_guidance_scale=1., unconditional_conditioning=None):
 
         if not log_every_t:
             log_every_t = self.log_every_t
         device = self.betas.device
         b = shape[0]
+        # Classifier-free guidance. The (unconditional, conditional) conditioning is concatenated
+        # once for the whole loop.
+        if unconditional_conditioning is not None and unconditional_guidance_scale != 1.:
+            assert not self.shorten_cond_schedule, 'classifier-free guidance is not supported with shorten_cond_schedule'
+            cfg_cond = concat_cfg_conditioning(cond, unconditional_conditioning)
+        else:
+            cfg_cond = None
         if x_T is None:
-            img = torch.randn(shape, device=device)
+            img = self.randn_reused(shape, device)
         else:
             img = x_T
+        img = img.to(memory_format=torch.channels_last)
 
-        intermediates = [img]
         if timesteps is None:
             timesteps = self.num_timesteps
 
         if start_T is not None:
             timesteps = min(timesteps, start_T)
+
+        # The intermediates are only logged if they are returned.
+        if return_intermediates:
+            n_logs = 1 + sum(1 for i in range(timesteps) if i % log_every_t == 0 or i == timesteps - 1)
+            intermediates = self.alloc_intermediates_buf(n_logs, img)
+            intermediates[0].copy_(img, non_blocking=True)
+            n_logged = 1
         iterator = tqdm(reversed(range(0, timesteps)), desc='Sampling t', total=timesteps) if verbose else reversed(
             range(0, timesteps))
 
         if mask is not None:
             assert x0 is not None
             assert x0.shape[2:3] == mask.shape[2:3]  # spatial size has to match
+            # torch.lerp() requires the weight to have the dtype of img.
+            mask = mask.to(img.dtype)
+        noise_buf = torch.empty_like(img)
+        # Timestep tensor is allocated once and refilled in place at each step.
+        ts = torch.empty((b,), device=device, dtype=torch.long)
 
         for i in iterator:
-            ts = torch.full((b,), i, device=device, dtype=torch.long)
+            ts.fill_(i)
             if self.shorten_cond_schedule:
                 assert self.model.conditioning_key != 'hybrid'
                 tc = self.cond_ids[ts].to(cond.device)
@@ -1458,37 +2070,47 @@ class LatentDiffusion(DDPM):
 
             img = self.p_sample(img, cond, ts,
                                 clip_denoised=self.clip_denoised,
-                                quantize_denoised=quantize_denoised)
+                                quantize_denoised=quantize_denoised, noise_buf=noise_buf,
+                                add_noise=(i > 0), cfg_cond=cfg_cond,
+                                unconditional_guidance_scale=unconditional_guidance_scale)
             if mask is not None:
                 img_orig = self.q_sample(x0, ts)
-                img = img_orig * mask + (1. - mask) * img
+                # img_orig * mask + (1 - mask) * img in one kernel.
+                img = torch.lerp(img, img_orig, mask)
 
-            if i % log_every_t == 0 or i == timesteps - 1:
-                intermediates.append(img)
+            if return_intermediates and (i % log_every_t == 0 or i == timesteps - 1):
+                intermediates[n_logged].copy_(img, non_blocking=True)
+                n_logged += 1
             if callback: callback(i)
             if img_callback: img_callback(img, i)
 
         if return_intermediates:
-            return img, intermediates
+            return img, self.intermediates_buf_to_list(intermediates)
         return img
 
     @torch.no_grad()
     def sample(self, cond, batch_size=16, return_intermediates=False, x_T=None,
                verbose=True, timesteps=None, quantize_denoised=False,
-               mask=None, x0=None, shape=None,**kwargs):
+               mask=None, x0=None, shape=None, unconditional_guidance_scale=1.,
+               unconditional_conditioning=None, **kwargs):
         if shape is None:
             shape = (batch_size, self.channels, self.image_size, self.image_size)
-        if cond is not None:
-            if isinstance(cond, dict):
-                cond = {key: cond[key][:batch_size] if not isinstance(cond[key], list) else
-                list(map(lambda x: x[:batch_size], cond[key])) for key in cond}
-            else:
-                cond = [c[:batch_size] for c in cond] if isinstance(cond, list) else cond[:batch_size]
-        return self.p_sample_loop(cond,
-                                  shape,
-                                  return_intermediates=return_intermediates, x_T=x_T,
-                                  verbose=verbose, timesteps=timesteps, quantize_denoised=quantize_denoised,
-                                  mask=mask, x0=x0)
+        cond = self.slice_cond(cond, batch_size)
+        if unconditional_conditioning is not None:
+            unconditional_conditioning = self.slice_cond(unconditional_conditioning, batch_size)
+        with self.sample_autocast():
+            return self.p_sample_loop(cond,
+                                      shape,
+                                      return_intermediates=return_intermediates, x_T=x_T,
+                                      verbose=verbose, timesteps=timesteps, quantize_denoised=quantize_denoised,
+                                      mask=mask, x0=x0, unconditional_guidance_scale=unconditional_guidance_scale,
+                                      unconditional_conditioning=unconditional_conditioning)
+
+    # The autocast context of the sampling loops. A no-op unless sample_autocast_dtype is set.
+    # The schedule math on the latents promotes back to fp32, so the sampled latents stay in fp32.
+    def sample_autocast(self):
+        return torch.autocast(self.device.type, dtype=self.sample_autocast_dtype or torch.bfloat16,
+                              enabled=self.sample_autocast_dtype is not None)
 
     @torch.no_grad()
     def sample_log(self, cond, batch_size, ddim, ddim_steps,**kwargs):
@@ -1496,8 +2118,9 @@ class LatentDiffusion(DDPM):
         if ddim:
             ddim_sampler = DDIMSampler(self)
             shape = (self.channels, self.image_size, self.image_size)
-            samples, intermediates = ddim_sampler.sample(ddim_steps, batch_size,
-                                                         shape, cond, verbose=False, **kwargs)
+            with self.sample_autocast():
+                samples, intermediates = ddim_sampler.sample(ddim_steps, batch_size,
+                                                             shape, cond, verbose=False, **kwargs)
 
         else:
             samples, intermediates = self.sample(cond=cond, batch_size=batch_size,
@@ -1539,34 +2162,28 @@ class LatentDiffusion(DDPM):
 
         if plot_diffusion_rows:
             # get diffusion row
-            diffusion_row = list()
+            # All the logged timesteps are noised in one q_sample_diffusion_row() call, 
+            # and decoded together, instead of one q_sample() and one decode per timestep.
+            # The decoding runs on a side stream, overlapping with the sampling below. 
+            # The grid is built at the end.
             z_start = z[:n_row]
-            for t in range(self.num_timesteps):
-                if t % self.log_every_t == 0 or t == self.num_timesteps - 1:
-                    t = repeat(torch.tensor([t]), '1 -> b', b=n_row)
-                    t = t.to(self.device).long()
-                    noise = torch.randn_like(z_start)
-                    z_noisy = self.q_sample(x_start=z_start, t=t, noise=noise)
-                    diffusion_row.append(self.decode_first_stage(z_noisy))
-
-            diffusion_row = torch.stack(diffusion_row)  # n_log_step, n_row, C, H, W
-            diffusion_grid = rearrange(diffusion_row, 'n b c h w -> b n c h w')
-            diffusion_grid = rearrange(diffusion_grid, 'b n c h w -> (b n) c h w')
-            diffusion_grid = make_grid(diffusion_grid, nrow=diffusion_row.shape[0])
-            log["diffusion_row"] = diffusion_grid
+            diffusion_row = self.decode_first_stage_batched_async(self.q_sample_diffusion_row(z_start))
 
         if sample:
+            # The sampled latents of each log key. They are decoded together at the end.
+            latents_to_decode = {}
             # get denoise row
             with self.ema_scope("Plotting"):
                 samples, z_denoise_row = self.sample_log(cond=c, batch_size=N, ddim=use_ddim,
                                                          ddim_steps=ddim_steps, eta=ddim_eta)
                 # samples, z_denoise_row = self.sample(cond=c, batch_size=N, return_intermediates=True)
-            x_samples = self.decode_first_stage(samples)
-            log["samples"] = x_samples
+            latents_to_decode["samples"] = samples
             if plot_denoise_rows:
                 denoise_grid = self._get_denoise_row_from_list(z_denoise_row)
                 log["denoise_row"] = denoise_grid
             
+            # Both DDIMSampler and p_sample_loop() evaluate the unconditional and conditional branches 
+            # of classifier-free guidance in one batched UNet call per step.
             uc = self.get_learned_conditioning(N * [""])
             sample_scaled, _ = self.sample_log(cond=c, 
                                                batch_size=N, 
@@ -1575,7 +2192,7 @@ class LatentDiffusion(DDPM):
                                                eta=ddim_eta,                                                 
                                                unconditional_guidance_scale=5.0,
                                                unconditional_conditioning=uc)
-            log["samples_scaled"] = self.decode_first_stage(sample_scaled)
+            latents_to_decode["samples_scaled"] = sample_scaled
 
             if quantize_denoised and not isinstance(self.first_stage_model, AutoencoderKL) and not isinstance(
                     self.first_stage_model, IdentityFirstStage):
@@ -1586,39 +2203,57 @@ class LatentDiffusion(DDPM):
                                                              quantize_denoised=True)
                     # samples, z_denoise_row = self.sample(cond=c, batch_size=N, return_intermediates=True,
                     #                                      quantize_denoised=True)
-                x_samples = self.decode_first_stage(samples.to(self.device))
-                log["samples_x0_quantized"] = x_samples
+                latents_to_decode["samples_x0_quantized"] = samples
 
             if inpaint:
                 # make a simple center square
                 b, h, w = z.shape[0], z.shape[2], z.shape[3]
-                mask = torch.ones(N, h, w).to(self.device)
+                # Allocated on the device directly, instead of on the host and then copied.
+                mask = torch.ones(N, h, w, device=self.device)
                 # zeros will be filled in
                 mask[:, h // 4:3 * h // 4, w // 4:3 * w // 4] = 0.
                 mask = mask[:, None, ...]
-                with self.ema_scope("Plotting Inpaint"):
-
-                    samples, _ = self.sample_log(cond=c,batch_size=N,ddim=use_ddim, eta=ddim_eta,
-                                                ddim_steps=ddim_steps, x0=z[:N], mask=mask)
-                x_samples = self.decode_first_stage(samples.to(self.device))
-                log["samples_inpainting"] = x_samples
+                # Inpainting (the center square is filled in) and outpainting (the border is filled in, 
+                # with the inverted mask) are sampled in one sampling loop on the doubled batch,
+                # instead of two loops of batch size N.
+                # concat_cfg_conditioning(c, c) concatenates the conditioning of the two halves.
+                with self.ema_scope("Plotting Inpaint / Outpaint"):
+                    samples, _ = self.sample_log(cond=concat_cfg_conditioning(c, c), batch_size=2 * N, 
+                                                 ddim=use_ddim, eta=ddim_eta, ddim_steps=ddim_steps, 
+                                                 x0=torch.cat([z[:N]] * 2), mask=torch.cat([mask, 1. - mask]))
+                latents_to_decode["samples_inpainting"], latents_to_decode["samples_outpainting"] = samples.chunk(2)
                 log["mask"] = mask
 
-                # outpaint
-                with self.ema_scope("Plotting Outpaint"):
-                    samples, _ = self.sample_log(cond=c, batch_size=N, ddim=use_ddim,eta=ddim_eta,
-                                                ddim_steps=ddim_steps, x0=z[:N], mask=mask)
-                x_samples = self.decode_first_stage(samples.to(self.device))
-                log["samples_outpainting"] = x_samples
+            # Decoded on a side stream, overlapping with the progressive sampling below.
+            x_samples = self.decode_first_stage_batched_async(list(latents_to_decode.values()))
 
         if plot_progressive_rows:
-            with self.ema_scope("Plotting Progressives"):
-                img, progressives = self.progressive_denoising(c,
-                                                               shape=(self.channels, self.image_size, self.image_size),
-                                                               batch_size=N)
+            with self.ema_scope("Plotting Progressives"), self.sample_autocast():
+                if use_ddim:
+                    # The x0 predictions along a DDIM run of ddim_steps steps, instead of a full 
+                    # num_timesteps DDPM run. Logged at about as many steps as progressive_denoising().
+                    # pred_x0[0] is the initial noise, not a prediction.
+                    n_logs = max(1, self.num_timesteps // self.log_every_t)
+                    _, intermediates = self.sample_log(cond=c, batch_size=N, ddim=True, ddim_steps=ddim_steps, 
+                                                       eta=ddim_eta, log_every_t=max(1, ddim_steps // n_logs))
+                    progressives = intermediates['pred_x0'][1:]
+                else:
+                    img, progressives = self.progressive_denoising(c,
+                                                                   shape=(self.channels, self.image_size, self.image_size),
+                                                                   batch_size=N)
             prog_row = self._get_denoise_row_from_list(progressives, desc="Progressive Generation")
             log["progressive_row"] = prog_row
 
+        self.wait_side_decodes()
+        if plot_diffusion_rows:
+            diffusion_row = torch.stack(diffusion_row)  # n_log_step, n_row, C, H, W
+            diffusion_grid = rearrange(diffusion_row, 'n b c h w -> b n c h w')
+            diffusion_grid = rearrange(diffusion_grid, 'b n c h w -> (b n) c h w')
+            diffusion_grid = make_grid(diffusion_grid, nrow=diffusion_row.shape[0])
+            log["diffusion_row"] = diffusion_grid
+        if sample:
+            log.update(zip(latents_to_decode.keys(), x_samples))
+
         if return_keys:
             if np.intersect1d(list(log.keys()), return_keys).shape[0] == 0:
                 return log
@@ -1644,10 +2279,10 @@ class LatentDiffusion(DDPM):
             # Are we allowing the base model to train? If so, set two different parameter groups.
             if self.unfreeze_model: 
                 model_params = list(self.cond_stage_model.parameters()) + list(self.model.parameters())
-                opt = torch.optim.AdamW([{"params": embedding_params, "lr": lr}, {"params": model_params}], lr=self.model_lr)
+                opt = make_adamw([{"params": embedding_params, "lr": lr}, {"params": model_params}], lr=self.model_lr)
             # Otherwise, train only embedding
             else:
-                opt = torch.optim.AdamW(embedding_params, lr=lr, weight_decay=weight_decay)
+                opt = make_adamw(embedding_params, lr=lr, weight_decay=weight_decay)
         else:
             params = list(self.model.parameters())
             if self.cond_stage_trainable:
@@ -1657,7 +2292,7 @@ class LatentDiffusion(DDPM):
                 print('Diffusion model optimizing logvar')
                 params.append(self.logvar)
 
-            opt = torch.optim.AdamW(params, lr=lr, weight_decay=weight_decay)
+            opt = make_adamw(params, lr=lr, weight_decay=weight_decay)
 
         if self.use_scheduler:
             assert 'target' in self.scheduler_config
@@ -1691,7 +2326,7 @@ class LatentDiffusion(DDPM):
 
         lr = self.learning_rate
         params = list(self.embedding_manager.embedding_parameters())
-        opt = torch.optim.AdamW(params, lr=lr)
+        opt = make_adamw(params, lr=lr)
         return opt
 
     # configure_opt_model() is never called.
@@ -1707,7 +2342,7 @@ class LatentDiffusion(DDPM):
 
         model_params = list(self.cond_stage_model.parameters()) + list(self.model.parameters())
         embedding_params = list(self.embedding_manager.embedding_parameters())
-        return torch.optim.AdamW([{"params": embedding_params, "lr": self.learning_rate}, {"params": model_params}], lr=self.model_lr)
+        return make_adamw([{"params": embedding_params, "lr": self.learning_rate}, {"params": model_params}], lr=self.model_lr)
 
     @torch.no_grad()
     def to_rgb(self, x):
@@ -1715,7 +2350,7 @@ class LatentDiffusion(DDPM):
         if not hasattr(self, "colorize"):
             self.colorize = torch.randn(3, x.shape[1], 1, 1).to(x)
         x = nn.functional.conv2d(x, weight=self.colorize)
-        x = 2. * (x - x.min()) / (x.max() - x.min()) - 1.
+        x = rescale_to_pm1(x)
         return x
 
     @rank_zero_only
@@ -1732,47 +2367,65 @@ class LatentDiffusion(DDPM):
 
 class DiffusionWrapper(pl.LightningModule):
     def __init__(self, diff_model_config, conditioning_key, 
-                 use_layerwise_embedding=False, use_ada_embedding=False):
+                 use_layerwise_embedding=False, use_ada_embedding=False, compile_unet=False):
         super().__init__()
         # diffusion_model: UNetModel
         self.diffusion_model = instantiate_from_config(diff_model_config)
+        # compile_unet: compile the UNet forward with torch.compile (PyTorch >= 2.0).
+        # Set in the DDPM / LatentDiffusion config, so it covers both training and all the sampling loops.
+        # The bound forward is replaced rather than the module itself, so that the state_dict keys 
+        # don't get the '_orig_mod.' prefix of an OptimizedModule, and checkpoints stay compatible.
+        # The default mode (not 'reduce-overhead'), as the UNet outputs are kept across calls 
+        # (the loss in training, the crop outputs in the split path). The graph breaks at 
+        # the ada embedding callback of the cross-attention conditioning, so fullgraph is not requested.
+        if compile_unet and hasattr(torch, 'compile'):
+            self.diffusion_model.forward = torch.compile(self.diffusion_model.forward)
         self.conditioning_key = conditioning_key
         assert self.conditioning_key in [None, 'concat', 'crossattn', 'hybrid', 'adm']
         self.use_layerwise_embedding = use_layerwise_embedding
         self.use_ada_embedding       = use_ada_embedding
+        # The forward implementation of conditioning_key, bound once here. 
+        # So each UNet call is a straight-line call, instead of going through the conditioning_key branches.
+        self._forward_impl = getattr(self, self._forward_impls[self.conditioning_key])
 
     # t: a 1-D batch of timesteps (during training: randomly sample one timestep for each instance).
     def forward(self, x, t, c_concat: list = None, c_crossattn: list = None):
-        if self.conditioning_key is None:
-            out = self.diffusion_model(x, t)
-        elif self.conditioning_key == 'concat':
-            xc = torch.cat([x] + c_concat, dim=1)
-            out = self.diffusion_model(xc, t)
-        elif self.conditioning_key == 'crossattn':
-            # For textual inversion, there's usually only one element tensor in c_crossattn.
-            # So we take c_crossattn[0] directly, instead of torch.cat() on a list of tensors.
-            if isinstance(c_crossattn[0], tuple):
-                cc, c_in, embedder = c_crossattn[0]
-            else:
-                cc       = c_crossattn[0]
-                c_in     = None
-                embedder = None
-            # cc = torch.cat(c_crossattn, 1)
-            # self.diffusion_model: UNetModel.
-            out = self.diffusion_model(x, t, context=cc, context_in=c_in, embedder=embedder,
-                                       use_layerwise_context=self.use_layerwise_embedding,
-                                       use_ada_context=self.use_ada_embedding)
-        elif self.conditioning_key == 'hybrid':
-            xc = torch.cat([x] + c_concat, dim=1)
-            cc = torch.cat(c_crossattn, 1)
-            out = self.diffusion_model(xc, t, context=cc)
-        elif self.conditioning_key == 'adm':
-            cc = c_crossattn[0]
-            out = self.diffusion_model(x, t, y=cc)
-        else:
-            raise NotImplementedError()
+        return self._forward_impl(x, t, c_concat, c_crossattn)
 
-        return out
+    def _forward_uncond(self, x, t, c_concat, c_crossattn):
+        return self.diffusion_model(x, t)
+
+    def _forward_concat(self, x, t, c_concat, c_crossattn):
+        xc = torch.cat([x] + c_concat, dim=1)
+        return self.diffusion_model(xc, t)
+
+    def _forward_crossattn(self, x, t, c_concat, c_crossattn):
+        # For textual inversion, there's usually only one element tensor in c_crossattn.
+        # So we take c_crossattn[0] directly, instead of torch.cat() on a list of tensors.
+        if isinstance(c_crossattn[0], tuple):
+            cc, c_in, embedder = c_crossattn[0]
+        else:
+            cc       = c_crossattn[0]
+            c_in     = None
+            embedder = None
+        # cc = torch.cat(c_crossattn, 1)
+        # self.diffusion_model: UNetModel.
+        return self.diffusion_model(x, t, context=cc, context_in=c_in, embedder=embedder,
+                                    use_layerwise_context=self.use_layerwise_embedding,
+                                    use_ada_context=self.use_ada_embedding)
+
+    def _forward_hybrid(self, x, t, c_concat, c_crossattn):
+        xc = torch.cat([x] + c_concat, dim=1)
+        cc = torch.cat(c_crossattn, 1)
+        return self.diffusion_model(xc, t, context=cc)
+
+    def _forward_adm(self, x, t, c_concat, c_crossattn):
+        cc = c_crossattn[0]
+        return self.diffusion_model(x, t, y=cc)
+
+    # conditioning_key -> the name of its forward implementation.
+    _forward_impls = { None: '_forward_uncond', 'concat': '_forward_concat', 'crossattn': '_forward_crossattn',
+                       'hybrid': '_forward_hybrid', 'adm': '_forward_adm' }
 
 
 class Layout2ImgDiffusion(LatentDiffusion):
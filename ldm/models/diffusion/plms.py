@@ -5,7 +5,8 @@ import numpy as np
 from tqdm import tqdm
 from functools import partial
 
-from ldm.modules.diffusionmodules.util import make_ddim_sampling_parameters, make_ddim_timesteps, noise_like
+from ldm.modules.diffusionmodules.util import make_ddim_sampling_parameters, make_ddim_timesteps, \
+    get_cfg_conditioning, get_cfg_x_in
 
 
 class PLMSSampler(object):
@@ -128,6 +129,8 @@ class PLMSSampler(object):
             img = torch.randn(shape, device=device)
         else:
             img = x_T
+        # channels_last, for the UNet convs. See LatentDiffusion.__init__().
+        img = img.to(memory_format=torch.channels_last)
 
         if timesteps is None:
             timesteps = self.ddpm_num_timesteps if ddim_use_original_steps else self.ddim_timesteps
@@ -142,16 +145,23 @@ class PLMSSampler(object):
 
         iterator = tqdm(time_range, desc='PLMS Sampler', total=total_steps)
         old_eps = []
+        # Timestep tensors are allocated once and refilled in place at each step.
+        ts      = torch.empty((b,), device=device, dtype=torch.long)
+        ts_next = torch.empty((b,), device=device, dtype=torch.long)
+        if mask is not None:
+            # torch.lerp() requires the weight to have the dtype of img.
+            mask = mask.to(img.dtype)
 
         for i, step in enumerate(iterator):
             index = total_steps - i - 1
-            ts = torch.full((b,), step, device=device, dtype=torch.long)
-            ts_next = torch.full((b,), time_range[min(i + 1, len(time_range) - 1)], device=device, dtype=torch.long)
+            ts.fill_(int(step))
+            ts_next.fill_(int(time_range[min(i + 1, len(time_range) - 1)]))
 
             if mask is not None:
                 assert x0 is not None
                 img_orig = self.model.q_sample(x0, ts)  # TODO: deterministic forward pass?
-                img = img_orig * mask + (1. - mask) * img
+                # img_orig * mask + (1 - mask) * img in one kernel.
+                img = torch.lerp(img, img_orig, mask)
 
             outs = self.p_sample_plms(img, cond, ts, index=index, use_original_steps=ddim_use_original_steps,
                                       quantize_denoised=quantize_denoised, temperature=temperature,
@@ -183,20 +193,12 @@ class PLMSSampler(object):
             if unconditional_conditioning is None or unconditional_guidance_scale == 1.:
                 e_t = self.model.apply_model(x, t, c)
             else:
-                x_in = torch.cat([x] * 2)
+                # The buffer of x_in and the concatenated conditioning are reused across the steps.
+                x_in = self._cfg_x_buf = get_cfg_x_in(x, getattr(self, '_cfg_x_buf', None))
                 t_in = torch.cat([t] * 2)
 
-                if isinstance(c, tuple):
-                    c_c, c_in_c, embedder = c
-                    c_u, c_in_u, embedder = unconditional_conditioning
-                    # Concatenated conditining embedding in the order of (unconditional, conditional)
-                    uc_c = torch.cat([c_u, c_c])
-                    # Concatenated input context (prompts) in the order of (unconditional, conditional)
-                    uc_c_in = sum([c_in_u, c_in_c], [])
-                    # Combined context tuple.
-                    c2 = (uc_c, uc_c_in, embedder)
-                else:
-                    c2 = torch.cat([unconditional_conditioning, c])
+                c2, self._cfg_cond_cache = get_cfg_conditioning(c, unconditional_conditioning,
+                                                                getattr(self, '_cfg_cond_cache', None))
 
                 # c_in = torch.cat([unconditional_conditioning, c])
                 e_t_uncond, e_t = self.model.apply_model(x_in, t_in, c2).chunk(2)
@@ -226,10 +228,9 @@ class PLMSSampler(object):
                 pred_x0, _, *_ = self.model.first_stage_model.quantize(pred_x0)
             # direction pointing to x_t
             dir_xt = (1. - a_prev - sigma_t**2).sqrt() * e_t
-            noise = sigma_t * noise_like(x.shape, device, repeat_noise) * temperature
-            if noise_dropout > 0.:
-                noise = torch.nn.functional.dropout(noise, p=noise_dropout)
-            x_prev = a_prev.sqrt() * pred_x0 + dir_xt + noise
+            # PLMS requires ddim_eta == 0 (see make_schedule()), so sigma_t is 0 at every step, 
+            # and the noise term would be all zeros. It's not drawn.
+            x_prev = a_prev.sqrt() * pred_x0 + dir_xt
             return x_prev, pred_x0
 
         e_t = get_model_output(x, t)
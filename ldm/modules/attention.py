@@ -3,7 +3,7 @@ import math
 import torch
 import torch.nn.functional as F
 from torch import nn, einsum
-from einops import rearrange, repeat
+from einops import rearrange
 
 from ldm.modules.diffusionmodules.util import checkpoint
 
@@ -64,6 +64,14 @@ class FeedForward(nn.Module):
         return self.net(x)
 
 
+def layer_norm(norm, x):
+    """
+    Apply the nn.LayerNorm module norm to x by calling F.layer_norm with its params directly,
+    which skips the per-call overhead of the module call (hook dispatch etc.) in hot loops.
+    """
+    return F.layer_norm(x, norm.normalized_shape, norm.weight, norm.bias, norm.eps)
+
+
 def zero_module(module):
     """
     Zero out the parameters of a module and return it.
@@ -131,19 +139,20 @@ class SpatialSelfAttention(nn.Module):
         v = self.v(h_)
 
         # compute attention
+        # q, k, v are only flattened to (b, c, hw) views. The einsums take the transposes 
+        # into account, instead of permuting q and the attention weights beforehand.
         b,c,h,w = q.shape
-        q = rearrange(q, 'b c h w -> b (h w) c')
-        k = rearrange(k, 'b c h w -> b c (h w)')
-        w_ = torch.einsum('bij,bjk->bik', q, k)
+        q = q.reshape(b, c, h*w)
+        k = k.reshape(b, c, h*w)
+        w_ = torch.einsum('bci,bcj->bij', q, k)
 
         w_ = w_ * (int(c)**(-0.5))
         w_ = torch.nn.functional.softmax(w_, dim=2)
 
-        # attend to values
-        v = rearrange(v, 'b c h w -> b c (h w)')
-        w_ = rearrange(w_, 'b i j -> b j i')
-        h_ = torch.einsum('bij,bjk->bik', v, w_)
-        h_ = rearrange(h_, 'b c (h w) -> b c h w', h=h)
+        # attend to values. j, the contracted dim, is the last dim of both v and w_.
+        v = v.reshape(b, c, h*w)
+        h_ = torch.einsum('bcj,bij->bci', v, w_)
+        h_ = h_.reshape(b, c, h, w)
         h_ = self.proj_out(h_)
 
         return x+h_
@@ -175,21 +184,29 @@ class CrossAttention(nn.Module):
         k = self.to_k(context)
         v = self.to_v(context)
 
-        q, k, v = map(lambda t: rearrange(t, 'b n (h d) -> (b h) n d', h=h), (q, k, v))
+        # Splitting the heads into 'b h n d' is a view of the linear outputs. Merging b and h into 
+        # one batch dim, as in '(b h) n d', would force a contiguous copy of q, k and v.
+        q, k, v = map(lambda t: rearrange(t, 'b n (h d) -> b h n d', h=h), (q, k, v))
+        if exists(mask):
+            mask = rearrange(mask, 'b ... -> b () () (...)')
 
-        sim = einsum('b i d, b j d -> b i j', q, k) * self.scale
+        if hasattr(F, 'scaled_dot_product_attention'):
+            # The fused kernel (flash / memory-efficient) never materializes the
+            # full i x j score matrix. Its default scale is dim_head ** -0.5 == self.scale.
+            out = F.scaled_dot_product_attention(q, k, v, attn_mask=mask)
+        else:
+            sim = einsum('b h i d, b h j d -> b h i j', q, k) * self.scale
 
-        if exists(mask):
-            mask = rearrange(mask, 'b ... -> b (...)')
-            max_neg_value = -torch.finfo(sim.dtype).max
-            mask = repeat(mask, 'b j -> (b h) () j', h=h)
-            sim.masked_fill_(~mask, max_neg_value)
+            if exists(mask):
+                max_neg_value = -torch.finfo(sim.dtype).max
+                sim.masked_fill_(~mask, max_neg_value)
+
+            # attention, what we cannot get enough of
+            attn = sim.softmax(dim=-1)
 
-        # attention, what we cannot get enough of
-        attn = sim.softmax(dim=-1)
+            out = einsum('b h i j, b h j d -> b h i d', attn, v)
 
-        out = einsum('b i j, b j d -> b i d', attn, v)
-        out = rearrange(out, '(b h) n d -> b n (h d)', h=h)
+        out = rearrange(out, 'b h n d -> b n (h d)')
         return self.to_out(out)
 
 
@@ -209,9 +226,9 @@ class BasicTransformerBlock(nn.Module):
         return checkpoint(self._forward, (x, context), self.parameters(), self.checkpoint)
 
     def _forward(self, x, context=None):
-        x = self.attn1(self.norm1(x)) + x
-        x = self.attn2(self.norm2(x), context=context) + x
-        x = self.ff(self.norm3(x)) + x
+        x = self.attn1(layer_norm(self.norm1, x)) + x
+        x = self.attn2(layer_norm(self.norm2, x), context=context) + x
+        x = self.ff(layer_norm(self.norm3, x)) + x
         return x
 
 
@@ -252,10 +269,16 @@ class SpatialTransformer(nn.Module):
         b, c, h, w = x.shape
         x_in = x
         x = self.norm(x)
-        x = self.proj_in(x)
-        x = rearrange(x, 'b c h w -> b (h w) c')
+        # The 1x1 convs proj_in / proj_out are Linear layers on the tokens.
+        # They are applied on the 2D token matrix [B*H*W, C] with F.linear (a single addmm),
+        # using the conv weights viewed as [C_out, C_in], so that the checkpoints stay compatible.
+        # It also gives the transformer blocks a contiguous [B, H*W, C] input, 
+        # instead of a permuted view of the conv output.
+        x = rearrange(x, 'b c h w -> (b h w) c')
+        x = F.linear(x, self.proj_in.weight.flatten(1), self.proj_in.bias).view(b, h * w, -1)
         for block in self.transformer_blocks:
             x = block(x, context=context)
-        x = rearrange(x, 'b (h w) c -> b c h w', h=h, w=w)
-        x = self.proj_out(x)
-        return x + x_in
\ No newline at end of file
+        x = F.linear(x.reshape(b * h * w, -1), self.proj_out.weight.flatten(1), self.proj_out.bias)
+        x = rearrange(x, '(b h w) c -> b c h w', b=b, h=h, w=w)
+        # x_in first, so that the sum keeps the memory format of x_in.
+        return x_in + x
\ No newline at end of file
@@ -178,21 +178,25 @@ class AttnBlock(nn.Module):
     def forward(self, x):
         h_ = x
         h_ = self.norm(h_)
-        q = self.q(h_)
-        k = self.k(h_)
-        v = self.v(h_)
+
+        # The 1x1 convs q, k, v are computed as one batched matmul with their stacked weights,
+        # instead of three conv kernels on the same input.
+        # The attention scale c^-0.5 is folded into the (small) weight and bias of q, 
+        # instead of scaling the b*hw*hw attention weights.
+        b,c,h,w = h_.shape
+        h_ = h_.reshape(b,c,h*w)
+        scale = int(c)**(-0.5)
+        qkv_weight = torch.cat([self.q.weight * scale, self.k.weight, self.v.weight]).view(1,3*c,c)
+        qkv_bias   = torch.cat([self.q.bias   * scale, self.k.bias,   self.v.bias]).view(1,3*c,1)
+        qkv = torch.baddbmm(qkv_bias, qkv_weight.expand(b,-1,-1), h_)   # b,3c,hw
+        q, k, v = qkv.chunk(3, dim=1)
 
         # compute attention
-        b,c,h,w = q.shape
-        q = q.reshape(b,c,h*w)
-        q = q.permute(0,2,1)   # b,hw,c
-        k = k.reshape(b,c,h*w) # b,c,hw
-        w_ = torch.bmm(q,k)     # b,hw,hw    w[b,i,j]=sum_c q[b,i,c]k[b,c,j]
-        w_ = w_ * (int(c)**(-0.5))
+        q = q.permute(0,2,1)   # b,hw,c. k: b,c,hw
+        w_ = torch.bmm(q,k)     # b,hw,hw    w[b,i,j]=sum_c q[b,i,c]k[b,c,j] * c^-0.5
         w_ = torch.nn.functional.softmax(w_, dim=2)
 
         # attend to values
-        v = v.reshape(b,c,h*w)
         w_ = w_.permute(0,2,1)   # b,hw,hw (first hw of k, second of q)
         h_ = torch.bmm(v,w_)     # b, c,hw (hw of q) h_[b,c,j] = sum_i v[b,c,i] w_[b,i,j]
         h_ = h_.reshape(b,c,h,w)
@@ -28,6 +28,20 @@ def convert_module_to_f32(x):
     pass
 
 
+def conv1x1_bmm(conv, x, residual=None):
+    """
+    Apply a 1x1 Conv1d to x as a batched matmul with its [C_out x C_in] weight, 
+    which runs as a cuBLAS strided batched GEMM, instead of the cuDNN conv path.
+    :param x: an [N x C_in x T] tensor.
+    :param residual: if given, an [N x C_out x T] tensor added to the output, as the addend of baddbmm.
+    :return: an [N x C_out x T] tensor.
+    """
+    weight = conv.weight.squeeze(-1).expand(x.shape[0], -1, -1)
+    bias = conv.bias.view(1, -1, 1)
+    addend = bias if residual is None else residual + bias
+    return th.baddbmm(addend, weight, x)
+
+
 ## go
 class AttentionPool2d(nn.Module):
     """
@@ -53,10 +67,11 @@ class AttentionPool2d(nn.Module):
         x = x.reshape(b, c, -1)  # NC(HW)
         x = th.cat([x.mean(dim=-1, keepdim=True), x], dim=-1)  # NC(HW+1)
         x = x + self.positional_embedding[None, :, :].to(x.dtype)  # NC(HW+1)
-        x = self.qkv_proj(x)
+        x = conv1x1_bmm(self.qkv_proj, x)
         x = self.attention(x)
-        x = self.c_proj(x)
-        return x[:, :, 0]
+        # Only the output at the first (mean-pooled) position is returned, 
+        # so c_proj is only applied to that position.
+        return F.linear(x[:, :, 0], self.c_proj.weight.squeeze(-1), self.c_proj.bias)
 
 
 class TimestepBlock(nn.Module):
@@ -320,10 +335,11 @@ class AttentionBlock(nn.Module):
     def _forward(self, x):
         b, c, *spatial = x.shape
         x = x.reshape(b, c, -1)
-        qkv = self.qkv(self.norm(x))
+        # The 1x1 Conv1d qkv and proj_out are computed as batched matmuls.
+        # The residual x is added by the baddbmm of proj_out.
+        qkv = conv1x1_bmm(self.qkv, self.norm(x))
         h = self.attention(qkv)
-        h = self.proj_out(h)
-        return (x + h).reshape(b, c, *spatial)
+        return conv1x1_bmm(self.proj_out, h, residual=x).reshape(b, c, *spatial)
 
 
 def count_flops_attn(model, _x, y):
@@ -346,6 +362,18 @@ def count_flops_attn(model, _x, y):
     model.total_ops += th.DoubleTensor([matmul_ops])
 
 
+def sdpa_channels_first(q, k, v):
+    """
+    Attention on [N x C x T] q, k, v with the fused scaled_dot_product_attention.
+    The fused kernels keep the softmax in fp32 internally, so q, k, v are passed in 
+    their own (possibly fp16 / bf16) dtype, without upcasting the attention weights.
+    The default scale of SDPA is 1 / sqrt(C), the same as the einsum path.
+    :return: an [N x C x T] tensor.
+    """
+    a = F.scaled_dot_product_attention(q.transpose(1, 2), k.transpose(1, 2), v.transpose(1, 2))
+    return a.transpose(1, 2)
+
+
 class QKVAttentionLegacy(nn.Module):
     """
     A module which performs QKV attention. Matches legacy QKVAttention + input/ouput heads shaping
@@ -365,6 +393,9 @@ class QKVAttentionLegacy(nn.Module):
         assert width % (3 * self.n_heads) == 0
         ch = width // (3 * self.n_heads)
         q, k, v = qkv.reshape(bs * self.n_heads, ch * 3, length).split(ch, dim=1)
+        if hasattr(F, 'scaled_dot_product_attention'):
+            return sdpa_channels_first(q, k, v).reshape(bs, -1, length)
+
         scale = 1 / math.sqrt(math.sqrt(ch))
         weight = th.einsum(
             "bct,bcs->bts", q * scale, k * scale
@@ -397,6 +428,10 @@ class QKVAttention(nn.Module):
         assert width % (3 * self.n_heads) == 0
         ch = width // (3 * self.n_heads)
         q, k, v = qkv.chunk(3, dim=1)
+        if hasattr(F, 'scaled_dot_product_attention'):
+            q, k, v = map(lambda t: t.reshape(bs * self.n_heads, ch, length), (q, k, v))
+            return sdpa_channels_first(q, k, v).reshape(bs, -1, length)
+
         scale = 1 / math.sqrt(math.sqrt(ch))
         weight = th.einsum(
             "bct,bcs->bts",
@@ -728,8 +763,15 @@ class UNetModel(nn.Module):
         emb = self.time_embed(t_emb)
 
         # context: [9*B, N, 768] reshape => [B, 9, N, 768] permute => [9, B, N, 768]
+        # Without ada context, the permuted context is made contiguous once here. Otherwise each layer's 
+        # context[emb_idx] is a non-contiguous [B, N, 768] slice, which to_k / to_v of every cross-attention 
+        # can't flatten to 2D for addmm, and fall back to matmul with a copy of the slice.
+        # With ada context, each slice is mixed with the ada embeddings, and the mix is a new contiguous 
+        # tensor anyway. So the permuted view is kept, instead of copying the whole context first.
         if use_layerwise_context:
             context = context.reshape(x.shape[0], 16, -1, context.shape[-1]).permute(1, 0, 2, 3)
+            if not use_ada_context:
+                context = context.contiguous()
 
         if self.num_classes is not None:
             assert y.shape == (x.shape[0],)
@@ -262,6 +262,70 @@ class HybridConditioner(nn.Module):
 
 
 def noise_like(shape, device, repeat=False):
-    repeat_noise = lambda: torch.randn((1, *shape[1:]), device=device).repeat(shape[0], *((1,) * (len(shape) - 1)))
+    # The repeated noise is a broadcast view, not a materialized copy. 
+    # All callers consume it with pointwise ops only.
+    repeat_noise = lambda: torch.randn((1, *shape[1:]), device=device).expand(shape)
     noise = lambda: torch.randn(shape, device=device)
-    return repeat_noise() if repeat else noise()
\ No newline at end of file
+    return repeat_noise() if repeat else noise()
+
+
+def resize_mask_nearest(mask, size):
+    """
+    Nearest-neighbor resize of a [N, C, H0, W0] mask to size (H, W).
+    When H0, W0 are integer multiples of H, W, nearest downsampling picks the pixels 
+    at (i * H0/H, j * W0/W), i.e., it's a strided slice of the mask, 
+    which is taken directly instead of going through F.interpolate.
+    Otherwise falls back to F.interpolate(mode='nearest').
+    """
+    H0, W0 = mask.shape[-2:]
+    H, W   = size
+    if H0 % H == 0 and W0 % W == 0:
+        return mask[..., ::H0 // H, ::W0 // W]
+    return torch.nn.functional.interpolate(mask, size=size, mode='nearest')
+
+
+def concat_cfg_conditioning(c, uc):
+    """
+    Concatenate the unconditional and conditional conditioning in the order of (uc, c),
+    so that classifier-free guidance evaluates both in one batched model call.
+    :param c, uc: tensors, or (embedding, prompts, embedder) tuples with ada embeddings.
+    """
+    if isinstance(c, tuple):
+        c_c, c_in_c, embedder = c
+        c_u, c_in_u, embedder = uc
+        # Concatenated conditining embedding in the order of (unconditional, conditional)
+        uc_c = torch.cat([c_u, c_c])
+        # Concatenated input context (prompts) in the order of (unconditional, conditional)
+        uc_c_in = sum([c_in_u, c_in_c], [])
+        # Combined context tuple.
+        return (uc_c, uc_c_in, embedder)
+    return torch.cat([uc, c])
+
+
+def get_cfg_conditioning(c, uc, cache=None):
+    """
+    The concatenated (unconditional, conditional) conditioning of classifier-free guidance.
+    It's the same at all the steps of a sampling run, so it's built once, and reused while 
+    the same c and uc objects are passed in.
+    :param cache: the cache returned by the previous call, or None.
+    :return: the concatenated conditioning, and the cache to pass to the next call.
+    """
+    if cache is None or cache[0] is not c or cache[1] is not uc:
+        cache = (c, uc, concat_cfg_conditioning(c, uc))
+    return cache[2], cache
+
+
+def get_cfg_x_in(x, buf=None):
+    """
+    x_in of classifier-free guidance: x repeated twice along the batch, in the memory format of x.
+    Written into buf if it matches x, instead of a new torch.cat() at every step.
+    :param buf: the tensor returned by the previous call, or None.
+    :return: x_in, which is only valid until the next call with the same buf.
+    """
+    B = x.shape[0]
+    if buf is None or buf.shape[0] != 2 * B or buf.shape[1:] != x.shape[1:] \
+      or buf.dtype != x.dtype or buf.device != x.device:
+        return torch.cat([x] * 2)
+    buf[:B].copy_(x)
+    buf[B:].copy_(x)
+    return buf
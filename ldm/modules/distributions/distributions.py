@@ -78,8 +78,9 @@ def normal_kl(mean1, logvar1, mean2, logvar2):
 
     # Force variances to be Tensors. Broadcasting helps convert scalars to
     # Tensors, but it does not work for torch.exp().
+    # Scalars are filled on the device of tensor, without a host-to-device copy.
     logvar1, logvar2 = [
-        x if isinstance(x, torch.Tensor) else torch.tensor(x).to(tensor)
+        x if isinstance(x, torch.Tensor) else torch.full((), x, dtype=tensor.dtype, device=tensor.device)
         for x in (logvar1, logvar2)
     ]
 
@@ -34,15 +34,26 @@ class LitEma(nn.Module):
         with torch.no_grad():
             m_param = dict(model.named_parameters())
             shadow_params = dict(self.named_buffers())
+            shadow_list, param_list = [], []
 
             for key in m_param:
                 if m_param[key].requires_grad:
                     sname = self.m_name2s_name[key]
-                    shadow_params[sname] = shadow_params[sname].type_as(m_param[key])
-                    shadow_params[sname].sub_(one_minus_decay * (shadow_params[sname] - m_param[key]))
+                    shadow_list.append(shadow_params[sname])
+                    param_list.append(m_param[key].to(shadow_params[sname].dtype))
                 else:
                     assert not key in self.m_name2s_name
 
+            # shadow <- shadow - (1 - decay) * (shadow - param) is a lerp towards param.
+            # _foreach_lerp_ updates all shadow params with one multi-tensor kernel,
+            # instead of launching a few kernels per param.
+            one_minus_decay = float(one_minus_decay)
+            if hasattr(torch, '_foreach_lerp_'):
+                torch._foreach_lerp_(shadow_list, param_list, one_minus_decay)
+            else:
+                for s_param, param in zip(shadow_list, param_list):
+                    s_param.lerp_(param, one_minus_decay)
+
     def copy_to(self, model):
         m_param = dict(model.named_parameters())
         shadow_params = dict(self.named_buffers())
@@ -52,6 +63,22 @@ class LitEma(nn.Module):
             else:
                 assert not key in self.m_name2s_name
 
+    def swap(self, model):
+        """
+        Exchange the EMA parameters with the parameters of `model` by swapping
+        their storage references, without copying any data. Calling it a second
+        time restores the original parameters, i.e., it can replace the
+        `store` / `copy_to` / `restore` sequence.
+        """
+        m_param = dict(model.named_parameters())
+        shadow_params = dict(self.named_buffers())
+        for key in m_param:
+            if m_param[key].requires_grad:
+                s_param = shadow_params[self.m_name2s_name[key]]
+                m_param[key].data, s_param.data = s_param.data, m_param[key].data
+            else:
+                assert not key in self.m_name2s_name
+
     def store(self, parameters):
         """
         Save the current parameters for restoring later.
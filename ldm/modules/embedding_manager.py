@@ -2,11 +2,15 @@ import torch
 from torch import nn
 import torch.nn.functional as F
 import numpy as np
+import math
 import copy
 
 from ldm.data.personalized import per_img_token_list
 from transformers import CLIPTokenizer
 from functools import partial
+from collections import OrderedDict
+from ldm.modules.diffusionmodules.util import resize_mask_nearest
+from ldm.util import params_version_key
 
 DEFAULT_PLACEHOLDER_TOKEN = ["*"]
 
@@ -55,7 +59,35 @@ def selective_reg_loss(x, loss_type='l2', selector=None):
     elif loss_type == 'l2':
         return (x * x).mean()
     else:
-        breakpoint()
+        raise NotImplementedError(f"unknown loss type '{loss_type}'")
+
+# Per-element scales 1/numel(x_i) of the concatenated xs, cached by the shapes of xs.
+_reg_loss_scales_cache = {}
+
+# Sum of selective_reg_loss(x_i) over a list of tensors of different shapes (without selector).
+# sum_i mean(f(x_i)) is computed as sum_j f(x)_j / numel(x_i containing j) on the concatenated xs,
+# with a few kernels in total, instead of a few kernels per tensor.
+def sum_reg_loss(xs, loss_type='l2'):
+    x = torch.cat([ x_i.flatten() for x_i in xs ])
+    key = (tuple(x_i.numel() for x_i in xs), x.device, x.dtype)
+    if key not in _reg_loss_scales_cache:
+        _reg_loss_scales_cache[key] = torch.cat([ torch.full((numel,), 1. / numel, dtype=x.dtype) 
+                                                  for numel in key[0] ]).to(x.device)
+    scales = _reg_loss_scales_cache[key]
+
+    if loss_type == 'l1':
+        return torch.dot(x.abs(), scales)
+    elif loss_type == 'l2':
+        return torch.dot(x * x, scales)
+    else:
+        raise NotImplementedError(f"unknown loss type '{loss_type}'")
+
+# x * |x|^(exponent - 1), i.e., the power that keeps the sign of x.
+# Scripted, so that the fuser merges abs, pow and mul into one kernel,
+# instead of materializing |x| and |x|^(exponent - 1) as full-size temporaries.
+@torch.jit.script
+def signed_pow(x, exponent: float):
+    return x * x.abs().pow(exponent - 1)
 
 # Eq.(2) in the StyleGAN-NADA paper.
 # delta, ref_delta: [2, 16, 77, 768].
@@ -65,14 +97,16 @@ def calc_delta_loss(delta, ref_delta, exponent=3):
     delta = delta.view(delta.numel() // delta.shape[-1], -1)
     ref_delta = ref_delta.view(ref_delta.numel() // ref_delta.shape[-1], -1)
     # delta_pow = delta * delta.abs().pow(exponent - 1)
-    ref_delta_pow = ref_delta * ref_delta.abs().pow(exponent - 1)
-    loss = F.cosine_embedding_loss(delta, ref_delta_pow.detach(), 
+    # ref_delta_pow is detached, so it's computed without recording the autograd graph.
+    with torch.no_grad():
+        ref_delta_pow = signed_pow(ref_delta, float(exponent))
+    loss = F.cosine_embedding_loss(delta, ref_delta_pow, 
                                    torch.ones_like(delta[:, 0]))
     return loss
 
 def calc_stats(emb_name, embeddings):
     print("%s:" %emb_name)
-    emb_mean = embeddings.mean(0, keepdim=True).repeat(embeddings.size(0), 1)
+    emb_mean = embeddings.mean(0, keepdim=True).expand_as(embeddings)
     l1_loss = F.l1_loss(embeddings, emb_mean)
     # F.l2_loss doesn't take sqrt. So the loss is very small. 
     # Compute it manually.
@@ -93,24 +127,122 @@ class LNCat2(nn.Module):
         x2 = self.ln2(x2)
         return torch.cat([x1, x2], dim=self.dim)
 
-class MaskedAvgPool2d(nn.Module):
-    def __init__(self):
+# A mixin of modules that keep caches of computed tensors, which are not saved with the object.
+# _cache_factories maps the attribute name of each cache to a function returning the empty cache.
+class CacheMixin:
+    _cache_factories = {}
+
+    # The caches are replaced by empty ones in the pickled state.
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        for name, factory in self._cache_factories.items():
+            state[name] = factory()
+        return state
+
+    # Objects pickled before a cache was added don't have it. It's created on the first access.
+    def get_cache(self, name):
+        if name not in self.__dict__:
+            self.__dict__[name] = self._cache_factories[name]()
+        return self.__dict__[name]
+
+class MaskedAvgPool2d(CacheMixin, nn.Module):
+    _cache_factories = { '_mask_cache': OrderedDict }
+
+    def __init__(self, mask_cache_size=8):
         super().__init__()
         self.avgpool = nn.AdaptiveAvgPool2d(1)
-
-    # x: [N, C, H, W], mask: [N, 1, H0, W0]. 
+        # The same mask is resized to the few feature map sizes of the UNet layers, at every layer 
+        # and every step. The resized masks are cached by (mask, feature map size, dtype), 
+        # and the oldest entry is evicted when the cache is full.
+        # The cache entries keep a reference to the mask, so its id() is not reused while cached,
+        # and in-place updates of the mask are detected by its _version.
+        self.mask_cache_size = mask_cache_size
+        self._mask_cache = OrderedDict()
+
+    # Returns the mask resized to size and flattened to [N/k, H*W, 1], and its sum over H*W: [N/k, 1].
+    def get_resized_mask(self, mask, size, dtype):
+        mask_cache = self.get_cache('_mask_cache')
+        key = (id(mask), mask._version, tuple(size), dtype)
+        if key in mask_cache:
+            return mask_cache[key][1:]
+
+        H, W = size
+        mask_flat = resize_mask_nearest(mask, size)
+        mask_flat = mask_flat.reshape(mask.shape[0], H * W, 1).to(dtype)
+        mask_sum  = mask_flat.sum(dim=1)
+        mask_cache[key] = (mask, mask_flat, mask_sum)
+        while len(mask_cache) > getattr(self, 'mask_cache_size', 8):
+            mask_cache.popitem(last=False)
+        return mask_flat, mask_sum
+
+    # x: [N, C, H, W], mask: [N, 1, H0, W0] or [N/k, 1, H0, W0]. 
     # H, W: feature map size, H0, W0: original image size.
+    # If the image batch is repeated k times in x, the mask is broadcasted 
+    # over the repeats instead of being materialized k times.
     # Return: [N, C]
     def forward(self, x, mask=None):
         if mask is None:
             return self.avgpool(x).view(x.shape[0], -1)
+
+        N, C, H, W = x.shape
+        # The masked sum over H, W is done as a matmul with the flattened mask, which doesn't 
+        # materialize the [N, C, H, W] product x * mask. Merging H, W is a view for both 
+        # NCHW and channels_last feature maps, and the matmul handles either stride order.
+        # x: [k, N/k, C, H*W]. mask: [N/k, H*W, 1].
+        # The matmul is a memory-bound matrix-vector product. It's done in the dtype of x (and the 
+        # cached mask is kept in the same dtype), with autocast disabled. Otherwise under autocast, 
+        # the whole feature map would be cast to fp16 first, which costs more memory traffic 
+        # than the product itself.
+        mask, mask_sum = self.get_resized_mask(mask, (H, W), x.dtype)
+        x = x.reshape(-1, mask.shape[0], C, H * W)
+        with torch.autocast(device_type=x.device.type, enabled=False):
+            x = torch.matmul(x, mask).squeeze(-1) / mask_sum
+        return x.reshape(N, C)
         
-        mask = F.interpolate(mask, size=x.shape[2:], mode='nearest')
-        x = x * mask
-        x = x.sum(dim=(2,3)) / mask.sum(dim=(2,3))
-        return x
-        
-class StaticLayerwiseEmbedding(nn.Module):
+# The per-layer pipeline of AdaEmbedding.forward after pooling:
+# cat(ln(infeat_pooled), ln(time_feat)) -> Linear -> matmul with basis_vecs -> ln -> scale.
+# It's a standalone function that takes the params of the current layer as tensors, 
+# so that one compiled graph (with dynamic shapes) is shared by all layers, instead of 
+# being recompiled for the modules of each layer.
+# lncat2_params: (ln1.weight, ln1.bias, ln2.weight, ln2.bias). ln_params: (ln.weight, ln.bias).
+def ada_emb_layer_forward(infeat_pooled, time_feat, lncat2_params, map_weight, map_bias, 
+                          basis_vecs, ln_params, eps: float, out_scale: float):
+    ln1_weight, ln1_bias, ln2_weight, ln2_bias = lncat2_params
+    infeat_ln = F.layer_norm(infeat_pooled, infeat_pooled.shape[-1:], ln1_weight, ln1_bias, eps)
+    time_ln   = F.layer_norm(time_feat,     time_feat.shape[-1:],     ln2_weight, ln2_bias, eps)
+    # Linear(cat(x1, x2)) = x1 @ W1^T + x2 @ W2^T + b, where W1, W2 are the column blocks of map_weight.
+    # The normalized features are fed into the two matmuls directly, 
+    # without materializing their concatenation.
+    C1 = infeat_pooled.shape[-1]
+    basis_dyn_weight = torch.addmm(F.linear(infeat_ln, map_weight[:, :C1], map_bias),
+                                   time_ln, map_weight[:, C1:].t())
+    out_vec0 = torch.matmul(basis_dyn_weight, basis_vecs)
+    out_vec0 = F.layer_norm(out_vec0, out_vec0.shape[-1:], ln_params[0], ln_params[1], eps) * out_scale
+    return basis_dyn_weight, out_vec0
+
+# Built on the first call of an AdaEmbedding with compile_forward=True.
+_compiled_ada_emb_layer_forward = None
+
+def get_compiled_ada_emb_layer_forward():
+    global _compiled_ada_emb_layer_forward
+    if _compiled_ada_emb_layer_forward is None:
+        _compiled_ada_emb_layer_forward = torch.compile(ada_emb_layer_forward, dynamic=True)
+    return _compiled_ada_emb_layer_forward
+
+# The initial values of the learned basis vectors: [n, dim2].
+# Random vectors are normalized, to roughly equalize the contributions of different random vectors, 
+# and the last basis vector is always set to 0. 
+# The values are computed in place in one tensor, which is then wrapped as the Parameter, 
+# instead of creating the Parameter first and replacing its data with new tensors.
+def init_basis_vecs(n, dim2):
+    basis_vecs = torch.randn(n, dim2)
+    basis_vecs = F.normalize(basis_vecs, dim=1).div_(4.)
+    basis_vecs[-1] = 0
+    return basis_vecs
+
+class StaticLayerwiseEmbedding(CacheMixin, nn.Module):
+    _cache_factories = { '_eval_cache': lambda: None }
+
     # dim1: 16 (9 layers out of 25 of UNet are skipped), dim2: 768, r: 12.
     # If using init_vecs, init_noise_stds are applied to basis_rand_weights. 
     # Otherwise, init_up_noise_stds has no effect.
@@ -129,6 +261,8 @@ class StaticLayerwiseEmbedding(nn.Module):
         self.dim1 = dim1
         self.dim2 = dim2
         self.r = r
+        # The scale of the output vectors, computed once instead of at every forward.
+        self.out_scale = 1. / math.sqrt(dim2)
 
         if r > min(dim1, dim2):
             raise ValueError(
@@ -158,11 +292,7 @@ class StaticLayerwiseEmbedding(nn.Module):
         # basis_rand_weights: 16 * r, basis_vecs: r * 768. basis_rand_weights * basis_vecs: 16 * 768.
         self.basis_rand_weights    = nn.Parameter(torch.randn(dim1, r))
         # basis_vecs consists of r basis vectors. Will be updated through BP.
-        self.basis_vecs = nn.Parameter(torch.randn(r - N, dim2), requires_grad=True)
-        # Normalize basis_vecs, to roughly equalize the contributions of different random vectors.
-        self.basis_vecs.data = F.normalize(self.basis_vecs, dim=1) / 4.
-        # Always set the last basis vector to 0.
-        self.basis_vecs.data[-1] = 0
+        self.basis_vecs = nn.Parameter(init_basis_vecs(r - N, dim2), requires_grad=True)
 
         self.has_bias    = has_bias
         self.device_type = device_type
@@ -227,19 +357,51 @@ class StaticLayerwiseEmbedding(nn.Module):
             self.bias = 0
             self.bias_scales = 0
 
-        layer_lns  = []
-        for i in range(dim1):
-            layer_lns.append( nn.LayerNorm(dim2, elementwise_affine=True) )
-
-        self.layer_lns  = nn.ModuleList(layer_lns)
+        # The affine params of the dim1 layer-wise LayerNorms, stacked into [dim1, dim2] tensors,
+        # so that they are applied to all rows at once without stacking them in every forward().
+        self.layer_ln_weight = nn.Parameter(torch.ones(dim1, dim2))
+        self.layer_ln_bias   = nn.Parameter(torch.zeros(dim1, dim2))
+        self.layer_ln_eps    = 1e-5
+        # The output of forward() only depends on the params. In eval mode without grad, 
+        # it's cached until any param is updated or replaced.
+        self._eval_cache     = None
 
         print(f"StaticLayerwiseEmbedding initialized with {self.N} init vectors, {self.NEG} negative vectors, {self.r} basis vectors")
 
+    # Convert the per-layer LayerNorms (layer_lns) of older objects / checkpoints to the stacked params.
+    def __setstate__(self, state):
+        super().__setstate__(state)
+        if 'layer_lns' in self._modules:
+            layer_lns = self._modules.pop('layer_lns')
+            self.layer_ln_weight = nn.Parameter(torch.stack([ ln.weight.data for ln in layer_lns ]))
+            self.layer_ln_bias   = nn.Parameter(torch.stack([ ln.bias.data   for ln in layer_lns ]))
+            self.layer_ln_eps    = layer_lns[0].eps
+        if 'out_scale' not in self.__dict__:
+            self.out_scale = 1. / math.sqrt(self.dim2)
+
+    def _load_from_state_dict(self, state_dict, prefix, *args, **kwargs):
+        ln_prefix = prefix + 'layer_lns.'
+        if any(k.startswith(ln_prefix) for k in state_dict):
+            for name in ('weight', 'bias'):
+                keys = [ f'{ln_prefix}{i}.{name}' for i in range(self.dim1) ]
+                state_dict[f'{prefix}layer_ln_{name}'] = torch.stack([ state_dict.pop(k) for k in keys ])
+        super()._load_from_state_dict(state_dict, prefix, *args, **kwargs)
+
     def forward(self, only_bias=False):
-        with torch.autocast(device_type=self.device_type, enabled=False):
-            if only_bias:
-                return self.bias
+        if only_bias:
+            return self.bias
+
+        if self.training or torch.is_grad_enabled():
+            return self._forward()
+
+        params_key = params_version_key(self.parameters())
+        eval_cache = self.get_cache('_eval_cache')
+        if eval_cache is None or eval_cache[0] != params_key:
+            eval_cache = self._eval_cache = (params_key, self._forward())
+        return eval_cache[1]
 
+    def _forward(self):
+        with torch.autocast(device_type=self.device_type, enabled=False):
             # self.basis_comm_weights: [1, r] broadcasted to [16, r].
             basis_weights   = self.basis_rand_weights   + self.basis_comm_weights
             # torch.matmul: matrix multiplication.
@@ -251,9 +413,12 @@ class StaticLayerwiseEmbedding(nn.Module):
                 basis_vecs = self.basis_vecs
 
             out_vecs = torch.matmul(basis_weights, basis_vecs)
-            # Apply layer-wise layer normalization.
-            out_vecs_ln = [ self.layer_lns[i](out_vecs[i]) for i in range(self.dim1) ]
-            out_vecs_ln = torch.stack(out_vecs_ln, dim=0) / np.sqrt(self.dim2)
+            # Apply layer-wise layer normalization. 
+            # Row i of out_vecs is normalized with the affine params in row i of layer_ln_weight / layer_ln_bias. 
+            # The normalization itself has no parameters, so all rows are normalized in one layer_norm() call, 
+            # and the per-layer affine params are applied at once with one addcmul().
+            out_vecs_ln = F.layer_norm(out_vecs, (self.dim2,), eps=self.layer_ln_eps)
+            out_vecs_ln = torch.addcmul(self.layer_ln_bias, out_vecs_ln, self.layer_ln_weight) * self.out_scale
 
             # Different layers have different bias scales.
             # Separate bias and bias_scales, for easier regularization on their scales.
@@ -261,7 +426,9 @@ class StaticLayerwiseEmbedding(nn.Module):
             out_vecs_ln = out_vecs_ln + layerwise_bias
             return out_vecs_ln
 
-class AdaEmbedding(nn.Module):
+class AdaEmbedding(CacheMixin, nn.Module):
+    _cache_factories = { '_eval_cache': lambda: None, '_cuda_graphs': dict }
+
     # dim1: 16 (9 layers out of 25 of UNet are skipped).
     # dim2: 768, r: 12.
     # infeat_dims: a list of 25 integers, each is the dimension of 
@@ -275,14 +442,22 @@ class AdaEmbedding(nn.Module):
                  # skipped_layers = [0, 3, 6, 9, 10, 11, 13, 14, 15],
                  layer_idx2emb_idx = { 1:  0, 2:  1, 4:  2,  5:  3,  7:  4,  8:  5,  12: 6,  16: 7,
                                        17: 8, 18: 9, 19: 10, 20: 11, 21: 12, 22: 13, 23: 14, 24: 15 },
-                 has_bias=True, device_type="cuda"):
+                 has_bias=True, device_type="cuda", compile_forward=False, cuda_graph_forward=False):
         super().__init__()
 
         assert dim1 == len(layer_idx2emb_idx), f"dim1={dim1} != len(layer_idx2emb_idx)={len(layer_idx2emb_idx)}"
         self.dim1 = dim1
         self.dim2 = dim2
         self.r = r
+        # The scale of the output vectors, computed once instead of at every layer call.
+        self.out_scale = 1. / math.sqrt(dim2)
         self.device_type = device_type
+        # compile_forward: run the per-layer pipeline with torch.compile (requires torch >= 2.0),
+        # which fuses the small LayerNorm / Linear / matmul kernels.
+        self.compile_forward = compile_forward and hasattr(torch, 'compile')
+        # cuda_graph_forward: at inference (eval mode, no grad), replay the per-layer pipeline 
+        # from a captured CUDA graph, to skip the launch overhead of its small kernels.
+        self.cuda_graph_forward = cuda_graph_forward and hasattr(torch.cuda, 'CUDAGraph')
         self.layer_idx2emb_idx = layer_idx2emb_idx
         self.emb_idx2layer_idx = { v: k for k, v in layer_idx2emb_idx.items() }
 
@@ -305,11 +480,7 @@ class AdaEmbedding(nn.Module):
             self.pre_vecs = None
 
         # basis_vecs: [12, 768], consists of r-N basis vectors. Will be updated through BP.
-        self.basis_vecs = nn.Parameter(torch.randn(r - N, dim2), requires_grad=True)
-        # Normalize basis_vecs, to roughly equalize the contributions of different random vectors.
-        self.basis_vecs.data = F.normalize(self.basis_vecs, dim=1) / 4.
-        # Always set the last basis vector to 0.
-        self.basis_vecs.data[-1] = 0
+        self.basis_vecs = nn.Parameter(init_basis_vecs(r - N, dim2), requires_grad=True)
 
         self.infeat_dims = list(infeat_dims)
         self.avgpool = MaskedAvgPool2d() # nn.AdaptiveAvgPool2d((1, 1))
@@ -347,13 +518,91 @@ class AdaEmbedding(nn.Module):
 
         print(f"AdaEmbedding initialized with {self.N} init vectors, {self.r} basis vectors")
         self.call_count = 0
+        # The basis vectors and layer-wise biases don't depend on the input. In eval mode without grad,
+        # they are cached across layers and steps, until any of their params is updated or replaced.
+        self._eval_cache = None
+        # The CUDA graphs of the per-layer pipeline, indexed by (emb_idx, input shapes, dtypes, device),
+        # and invalidated by the params of the layer as the eval cache.
+        self._cuda_graphs = {}
+
+    # Compatible with AdaEmbedding objects pickled before out_scale was added.
+    def __setstate__(self, state):
+        super().__setstate__(state)
+        if 'out_scale' not in self.__dict__:
+            self.out_scale = 1. / math.sqrt(self.dim2)
+
+    # Returns basis_vecs: [r, 768] and the biases of all layers: [dim1, 768] (or 0 if not has_bias).
+    def get_basis_vecs_and_biases(self):
+        if self.training or torch.is_grad_enabled():
+            return self._get_basis_vecs_and_biases()
+
+        params = [ p for p in (self.pre_vecs, self.basis_vecs, self.bias, self.bias_scales) 
+                   if isinstance(p, torch.Tensor) ]
+        params_key = params_version_key(params)
+        eval_cache = self.get_cache('_eval_cache')
+        if eval_cache is None or eval_cache[0] != params_key:
+            eval_cache = self._eval_cache = (params_key, self._get_basis_vecs_and_biases())
+        return eval_cache[1]
+
+    def _get_basis_vecs_and_biases(self):
+        if self.N > 0:
+            basis_vecs = torch.cat([self.pre_vecs, self.basis_vecs], dim=0)
+        else:
+            basis_vecs = self.basis_vecs
+        # Separate bias and bias_scales, for easier regularization on their scales.
+        # bias: [16, 768] * [16, 1] = [16, 768].
+        layer_biases = self.bias * self.bias_scales
+        return basis_vecs, layer_biases
+
+    # Run layer_forward(infeat_pooled, time_feat, *layer_args[:3], basis_vecs, *layer_args[3:])
+    # by replaying a CUDA graph. The graph of each (emb_idx, input shapes, dtypes) is captured 
+    # on its first call. Later calls copy the inputs into its static input buffers, 
+    # and replay it. basis_vecs may be a newly computed tensor, so it's a static input as well.
+    # The graph reads the params from the storage they had at capture, so it's captured again 
+    # once any param of the layer is updated or replaced, same as the eval caches.
+    # The returned tensors are the static outputs, which are overwritten by the next replay.
+    def cuda_graph_layer_forward(self, emb_idx, layer_forward, infeat_pooled, time_feat, basis_vecs, layer_args):
+        cuda_graphs = self.get_cache('_cuda_graphs')
+
+        inputs = (infeat_pooled, time_feat, basis_vecs)
+        key = (emb_idx,) + tuple((x.shape, x.dtype) for x in inputs) + (infeat_pooled.device,)
+        params = [ p for arg in layer_args for p in (arg if isinstance(arg, tuple) else (arg,))
+                   if isinstance(p, torch.Tensor) ]
+        params_key = params_version_key(params)
+        if key not in cuda_graphs or cuda_graphs[key][0] != params_key:
+            static_inputs = tuple(x.clone() for x in inputs)
+            def run_static():
+                x, t, bv = static_inputs
+                return layer_forward(x, t, *layer_args[:3], bv, *layer_args[3:])
+
+            # The autocast cache has to be disabled during capture, 
+            # otherwise the cached casts of the params are baked into the graph.
+            with torch.autocast(device_type=self.device_type, enabled=torch.is_autocast_enabled(),
+                                cache_enabled=False):
+                # Warm up on a side stream before capturing.
+                side_stream = torch.cuda.Stream()
+                side_stream.wait_stream(torch.cuda.current_stream())
+                with torch.cuda.stream(side_stream):
+                    for _ in range(3):
+                        run_static()
+                torch.cuda.current_stream().wait_stream(side_stream)
+
+                graph = torch.cuda.CUDAGraph()
+                with torch.cuda.graph(graph):
+                    static_outputs = run_static()
+            cuda_graphs[key] = (params_key, graph, static_inputs, static_outputs)
+
+        _, graph, static_inputs, static_outputs = cuda_graphs[key]
+        for static_x, x in zip(static_inputs, inputs):
+            static_x.copy_(x, non_blocking=True)
+        graph.replay()
+        return static_outputs
 
     # layer_infeat: 4D image feature tensor [B, C, H, W].
     # layer_idx: 0 ~ 24. emb_idx: 0 ~ 15.
     # time_emb: [B, 1280].
     def forward(self, layer_idx, layer_infeat, time_emb, img_mask=None):
         emb_idx = self.layer_idx2emb_idx[layer_idx]
-        self.avgpool = MaskedAvgPool2d()
         
         with torch.autocast(device_type=self.device_type, enabled=True):
             # basis_dyn_weight: [B, r] = [2, 12].
@@ -369,21 +618,34 @@ class AdaEmbedding(nn.Module):
             # and the last dimensions tend to be the same for all time steps.
             # TD is C_layer/2, so that the time embeddings won't dominate the image features infeat_pooled.
             TD = self.TDs[emb_idx]
+            basis_vecs, layer_biases = self.get_basis_vecs_and_biases()
+            # bias: [1, 768].
+            bias = layer_biases[emb_idx].unsqueeze(0) if isinstance(layer_biases, torch.Tensor) else layer_biases
+
+            lncat2      = self.layer_lncat2s[emb_idx]
+            layer_map   = self.layer_maps[emb_idx]
+            ln          = self.layer_lns[emb_idx]
+            # Compatible with AdaEmbedding objects pickled before compile_forward was added.
+            layer_forward = get_compiled_ada_emb_layer_forward() if getattr(self, 'compile_forward', False) \
+                                else ada_emb_layer_forward
+            # The args of layer_forward other than infeat_pooled, time_feat and basis_vecs.
+            layer_args  = ((lncat2.ln1.weight, lncat2.ln1.bias, lncat2.ln2.weight, lncat2.ln2.bias),
+                           layer_map.weight, layer_map.bias, (ln.weight, ln.bias), 
+                           ln.eps, self.out_scale)
+            # CUDA graphs are only used at inference, where the graph doesn't need to 
+            # record the autograd history of the pipeline.
+            use_cuda_graph = getattr(self, 'cuda_graph_forward', False) and infeat_pooled.is_cuda \
+                             and not self.training and not torch.is_grad_enabled()
             # cat(ln(infeat_pooled), ln(time_emb)) as the input features.
-            infeat_time      = self.layer_lncat2s[emb_idx](infeat_pooled, time_emb[:, :TD])
-            basis_dyn_weight = self.layer_maps[emb_idx](infeat_time)
-            # Separate bias and bias_scales, for easier regularization on their scales.
-            # bias: [1, 768] * [1, 1] = [1, 768].
-            bias = self.bias[emb_idx].unsqueeze(0) * self.bias_scales[emb_idx]
-
-            if self.N > 0:
-                basis_vecs = torch.cat([self.pre_vecs, self.basis_vecs], dim=0)
+            # [2, 12] x [12, 768] = [2, 768].
+            if use_cuda_graph:
+                basis_dyn_weight, out_vec0 = \
+                    self.cuda_graph_layer_forward(emb_idx, layer_forward, infeat_pooled, time_emb[:, :TD],
+                                                  basis_vecs, layer_args)
             else:
-                basis_vecs = self.basis_vecs
-
-            ln = self.layer_lns[emb_idx]
-            # [2, 12] x [12, 768] = [2, 768], + [1, 768] = [2, 768].
-            out_vec0 = ln(torch.matmul(basis_dyn_weight, basis_vecs)) / np.sqrt(self.dim2)
+                basis_dyn_weight, out_vec0 = \
+                    layer_forward(infeat_pooled, time_emb[:, :TD], *layer_args[:3], basis_vecs, *layer_args[3:])
+            # [2, 768] + [1, 768] = [2, 768].
             out_vec  = out_vec0 + bias
 
             self.debug = False
@@ -431,6 +693,10 @@ class EmbeddingManager(nn.Module):
             ada_emb_weight=0.5, 
             composition_delta_reg_iter_gap=-1,       
             subj_scale=1.0,
+            # Compile the per-layer pipeline of AdaEmbedding with torch.compile (torch >= 2.0).
+            compile_ada_embedding=False,
+            # Replay the per-layer pipeline of AdaEmbedding from CUDA graphs at inference.
+            cuda_graph_ada_embedding=False,
             **kwargs
     ):
         super().__init__()
@@ -525,7 +791,9 @@ class EmbeddingManager(nn.Module):
                                                                    init_neg_vecs=init_neg_embeddings)
 
                     token_ada_embedder  = AdaEmbedding(num_vectors_per_token, self.token_dim, 
-                                                         layerwise_lora_rank, init_word_embeddings)                                                        
+                                                         layerwise_lora_rank, init_word_embeddings,
+                                                         compile_forward=compile_ada_embedding,
+                                                        cuda_graph_forward=cuda_graph_ada_embedding)                                                        
                 else:
                     # ANCHOR[id=init_embed] : num_vectors_per_token vectors are initialized with the same embedding.
                     token_params = torch.nn.Parameter(avg_init_word_embedding.repeat(num_vectors_per_token, 1), requires_grad=True)
@@ -538,7 +806,9 @@ class EmbeddingManager(nn.Module):
                                                               None, None, init_neg_embeddings=init_neg_embeddings)
                                                   
                     token_ada_embedder  = AdaEmbedding(num_vectors_per_token, self.token_dim, 
-                                                        layerwise_lora_default_rank, init_word_embeddings)   
+                                                        layerwise_lora_default_rank, init_word_embeddings,
+                                                        compile_forward=compile_ada_embedding,
+                                                        cuda_graph_forward=cuda_graph_ada_embedding)   
                 else:
                     token_params = torch.nn.Parameter(torch.rand(size=(num_vectors_per_token, self.token_dim), requires_grad=True))
                     token_ada_embedder = None
@@ -579,17 +849,25 @@ class EmbeddingManager(nn.Module):
             self.clear_ada_layer_info()
             return embedded_text
 
-        if self.use_layerwise_embedding:
+        if self.use_layerwise_embedding and self.max_vectors_per_layer_per_token == 1:
+            # embedded_text is first expanded to [B, 16, N, 768] (a view), and the masked replacement below
+            # writes the layer-wise embeddings into a new tensor. It's reshaped to [16*B, N, 768] in the end.
+            embedded_text = embedded_text.unsqueeze(1).expand(-1, self.num_unet_layers, -1, -1)
+            # tokenized_text: [B, N] => [B, 1, N], broadcasted along the layer dimension.
+            tokenized_text = tokenized_text.unsqueeze(1)
+            # mirror-reflect the embedding along the layer dimension, to make it symmetric 
+            # in the encoder & decoder.
+        elif self.use_layerwise_embedding:
+            # The multi-vector replacement below writes the rows of embedded_text in place, 
+            # so it needs real copies for each layer.
             # embedded_text: [B, 16, N, 768] => [16*B, N, 768].
             # "Tuck" the layer dimension into the batch dimension, 
             # to keep embedded_text in 3D, same as the input.
             embedded_text = embedded_text.unsqueeze(1).repeat(1, self.num_unet_layers, 1, 1).view(b * self.num_unet_layers, n, -1)
             # tokenized_text: [B, 16, N] => [16*B, N]
             # tokenized_text has to be repeated along the layer dimension as well, so that 
-            # placeholder_idx can index the embedding at each layer in the batch.
+            # the placeholder positions index the embedding at each layer in the batch.
             tokenized_text = tokenized_text.unsqueeze(1).repeat(1, self.num_unet_layers, 1).view(b * self.num_unet_layers, n)
-            # mirror-reflect the embedding along the layer dimension, to make it symmetric 
-            # in the encoder & decoder.
 
         for placeholder_string, placeholder_token in self.string_to_token_dict.items():
             placeholder_embedding = self.string_to_param_dict[placeholder_string].to(device)
@@ -602,29 +880,23 @@ class EmbeddingManager(nn.Module):
             # max_vectors_per_layer_per_token == 1: original num_vectors_per_token == 1, but 
             # self.use_layerwise_embedding could still be True.
             if self.max_vectors_per_layer_per_token == 1: # If there's only one vector per token, we can do a simple replacement
-                placeholder_idx = torch.where(tokenized_text == placeholder_token.to(device))
-                if placeholder_idx[0].numel() == 0:
-                    continue
-
-                # embedded_text[placeholder_idx] indexes the embedding at each instance in the batch.
-                # Non-layerwise: embedded_text[placeholder_idx]: [2, 768].  placeholder_embedding: [1, 768].
-                # layerwise: placeholder_idx =  
-                # (tensor([ 0, 1, 2, 3, 4, 5, 6, 7, 8, 9, 10, 11, 12, 13, 14, 15, 16, 17]), 
-                #  tensor([ 6, 6, 6, 6, 6, 6, 6, 6, 6, 6, 6, 6, 6, 6, 6, 6, 6, 6]))
-                # embedded_text[placeholder_idx]: [32, 768]. placeholder_embedding: [16, 768].
-                # The first 16 elements (0-8) in embedded_text[placeholder_idx] correspond to the 16 layers of the 
-                # first instance in the batch.
-                # 16 layers of placeholder_embedding are repeated b times.
-                # placeholder_embedding: placeholder_embedding: [16, 768] repeat=> [32, 768]
+                # The embeddings at the placeholder tokens are replaced with a masked torch.where(). 
+                # Indexing with the positions of the placeholder tokens (torch.where(cond), i.e., nonzero()) 
+                # and checking whether there are any would sync with the host at each call.
+                # placeholder_mask: [B, N, 1] (non-layerwise) or [B, 1, N, 1] (layerwise).
+                placeholder_mask = (tokenized_text == placeholder_token.to(device)).unsqueeze(-1)
+                # Non-layerwise: placeholder_embedding: [1, 768] => [1, 1, 768], broadcasted to all instances.
+                # layerwise: placeholder_embedding: [16, 768] => [1, 16, 1, 768], broadcasted to all instances,
+                # and layer i is placed at layer i of embedded_text.
                 # Note that the 16 layers are initialized with the same embedding. 
                 # LINK #init_embed
-                # Possible BUG: if the placeholder appears in > 1 times in one prompt, then the 
-                # filling order may be wrong. Check in the future.
+                placeholder_embedding = placeholder_embedding * self.subj_scale
                 if self.use_layerwise_embedding:
-                    OCCUR = placeholder_idx[0].numel() // self.num_unet_layers
+                    placeholder_embedding = placeholder_embedding.view(1, self.num_unet_layers, 1, -1)
                 else:
-                    OCCUR = placeholder_idx[0].numel()
-                embedded_text[placeholder_idx] = placeholder_embedding.repeat(OCCUR, 1) * self.subj_scale
+                    placeholder_embedding = placeholder_embedding.unsqueeze(1)
+                embedded_text = torch.where(placeholder_mask, placeholder_embedding.to(embedded_text.dtype), 
+                                            embedded_text)
 
             # *multi-vector latent space*: In this space, S* is embedded into multiple 
             # learned embeddings, an approach that is equivalent to describing
@@ -665,6 +937,12 @@ class EmbeddingManager(nn.Module):
                     embedded_text[row]  = new_embed_row
                     tokenized_text[row] = new_token_row
 
+        if self.use_layerwise_embedding and self.max_vectors_per_layer_per_token == 1:
+            # embedded_text: [B, 16, N, 768] => [16*B, N, 768].
+            # "Tuck" the layer dimension into the batch dimension, 
+            # to keep embedded_text in 3D, same as the input.
+            embedded_text = embedded_text.reshape(b * self.num_unet_layers, n, -1)
+
         return embedded_text
 
     # "Patch" the returned embeddings of CLIPTextEmbeddings.
@@ -691,6 +969,12 @@ class EmbeddingManager(nn.Module):
         if not self.use_layerwise_embedding:
             raise NotImplementedError("non-layerwise embedding not supported in get_ada_embedding().")
 
+        # Skip generating the ada embeddings if the caller has found, from the prompt strings, 
+        # that there's no placeholder token in the batch. Checking tokenized_text on the device
+        # would sync with the host.
+        if not getattr(self, 'ada_has_placeholder', True):
+            return embedded_text
+
         for placeholder_string, placeholder_token in self.string_to_token_dict.items():
             placeholder_embedder = self.string_to_ada_embedder_dict[placeholder_string].to(device)
             assert isinstance(placeholder_embedder, AdaEmbedding)
@@ -698,22 +982,19 @@ class EmbeddingManager(nn.Module):
             # There's only one vector per token, we can do a simple replacement
             # embedded_text: [B, N, 768].
             # tokenized_text: [B, N].
-            placeholder_idx = torch.where(tokenized_text == placeholder_token.to(device))
-            # Skip generating the ada embedding if there's no placeholder token in the batch.
-            if placeholder_idx[0].numel() == 0:
-                continue
+            # The embeddings at the placeholder tokens are replaced with a masked torch.where(), 
+            # without syncing with the host to find the placeholder positions, as in forward().
+            placeholder_mask = (tokenized_text == placeholder_token.to(device)).unsqueeze(-1)
 
             # Generate the actual placeholder_embedding on the fly.
             # [B=2, 768]
             placeholder_embedding = placeholder_embedder(layer_idx, layer_infeat, time_emb, self.img_mask)
-            # embedded_text[placeholder_idx] indexes the embedding at each instance in the batch.
-            # embedded_text[placeholder_idx]: [2, 768].  placeholder_embedding: [2, 768].
-            # Sometimes (e.g. during inference, some instances contain the placeholder token but
-            # others don't. tokenized_text has a batch size of those containing the placeholder token only.
-            # But layer_infeat is still of the full batch size. So placeholder_embedding has a batch size 
-            # larger than the number of instances containing the placeholder token. We need to index
-            # placeholder_embedding with placeholder_idx[0] to get the matching new placeholder_embedding.
-            embedded_text[placeholder_idx] = placeholder_embedding[placeholder_idx[0]] * self.subj_scale
+            # Sometimes tokenized_text has a smaller batch size than layer_infeat, and 
+            # row i of tokenized_text matches row i of placeholder_embedding.
+            placeholder_embedding = placeholder_embedding[:b] * self.subj_scale
+            # [B, 1, 768] is broadcasted to the N tokens.
+            embedded_text = torch.where(placeholder_mask, placeholder_embedding.unsqueeze(1).to(embedded_text.dtype), 
+                                        embedded_text)
 
         return embedded_text
 
@@ -725,11 +1006,13 @@ class EmbeddingManager(nn.Module):
             rand_ada_emb_weight = self.ada_emb_weight        
         return rand_ada_emb_weight
     
-    def set_ada_layer_info(self, layer_idx, layer_infeat, time_emb):
+    # has_placeholder: False if the prompts are known to contain no placeholder token.
+    def set_ada_layer_info(self, layer_idx, layer_infeat, time_emb, has_placeholder=True):
         self.gen_ada_embedding = True
         self.layer_idx      = layer_idx
         self.layer_infeat   = layer_infeat
         self.time_emb       = time_emb
+        self.ada_has_placeholder = has_placeholder
         # Initialize the ada_embeddings cache list.
 
     # ada_embeddings is used to cache the embeddings of all layers, 
@@ -742,6 +1025,7 @@ class EmbeddingManager(nn.Module):
         self.layer_idx      = -1
         self.layer_infeat   = None
         self.time_emb       = None
+        self.ada_has_placeholder = True
         
     def clear_ada_embedding_cache(self):
         self.ada_embeddings = None
@@ -844,11 +1128,13 @@ class EmbeddingManager(nn.Module):
 
             if reg_center_type == 'init':
                 # initial_embeddings[key] is already [L, 768]. No need to repeat().
-                reg_center = self.initial_embeddings[key].clone()
+                # It's a frozen parameter that's only read by the losses, so it's used without a copy.
+                reg_center = self.initial_embeddings[key]
             else:
                 # make avg_embedding the same shape as embeddings, 
                 # to avoid F.*_loss() whining about broadcasting.
-                avg_embedding = embeddings.mean(dim=0, keepdim=True).repeat(embeddings.shape[0], 1)
+                # expand_as() is a view, instead of BS copies of the mean embedding made by repeat().
+                avg_embedding = embeddings.mean(dim=0, keepdim=True).expand_as(embeddings)
                 reg_center = avg_embedding
 
             l2_norm_reg = torch.norm(embeddings, dim=1).mean()
@@ -893,6 +1179,8 @@ class EmbeddingManager(nn.Module):
 
         # Dynamically adjust the regularization weights. The larger the norm, the larger the weight.
         # T: temperature. Larger T => when norm grows, the penalty is more severe.
+        # The weights are detached 0-d tensors instead of .item() floats, so that computing them 
+        # doesn't block the host on the GPU twice per embedding on every step.
         T = 1.5
 
         for key in self.initial_embeddings:
@@ -902,7 +1190,8 @@ class EmbeddingManager(nn.Module):
                   and not isinstance(embobj, AdaEmbedding):
                     continue
 
-                init_vecs = self.initial_embeddings[key].clone()
+                # init_vecs is only read, so it's not cloned.
+                init_vecs = self.initial_embeddings[key]
                 # bias, pre_vecs, basis_vecs are structures existing in 
                 # both StaticLayerwiseEmbedding and AdaEmbedding.
                 # pre_vecs: basis vectors that are initialized by prespecified init_vecs. 
@@ -917,14 +1206,14 @@ class EmbeddingManager(nn.Module):
                     # Penalize those scales bigger than 1 more than those smaller than 1.
                     loss_bias_scales = loss_bias_scales_above1 + loss_bias_scales_below1 * 0.0001
                     loss_bias        = selective_reg_loss(embobj.bias, loss_type=euc_loss_type)
-                    bias_reg_weight  = bias_reg_weight_base  * torch.norm(embobj.bias, dim=1).mean().item() ** T
+                    bias_reg_weight  = bias_reg_weight_base  * torch.norm(embobj.bias, dim=1).mean().detach() ** T
                 else:
                     loss_bias_scales = 0.
                     loss_bias        = 0.
                     bias_reg_weight  = 0.
 
                 loss_basis       = selective_reg_loss(embobj.basis_vecs, loss_type=euc_loss_type)
-                basis_reg_weight = basis_reg_weight_base * torch.norm(embobj.basis_vecs, dim=1).mean().item() ** T
+                basis_reg_weight = basis_reg_weight_base * torch.norm(embobj.basis_vecs, dim=1).mean().detach() ** T
                 if embobj.N > 0:
                     loss_pre_vecs = selective_reg_loss(embobj.pre_vecs - init_vecs, loss_type=euc_loss_type)
                 else:
@@ -933,12 +1222,12 @@ class EmbeddingManager(nn.Module):
                 loss_ada_maps_weight = 0.
                 loss_ada_maps_bias   = 0.
                 if isinstance(embobj, AdaEmbedding):
-                    for i, map in enumerate(embobj.layer_maps):
-                        loss_ada_maps_weight += selective_reg_loss(map.weight, loss_type=euc_loss_type)
-                        loss_ada_maps_bias   += selective_reg_loss(map.bias,   loss_type=euc_loss_type)
+                    # The layer maps have different input dims, so they are reduced 
+                    # in one batched sum_reg_loss() call each, instead of layer by layer.
+                    loss_ada_maps_weight = sum_reg_loss([ map.weight for map in embobj.layer_maps ], loss_type=euc_loss_type)
+                    loss_ada_maps_bias   = sum_reg_loss([ map.bias   for map in embobj.layer_maps ], loss_type=euc_loss_type)
 
-                if type(loss_bias) == int:
-                    breakpoint()
+                assert not isinstance(loss_bias, int), "loss_bias should be a float or a tensor"
 
                 curr_loss = loss_bias               * bias_reg_weight \
                             + loss_bias_scales      * bias_scales_reg_weight \
@@ -1009,11 +1298,10 @@ class EmbeddingManager(nn.Module):
 
         if do_ada_comp_delta_reg:
             # Each emb is of [4, 77, 768]. 4 = 2 * batch_size.
-            for i, emb in enumerate(self.ada_embeddings):
-                # ada embeddings of all layers should have been stored in self.ada_embeddings
-                # before calling composition_delta_loss().
-                if emb is None:
-                    breakpoint()
+            # ada embeddings of all layers should have been stored in self.ada_embeddings
+            # before calling composition_delta_loss(). Only Python objects are checked, no device sync.
+            missing_layers = [ i for i, emb in enumerate(self.ada_embeddings) if emb is None ]
+            assert len(missing_layers) == 0, f"ada embeddings of layers {missing_layers} are missing"
             # ada_embeddings: [4, 16, 77, 768]
             ada_embeddings = torch.stack(self.ada_embeddings, dim=1)
             ada_subj_emb_single, ada_subj_emb_comp = ada_embeddings.split(BS, dim=0)
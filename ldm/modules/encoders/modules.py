@@ -1,8 +1,9 @@
 import torch
 import torch.nn as nn
+import torch.nn.functional as F
 from functools import partial
 import clip
-from einops import rearrange, repeat
+from einops import rearrange
 from transformers import CLIPTokenizer, CLIPTextModel
 import kornia
 
@@ -15,20 +16,29 @@ def _expand_mask(mask, dtype, tgt_len = None):
     bsz, src_len = mask.size()
     tgt_len = tgt_len if tgt_len is not None else src_len
 
-    expanded_mask = mask[:, None, None, :].expand(bsz, 1, tgt_len, src_len).to(dtype)
+    # The mask only depends on the source position. So the additive mask is computed 
+    # on [bsz, 1, 1, src_seq_len], and expanded over the target positions as a view,
+    # instead of materializing the [bsz, 1, tgt_seq_len, src_seq_len] tensor.
+    inverted_mask = 1.0 - mask[:, None, None, :].to(dtype)
+    inverted_mask = inverted_mask.masked_fill(inverted_mask.to(torch.bool), torch.finfo(dtype).min)
 
-    inverted_mask = 1.0 - expanded_mask
+    return inverted_mask.expand(bsz, 1, tgt_len, src_len)
 
-    return inverted_mask.masked_fill(inverted_mask.to(torch.bool), torch.finfo(dtype).min)
+# Causal attention masks of shape [1, 1, seq_len, seq_len], cached by (seq_len, dtype, device).
+_causal_attention_mask_cache = {}
 
-def _build_causal_attention_mask(bsz, seq_len, dtype):
+def _build_causal_attention_mask(bsz, seq_len, dtype, device=None):
         # lazily create causal attention mask, with full attention between the vision tokens
         # pytorch uses additive attention mask; fill with -inf
-        mask = torch.empty(bsz, seq_len, seq_len, dtype=dtype)
-        mask.fill_(torch.tensor(torch.finfo(dtype).min))
-        mask.triu_(1)  # zero out the lower diagonal
-        mask = mask.unsqueeze(1)  # expand mask
-        return mask
+        # The mask is built once on the target device, and expanded to the batch size as a view, 
+        # instead of filling a [bsz, 1, seq_len, seq_len] mask on the host and copying it 
+        # to the device at every call.
+        key = (seq_len, dtype, device)
+        if key not in _causal_attention_mask_cache:
+            mask = torch.full((seq_len, seq_len), torch.finfo(dtype).min, dtype=dtype, device=device)
+            mask.triu_(1)  # zero out the lower diagonal
+            _causal_attention_mask_cache[key] = mask[None, None]
+        return _causal_attention_mask_cache[key].expand(bsz, 1, seq_len, seq_len)
 
 class AbstractEncoder(nn.Module):
     def __init__(self):
@@ -156,12 +166,64 @@ class SpatialRescaler(nn.Module):
 
 class FrozenCLIPEmbedder(AbstractEncoder):
     """Uses the CLIP transformer encoder for text (from Hugging Face)"""
-    def __init__(self, version="openai/clip-vit-large-patch14", device="cuda", max_length=77):
+    def __init__(self, version="openai/clip-vit-large-patch14", device="cuda", max_length=77,
+                 compile_layers=False, use_autocast=False):
         super().__init__()
         self.tokenizer = CLIPTokenizer.from_pretrained(version)
         self.transformer = CLIPTextModel.from_pretrained(version)
         self.device = device
         self.max_length = max_length
+        # use_autocast: run the text transformer under bf16 autocast, so that the matmuls of 
+        # the encoder layers use the bf16 tensor cores. Layer norms and softmax are kept 
+        # in fp32 by the autocast policy. The output is cast back to fp32.
+        self.use_autocast = use_autocast
+
+        def attention_forward(
+            self,
+            hidden_states,
+            attention_mask = None,
+            causal_attention_mask = None,
+            output_attentions = False,
+        ):
+            bsz, tgt_len, embed_dim = hidden_states.size()
+            # [bsz, seq_len, embed_dim] -> [bsz, num_heads, seq_len, head_dim], as views.
+            q, k, v = [ proj(hidden_states).view(bsz, -1, self.num_heads, self.head_dim).transpose(1, 2)
+                        for proj in (self.q_proj, self.k_proj, self.v_proj) ]
+            dropout_p = self.dropout if self.training else 0.
+
+            # Without a padding mask, the only mask is the causal mask built in text_encoder_forward().
+            # It's passed to SDPA as is_causal, which allows the flash attention kernel, 
+            # instead of as an additive [bsz, 1, seq_len, seq_len] mask.
+            if attention_mask is None and causal_attention_mask is not None:
+                attn_output = F.scaled_dot_product_attention(q, k, v, dropout_p=dropout_p, is_causal=True)
+            else:
+                attn_mask = causal_attention_mask
+                if attention_mask is not None:
+                    attn_mask = attention_mask if attn_mask is None else attn_mask + attention_mask
+                attn_output = F.scaled_dot_product_attention(q, k, v, attn_mask=attn_mask, dropout_p=dropout_p)
+
+            attn_output = attn_output.transpose(1, 2).reshape(bsz, tgt_len, embed_dim)
+            attn_output = self.out_proj(attn_output)
+            # The attention weights are not computed by SDPA.
+            return attn_output, None
+
+        # self_attn: CLIPAttention. 
+        # The attention is computed with the fused F.scaled_dot_product_attention (torch >= 2.0), 
+        # instead of materializing the [bsz * num_heads, seq_len, seq_len] attention weights.
+        # The default scale of SDPA is head_dim^-0.5, the same as CLIPAttention.scale.
+        if hasattr(F, 'scaled_dot_product_attention'):
+            for layer in self.transformer.text_model.encoder.layers:
+                layer.self_attn.forward = attention_forward.__get__(layer.self_attn)
+
+        # compile_layers: compile the forward of each CLIPEncoderLayer with torch.compile 
+        # (requires torch >= 2.0), which fuses the layer norms, the projections and the residual adds.
+        # Each layer is compiled separately, instead of the whole text model, so that 
+        # the patched forwards below (with the embedding_manager callback) stay in eager mode.
+        # Shapes are specialized (dynamic=False), as only a few batch sizes are used.
+        # The bound forwards are replaced, so the state_dict keys are unchanged.
+        if compile_layers and hasattr(torch, 'compile'):
+            for layer in self.transformer.text_model.encoder.layers:
+                layer.forward = torch.compile(layer.forward, dynamic=False)
 
         def embedding_forward(
                 self,
@@ -207,35 +269,21 @@ class FrozenCLIPEmbedder(AbstractEncoder):
             output_hidden_states = None,
             return_dict = None,
         ):
-            output_attentions = output_attentions if output_attentions is not None else self.config.output_attentions
-            output_hidden_states = (
-                output_hidden_states if output_hidden_states is not None else self.config.output_hidden_states
-            )
-            return_dict = return_dict if return_dict is not None else self.config.use_return_dict
-
-            encoder_states = () if output_hidden_states else None
-            all_attentions = () if output_attentions else None
-
+            # Only the last hidden_states is returned. So the intermediate hidden states and 
+            # the attention weights are not collected, even if output_hidden_states / output_attentions 
+            # are set (in the arguments or the config). Otherwise the layers would keep all of them 
+            # alive until the end of the forward, and compute the attention weights as an extra output.
             hidden_states = inputs_embeds
             for idx, encoder_layer in enumerate(self.layers):
-                if output_hidden_states:
-                    encoder_states = encoder_states + (hidden_states,)
-
                 layer_outputs = encoder_layer(
                     hidden_states,
                     attention_mask,
                     causal_attention_mask,
-                    output_attentions=output_attentions,
+                    output_attentions=False,
                 )
 
                 hidden_states = layer_outputs[0]
 
-                if output_attentions:
-                    all_attentions = all_attentions + (layer_outputs[1],)
-
-            if output_hidden_states:
-                encoder_states = encoder_states + (hidden_states,)
-
             return hidden_states
 
 
@@ -273,19 +321,29 @@ class FrozenCLIPEmbedder(AbstractEncoder):
             input_ids = input_ids.view(-1, input_shape[-1])
 
             hidden_states = self.embeddings(input_ids=input_ids, position_ids=position_ids, embedding_manager=embedding_manager)
+            # embedding_manager may return a view in a different layout (e.g., the layerwise embeddings 
+            # reshaped from [B, 16, N, 768]). The Linear layers of the encoder only take 
+            # the single-addmm path on a contiguous 3D input. No-op if it's already contiguous.
+            hidden_states = hidden_states.contiguous()
             # the batch size could be modified by embedding_manager
             bsz = hidden_states.shape[0]
             seq_len = input_shape[1]
             # CLIP's text model uses causal mask, prepare it here.
             # https://github.com/openai/CLIP/blob/cfcffb90e69f37bf2ff1e988237a0fbe41f33c04/clip/model.py#L324
-            causal_attention_mask = _build_causal_attention_mask(bsz, seq_len, hidden_states.dtype).to(
-                hidden_states.device
-            )
+            causal_attention_mask = _build_causal_attention_mask(bsz, seq_len, hidden_states.dtype, 
+                                                                 hidden_states.device)
 
             # expand attention_mask
             if attention_mask is not None:
                 # [bsz, seq_len] -> [bsz, 1, tgt_seq_len, src_seq_len]
                 attention_mask = _expand_mask(attention_mask, hidden_states.dtype)
+                # Both masks are additive. Merge them into one bias here, so that each encoder layer 
+                # adds one mask to the attention logits, instead of two.
+                # Clamped so that the positions masked by both don't overflow to -inf.
+                # The merged bias is passed as attention_mask, so that a causal_attention_mask
+                # always means the plain causal mask (which attention_forward() passes to SDPA as is_causal).
+                attention_mask = (causal_attention_mask + attention_mask).clamp_(min=torch.finfo(hidden_states.dtype).min)
+                causal_attention_mask = None
 
             last_hidden_state = self.encoder(
                 inputs_embeds=hidden_states,
@@ -349,14 +407,23 @@ class FrozenCLIPEmbedder(AbstractEncoder):
     # kwargs: embedding_manager
     def forward(self, text, **kwargs):
         # tokenizer: CLIPTokenizer.
-        batch_encoding = self.tokenizer(text, truncation=True, max_length=self.max_length, return_length=True,
-                                        return_overflowing_tokens=False, padding="max_length", return_tensors="pt")
+        # Only input_ids is used. The lengths and the attention mask are not requested, 
+        # so that the tokenizer doesn't build and tensorize them in the returned BatchEncoding at every call.
+        batch_encoding = self.tokenizer(text, truncation=True, max_length=self.max_length, return_length=False,
+                                        return_attention_mask=False, return_overflowing_tokens=False, 
+                                        padding="max_length", return_tensors="pt")
         tokens = batch_encoding["input_ids"].to(self.device)      
         # transformer: CLIPTextModel. 
         # transformer.text_model: CLIPTextTransformer. 
         # transformer.text_model.encoder: CLIPEncoder
         # transformer.text_model.embeddings: CLIPTextEmbeddings
-        z = self.transformer(input_ids=tokens, **kwargs)
+        # Compatible with FrozenCLIPEmbedder objects pickled before use_autocast was added.
+        if getattr(self, 'use_autocast', False):
+            with torch.autocast(device_type=tokens.device.type, dtype=torch.bfloat16):
+                z = self.transformer(input_ids=tokens, **kwargs)
+            z = z.float()
+        else:
+            z = self.transformer(input_ids=tokens, **kwargs)
 
         return z
 
@@ -392,7 +459,9 @@ class FrozenCLIPTextEmbedder(nn.Module):
         z = self(text)
         if z.ndim==2:
             z = z[:, None, :]
-        z = repeat(z, 'b 1 d -> b k d', k=self.n_repeat)
+        # 'b 1 d -> b k d' as a broadcast view over the k repeats of the pooled text embedding, 
+        # instead of materializing k copies.
+        z = z.expand(-1, self.n_repeat, -1)
         return z
 
 
@@ -406,11 +475,19 @@ class FrozenClipImageEmbedder(nn.Module):
             jit=False,
             device='cuda' if torch.cuda.is_available() else 'cpu',
             antialias=False,
+            use_channels_last=False,
         ):
         super().__init__()
         self.model, _ = clip.load(name=model, device=device, jit=jit)
 
         self.antialias = antialias
+        # use_channels_last: run the patch embedding conv of the ViT in channels_last (NHWC), 
+        # which uses the NHWC tensor core kernels of cuDNN on Volta and later GPUs.
+        # The NHWC conv output is already in the [B, H*W, C] token order, so the flattening 
+        # into tokens that follows the conv is a view. Not supported by the jit model.
+        self.use_channels_last = use_channels_last and not jit and hasattr(self.model.visual, 'conv1')
+        if self.use_channels_last:
+            self.model.visual.conv1.to(memory_format=torch.channels_last)
 
         self.register_buffer('mean', torch.Tensor([0.48145466, 0.4578275, 0.40821073]), persistent=False)
         self.register_buffer('std', torch.Tensor([0.26862954, 0.26130258, 0.27577711]), persistent=False)
@@ -427,7 +504,10 @@ class FrozenClipImageEmbedder(nn.Module):
 
     def forward(self, x):
         # x is assumed to be in range [-1,1]
-        return self.model.encode_image(self.preprocess(x))
+        x = self.preprocess(x)
+        if self.use_channels_last:
+            x = x.contiguous(memory_format=torch.channels_last)
+        return self.model.encode_image(x)
 
 
 if __name__ == "__main__":
@@ -68,6 +68,18 @@ def mean_flat(tensor):
     return tensor.mean(dim=list(range(1, len(tensor.shape))))
 
 
+def rescale_to_pm1(x):
+    """
+    Linearly rescale x to [-1, 1] by its global min and max.
+    torch.aminmax() finds both in one reduction (PyTorch >= 1.11), instead of two.
+    """
+    if hasattr(torch, 'aminmax'):
+        x_min, x_max = torch.aminmax(x)
+    else:
+        x_min, x_max = x.min(), x.max()
+    return 2. * (x - x_min) / (x_max - x_min) - 1.
+
+
 def count_params(model, verbose=False):
     total_params = sum(p.numel() for p in model.parameters())
     if verbose:
@@ -75,6 +87,15 @@ def count_params(model, verbose=False):
     return total_params
 
 
+def params_version_key(params):
+    """
+    A key of the current values of params, for caches of tensors computed from them.
+    In-place updates of a param bump its _version, and replacing it (e.g. by .to()
+    or by loading a checkpoint) changes its data_ptr.
+    """
+    return tuple((p.data_ptr(), p._version) for p in params)
+
+
 def instantiate_from_config(config, **kwargs):
     if not "target" in config:
         if config == '__is_first_stage__':
@@ -0,0 +1,202 @@
+import pytest
+
+torch = pytest.importorskip("torch")
+pytest.importorskip("pytorch_lightning")
+
+import numpy as np
+import torch.nn as nn
+from collections import OrderedDict
+from types import SimpleNamespace
+
+from ldm.models.diffusion.ddpm import DDPM, LatentDiffusion
+from ldm.modules.diffusionmodules.util import make_beta_schedule
+
+
+# The buffers register_schedule() saves into checkpoints. lvlb_weights and the half-precision copies
+# of the coefficients are non-persistent.
+SCHEDULE_CKPT_KEYS = [
+    'betas', 'alphas_cumprod', 'alphas_cumprod_prev',
+    'sqrt_alphas_cumprod', 'sqrt_one_minus_alphas_cumprod', 'log_one_minus_alphas_cumprod',
+    'sqrt_recip_alphas_cumprod', 'sqrt_recipm1_alphas_cumprod',
+    'posterior_variance', 'posterior_log_variance_clipped',
+    'posterior_mean_coef1', 'posterior_mean_coef2',
+]
+
+
+# Holds the attributes register_schedule() reads, without building a UNet.
+class ScheduleHolder(nn.Module):
+    def __init__(self, v_posterior=0., parameterization="eps"):
+        super().__init__()
+        self.v_posterior = v_posterior
+        self.parameterization = parameterization
+
+
+@pytest.mark.parametrize("v_posterior", [0., 0.1])
+def test_register_schedule_checkpoint_format(v_posterior):
+    holder = ScheduleHolder(v_posterior)
+    DDPM.register_schedule(holder, timesteps=100)
+    assert sorted(holder.state_dict().keys()) == sorted(SCHEDULE_CKPT_KEYS)
+
+    # The coefficients as computed one by one before the one-pass derivation.
+    betas = make_beta_schedule("linear", 100, linear_start=1e-4, linear_end=2e-2)
+    alphas = 1. - betas
+    alphas_cumprod = np.cumprod(alphas, axis=0)
+    alphas_cumprod_prev = np.append(1., alphas_cumprod[:-1])
+    posterior_variance = (1 - v_posterior) * betas * (1. - alphas_cumprod_prev) / (
+                1. - alphas_cumprod) + v_posterior * betas
+    expected = {
+        'sqrt_alphas_cumprod':              np.sqrt(alphas_cumprod),
+        'sqrt_one_minus_alphas_cumprod':    np.sqrt(1. - alphas_cumprod),
+        'log_one_minus_alphas_cumprod':     np.log(1. - alphas_cumprod),
+        'sqrt_recip_alphas_cumprod':        np.sqrt(1. / alphas_cumprod),
+        'sqrt_recipm1_alphas_cumprod':      np.sqrt(1. / alphas_cumprod - 1),
+        'posterior_variance':               posterior_variance,
+        'posterior_log_variance_clipped':   np.log(np.maximum(posterior_variance, 1e-20)),
+        'posterior_mean_coef1':             betas * np.sqrt(alphas_cumprod_prev) / (1. - alphas_cumprod),
+        'posterior_mean_coef2':             (1. - alphas_cumprod_prev) * np.sqrt(alphas) / (1. - alphas_cumprod),
+    }
+    for name, coef in expected.items():
+        torch.testing.assert_close(getattr(holder, name), torch.tensor(coef, dtype=torch.float32))
+
+    # A checkpoint of the schedule loads strictly into a fresh module.
+    holder2 = ScheduleHolder(v_posterior)
+    DDPM.register_schedule(holder2, timesteps=100)
+    holder2.load_state_dict(holder.state_dict(), strict=True)
+    assert not torch.isnan(holder.lvlb_weights).any()
+
+
+# Holds the attributes encode_prompts_cached() reads. The prompt "embeddings" depend on 
+# the params of a stand-in embedding manager, and the encoded prompts are recorded.
+def make_prompt_encoder():
+    em = nn.Linear(3, 3)
+    calls = []
+    def encode_unique_prompts(c):
+        calls.append(list(c))
+        return em.weight.sum().expand(len(c), 3) + torch.arange(len(c)).unsqueeze(1)
+    holder = SimpleNamespace(embedding_manager=em, use_ada_embedding=False, use_layerwise_embedding=False,
+                             _cond_cache=OrderedDict(), cond_cache_size=4,
+                             encode_unique_prompts=encode_unique_prompts)
+    return holder, calls
+
+
+def test_encode_prompts_cached_invalidation():
+    holder, calls = make_prompt_encoder()
+    prompts = ["a photo of z", ""]
+    with torch.no_grad():
+        c1 = LatentDiffusion.encode_prompts_cached(holder, prompts)
+        c2 = LatentDiffusion.encode_prompts_cached(holder, prompts)
+        assert len(calls) == 1
+        torch.testing.assert_close(c1, c2)
+        # Hits return copies, which can be changed in place without affecting the cache.
+        c2.zero_()
+        torch.testing.assert_close(LatentDiffusion.encode_prompts_cached(holder, prompts), c1)
+        assert len(calls) == 1
+
+        # An in-place update of the embedding manager params (e.g. an optimizer step).
+        holder.embedding_manager.weight.add_(1.)
+        c3 = LatentDiffusion.encode_prompts_cached(holder, prompts)
+        assert len(calls) == 2
+        torch.testing.assert_close(c3, c1 + 9.)
+
+        # Replacing a param (e.g. loading another checkpoint).
+        holder.embedding_manager.weight = nn.Parameter(torch.zeros(3, 3))
+        c4 = LatentDiffusion.encode_prompts_cached(holder, prompts)
+        assert len(calls) == 3
+        torch.testing.assert_close(c4[:, 0], torch.tensor([0., 1.]))
+
+    # With grad, the prompts are always encoded.
+    LatentDiffusion.encode_prompts_cached(holder, prompts)
+    LatentDiffusion.encode_prompts_cached(holder, prompts)
+    assert len(calls) == 5
+
+
+# The per-bbox rescaling of _rescale_annotations(), with the clamp to [0, 1] it intended.
+def rescale_bbox_ref(bbox, crop_coordinates):
+    clamp = lambda v: min(max(v, 0.), 1.)
+    x0 = clamp((bbox[0] - crop_coordinates[0]) / crop_coordinates[2])
+    y0 = clamp((bbox[1] - crop_coordinates[1]) / crop_coordinates[3])
+    w = min(bbox[2] / crop_coordinates[2], 1 - x0)
+    h = min(bbox[3] / crop_coordinates[3], 1 - y0)
+    return x0, y0, w, h
+
+
+def test_rescale_annotations():
+    crop_coordinates = (0.2, 0.1, 0.5, 0.6)
+    bboxes = [ (0.3, 0.2, 0.1, 0.1),     # inside the crop
+               (0.0, 0.0, 0.3, 0.4),     # overlaps the top-left corner
+               (0.6, 0.5, 0.4, 0.5),     # crosses the bottom-right border
+               (0.9, 0.9, 0.05, 0.05) ]  # outside the crop
+    rescaled = LatentDiffusion._rescale_annotations(None, bboxes, crop_coordinates)
+    assert len(rescaled) == len(bboxes)
+    for bbox, bbox_rescaled in zip(bboxes, rescaled):
+        assert isinstance(bbox_rescaled, tuple)
+        np.testing.assert_allclose(bbox_rescaled, rescale_bbox_ref(bbox, crop_coordinates))
+
+    assert LatentDiffusion._rescale_annotations(None, [], crop_coordinates) == []
+
+
+# A text encoder whose prompt "embeddings" depend on its params. The encoded prompts are recorded.
+class PromptEncoder(nn.Module):
+    def __init__(self):
+        super().__init__()
+        self.proj = nn.Linear(3, 3)
+        self.calls = []
+
+    def encode(self, prompts, embedding_manager=None):
+        assert embedding_manager is None
+        self.calls.append(list(prompts))
+        return self.proj.weight.sum().expand(len(prompts), 3).clone()
+
+
+def test_encode_base_prompts_cached_invalidation():
+    encoder = PromptEncoder()
+    holder = SimpleNamespace(cond_stage_model=encoder, _cond_cache=OrderedDict(), cond_cache_size=4)
+    prompts = ["", ""]
+    with torch.no_grad():
+        c1 = LatentDiffusion.encode_base_prompts_cached(holder, prompts)
+        c2 = LatentDiffusion.encode_base_prompts_cached(holder, prompts)
+        assert len(encoder.calls) == 1
+        # Hits return copies, which can be changed in place without affecting the cache.
+        c2.add_(1.)
+        torch.testing.assert_close(LatentDiffusion.encode_base_prompts_cached(holder, prompts), c1)
+        assert len(encoder.calls) == 1
+
+        # An in-place update of the text encoder params (e.g. with unfreeze_model).
+        encoder.proj.weight.add_(1.)
+        c3 = LatentDiffusion.encode_base_prompts_cached(holder, prompts)
+        assert len(encoder.calls) == 2
+        torch.testing.assert_close(c3, c1 + 9.)
+
+
+def test_encode_first_stage_cached_invalidation():
+    calls = []
+    def encode_first_stage(x):
+        calls.append(x)
+        return x * 2
+    holder = SimpleNamespace(encode_first_stage=encode_first_stage)
+
+    x_batch = torch.randn(4, 3, 8, 8)
+    posterior = LatentDiffusion.encode_first_stage_cached(holder, x_batch, x_batch)
+    assert LatentDiffusion.encode_first_stage_cached(holder, x_batch, x_batch) is posterior
+    assert len(calls) == 1
+
+    # Another batch size, an in-place update of the batch, and another batch are encoded again.
+    LatentDiffusion.encode_first_stage_cached(holder, x_batch, x_batch[:2], bs=2)
+    assert len(calls) == 2
+    x_batch.add_(1.)
+    torch.testing.assert_close(LatentDiffusion.encode_first_stage_cached(holder, x_batch, x_batch), x_batch * 2)
+    assert len(calls) == 3
+    LatentDiffusion.encode_first_stage_cached(holder, x_batch.clone(), x_batch)
+    assert len(calls) == 4
+
+
+def test_validation_step_clears_first_stage_cache(monkeypatch):
+    steps = []
+    monkeypatch.setattr(DDPM, "validation_step", lambda self, batch, batch_idx: steps.append(batch_idx))
+    # validation_step() only needs a LatentDiffusion instance, not a UNet or a first stage model.
+    model = LatentDiffusion.__new__(LatentDiffusion)
+    nn.Module.__init__(model)
+    model._first_stage_cache = (None, None, torch.zeros(1))
+    LatentDiffusion.validation_step(model, {}, 3)
+    assert steps == [3]
+    assert model._first_stage_cache is None
@@ -0,0 +1,144 @@
+import pickle
+import pytest
+
+torch = pytest.importorskip("torch")
+pytest.importorskip("transformers")
+pytest.importorskip("torchvision")
+
+from ldm.modules.embedding_manager import StaticLayerwiseEmbedding, AdaEmbedding, MaskedAvgPool2d, \
+                                          EmbeddingManager
+
+
+def test_static_layerwise_embedding_eval_cache():
+    torch.manual_seed(0)
+    emb = StaticLayerwiseEmbedding(dim1=4, dim2=8, r=3, device_type="cpu").eval()
+    with torch.no_grad():
+        out1 = emb()
+        # Cached until a param is updated.
+        assert emb() is out1
+        torch.testing.assert_close(out1, emb._forward())
+
+        # An in-place update (e.g. an optimizer step or load_state_dict()).
+        emb.bias.add_(1.)
+        out2 = emb()
+        assert out2 is not out1
+        torch.testing.assert_close(out2, out1 + emb.bias_scales)
+
+        # Replacing a param.
+        emb.basis_vecs = torch.nn.Parameter(torch.zeros_like(emb.basis_vecs))
+        out3 = emb()
+        assert out3 is not out2
+        torch.testing.assert_close(out3, emb._forward())
+
+    # Training and grad-enabled calls are not cached.
+    emb.train()
+    assert emb() is not emb()
+    emb.eval()
+    assert emb().requires_grad
+
+
+def test_static_layerwise_embedding_pickle_drops_cache():
+    emb = StaticLayerwiseEmbedding(dim1=4, dim2=8, r=3, device_type="cpu").eval()
+    with torch.no_grad():
+        out = emb()
+    emb2 = pickle.loads(pickle.dumps(emb))
+    assert emb2._eval_cache is None
+    with torch.no_grad():
+        torch.testing.assert_close(emb2(), out)
+
+    # Objects pickled before the cache was added don't have it.
+    del emb2.__dict__['_eval_cache']
+    with torch.no_grad():
+        torch.testing.assert_close(emb2(), out)
+
+
+def test_ada_embedding_basis_cache():
+    torch.manual_seed(0)
+    emb = AdaEmbedding(dim2=8, r=3, device_type="cpu").eval()
+    torch.nn.init.normal_(emb.bias)
+    with torch.no_grad():
+        basis_vecs, layer_biases = emb.get_basis_vecs_and_biases()
+        # Cached until a param is updated.
+        assert emb.get_basis_vecs_and_biases()[1] is layer_biases
+        torch.testing.assert_close(layer_biases, emb.bias * emb.bias_scales)
+
+        emb.bias_scales.mul_(2.)
+        basis_vecs2, layer_biases2 = emb.get_basis_vecs_and_biases()
+        assert layer_biases2 is not layer_biases
+        torch.testing.assert_close(layer_biases2, emb.bias * emb.bias_scales)
+
+        emb.basis_vecs = torch.nn.Parameter(torch.randn_like(emb.basis_vecs))
+        basis_vecs3, _ = emb.get_basis_vecs_and_biases()
+        torch.testing.assert_close(basis_vecs3, emb.basis_vecs)
+
+    # The basis vectors are recomputed with grad, so that they are trained.
+    emb.train()
+    basis_vecs, _ = emb.get_basis_vecs_and_biases()
+    assert basis_vecs.requires_grad
+
+
+# Masked average pooling of x: [N, C, H, W] with mask: [N, 1, H0, W0], resized with F.interpolate.
+def masked_avg_pool_ref(x, mask):
+    mask = torch.nn.functional.interpolate(mask, size=x.shape[-2:], mode='nearest')
+    return (x * mask).sum(dim=(2, 3)) / mask.sum(dim=(2, 3))
+
+
+def test_masked_avg_pool_mask_cache():
+    torch.manual_seed(0)
+    pool = MaskedAvgPool2d(mask_cache_size=2)
+    mask = (torch.rand(2, 1, 16, 16) > 0.3).float()
+    x8, x4 = torch.randn(2, 5, 8, 8), torch.randn(2, 5, 4, 4)
+
+    torch.testing.assert_close(pool(x8, mask), masked_avg_pool_ref(x8, mask))
+    torch.testing.assert_close(pool(x4, mask), masked_avg_pool_ref(x4, mask))
+    torch.testing.assert_close(pool(x8, mask), masked_avg_pool_ref(x8, mask))
+    assert len(pool._mask_cache) == 2
+
+    # The batch repeated twice in x is pooled with the same mask.
+    x8_rep = torch.cat([x8, x8])
+    torch.testing.assert_close(pool(x8_rep, mask), masked_avg_pool_ref(x8_rep, torch.cat([mask, mask])))
+
+    # An in-place update of the mask invalidates its cached resized copies.
+    mask[:, :, :8] = 1.
+    torch.testing.assert_close(pool(x8, mask), masked_avg_pool_ref(x8, mask))
+    # The oldest entry is evicted.
+    assert len(pool._mask_cache) == 2
+
+    pool2 = pickle.loads(pickle.dumps(pool))
+    assert len(pool2._mask_cache) == 0
+
+
+# An EmbeddingManager with a multi-vector placeholder "z" (token 5), without a text encoder.
+def make_multi_vector_manager(num_unet_layers=4, num_vectors=2, dim=8):
+    em = EmbeddingManager.__new__(EmbeddingManager)
+    torch.nn.Module.__init__(em)
+    em.gen_ada_embedding = False
+    em.use_layerwise_embedding = True
+    em.num_unet_layers = num_unet_layers
+    em.max_vectors_per_layer_per_token = num_vectors
+    em.progressive_words = False
+    em.subj_scale = 1.
+    em.string_to_token_dict = { 'z': torch.tensor(5) }
+    em.string_to_param_dict = torch.nn.ParameterDict({ 'z': torch.nn.Parameter(torch.randn(num_vectors, dim)) })
+    return em
+
+
+def test_embedding_manager_layerwise_multi_vector_forward():
+    torch.manual_seed(0)
+    em = make_multi_vector_manager()
+    tokenized_text = torch.tensor([[1, 5, 2, 3, 4, 0],
+                                   [1, 2, 3, 0, 0, 0]])
+    embedded_text = torch.randn(2, 6, 8)
+
+    with torch.no_grad():
+        out = em(tokenized_text.clone(), embedded_text.clone())
+    assert out.shape == (2 * em.num_unet_layers, 6, 8)
+
+    # The placeholder of the first prompt is replaced by its 2 vectors, and the following 
+    # tokens are shifted to the right and truncated. The second prompt has no placeholder.
+    placeholder_vecs = em.string_to_param_dict['z'].detach()
+    expected0 = torch.cat([embedded_text[0, :1], placeholder_vecs, embedded_text[0, 2:5]])
+    out = out.view(2, em.num_unet_layers, 6, 8)
+    for layer_idx in range(em.num_unet_layers):
+        torch.testing.assert_close(out[0, layer_idx], expected0)
+        torch.testing.assert_close(out[1, layer_idx], embedded_text[1])
@@ -0,0 +1,60 @@
+import pytest
+
+torch = pytest.importorskip("torch")
+pytest.importorskip("einops")
+
+from ldm.modules.diffusionmodules.model import AttnBlock
+
+
+# AttnBlock.forward() with three separate q, k, v convs, and the scale applied to the attention weights.
+def attn_block_ref(block, x):
+    h_ = block.norm(x)
+    q = block.q(h_)
+    k = block.k(h_)
+    v = block.v(h_)
+
+    b,c,h,w = q.shape
+    q = q.reshape(b,c,h*w).permute(0,2,1)   # b,hw,c
+    k = k.reshape(b,c,h*w)                  # b,c,hw
+    w_ = torch.bmm(q,k) * (int(c)**(-0.5))  # b,hw,hw
+    w_ = torch.nn.functional.softmax(w_, dim=2)
+
+    v = v.reshape(b,c,h*w)
+    h_ = torch.bmm(v,w_.permute(0,2,1))     # b,c,hw
+    h_ = h_.reshape(b,c,h,w)
+    return x + block.proj_out(h_)
+
+
+@pytest.mark.parametrize("memory_format", [torch.contiguous_format, torch.channels_last])
+def test_attn_block_qkv_folding(memory_format):
+    torch.manual_seed(0)
+    block = AttnBlock(64).eval()
+    # Non-zero biases, so that the folded scale of the q bias is covered.
+    for conv in (block.q, block.k, block.v):
+        torch.nn.init.normal_(conv.bias)
+    x = torch.randn(2, 64, 8, 6).to(memory_format=memory_format)
+
+    with torch.no_grad():
+        torch.testing.assert_close(block(x), attn_block_ref(block, x), rtol=1e-4, atol=1e-5)
+
+    # The parameters and state_dict keys are unchanged.
+    assert sorted(block.state_dict().keys()) == sorted(
+        f"{name}.{p}" for name in ("norm", "q", "k", "v", "proj_out") for p in ("weight", "bias"))
+
+
+def test_attn_block_scale_folding_grads():
+    torch.manual_seed(0)
+    block = AttnBlock(32)
+    x = torch.randn(1, 32, 4, 4)
+    q_weight, q_bias = block.q.weight.detach().clone(), block.q.bias.detach().clone()
+
+    block(x).square().sum().backward()
+    grads = [ p.grad.clone() for p in block.parameters() ]
+    block.zero_grad()
+    attn_block_ref(block, x).square().sum().backward()
+    for grad, p in zip(grads, block.parameters()):
+        torch.testing.assert_close(grad, p.grad, rtol=1e-4, atol=1e-5)
+
+    # The scale is folded into a scaled copy of the q weight and bias, not into the params.
+    torch.testing.assert_close(block.q.weight, q_weight, rtol=0, atol=0)
+    torch.testing.assert_close(block.q.bias, q_bias, rtol=0, atol=0)